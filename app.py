@@ -1,52 +1,71 @@
 from flask import Flask, g, request, abort, redirect, render_template, jsonify
-from dash import Dash, _dash_renderer
-import dash_bootstrap_components as dbc
-import dash_mantine_components as dmc
 from sys import argv
-from db import db_util, memcached_util
-from layout import get_layout
-import dash_uploader as du
+from db import db_util, memcached_util, cache_gc
 import json
 import jwt
 from auth import init_auth
 
-server = Flask(__name__)
-init_auth(server)
+# Job processes (see jobs.py) import this module again as __mp_main__, nothing may run at import:
+# the app is only built, and the background threads only started, by the process serving it
+def create_app():
+    """
+    Build the Dash app and its Flask server (app.server, e.g. for a WSGI server), start the cache sweeper
+    """
+    from dash import Dash, _dash_renderer
+    import dash_bootstrap_components as dbc
+    import dash_mantine_components as dmc
+    import dash_uploader as du
+    from layout import get_layout
 
-external_stylesheets = ["/static/style.css", dbc.themes.BOOTSTRAP, dmc.styles.NOTIFICATIONS]
-_dash_renderer._set_react_version("18.2.0")
-app = Dash(
-    server=server, 
-    external_stylesheets=external_stylesheets,
-    title="GENII", 
-    update_title=None
-    # 这个参数抑制callback相关的exception
-    # 比如，一开始在页面上不存在的，动态生成的按钮，它的callback会报错说元素不存在
-    # 用这个参数可以抑制这类报错，但是也会抑制真正的错误（打错id之类的）
-    # suppress_callback_exceptions=True
-)
+    server = Flask(__name__)
+    init_auth(server)
 
-# 自定义的renderer，每次request前都手动放入Authorization header
-# now use JWT, no longer needed
-# app.renderer = '''
-# var renderer = new DashRenderer({
-#     request_pre: (payload) => {
-#         // console.log(payload);
-#         store.getState().config.fetch.headers['Authorization'] = atob(localStorage.getItem("auth-key"));
-#         // store.getState().config.fetch.headers['Authorization'] = "asdasdasd"
-#     },
-#     request_post: (payload, response) => {
-#         // console.log(payload);
-#         // console.log(store.getState());
-#     }
-# })
-# '''
+    external_stylesheets = ["/static/style.css", dbc.themes.BOOTSTRAP, dmc.styles.NOTIFICATIONS]
+    _dash_renderer._set_react_version("18.2.0")
+    app = Dash(
+        server=server, 
+        external_stylesheets=external_stylesheets,
+        title="GENII", 
+        update_title=None
+        # 这个参数抑制callback相关的exception
+        # 比如，一开始在页面上不存在的，动态生成的按钮，它的callback会报错说元素不存在
+        # 用这个参数可以抑制这类报错，但是也会抑制真正的错误（打错id之类的）
+        # suppress_callback_exceptions=True
+    )
 
+    # 自定义的renderer，每次request前都手动放入Authorization header
+    # now use JWT, no longer needed
+    # app.renderer = '''
+    # var renderer = new DashRenderer({
+    #     request_pre: (payload) => {
+    #         // console.log(payload);
+    #         store.getState().config.fetch.headers['Authorization'] = atob(localStorage.getItem("auth-key"));
+    #         // store.getState().config.fetch.headers['Authorization'] = "asdasdasd"
+    #     },
+    #     request_post: (payload, response) => {
+    #         // console.log(payload);
+    #         // console.log(store.getState());
+    #     }
+    # })
+    # '''
 
-du.configure_upload(app, "uploaded_files")
-app.layout = get_layout()
+
+    du.configure_upload(app, "uploaded_files")
+    app.layout = get_layout()
+
+    # 定期清理缓存（TTL、配额），见db/cache_gc.py
+    cache_gc.start_sweeper("uploaded_files")
+
+    @server.route("/api/admin/cache", methods=["GET"])
+    def cache_usage():
+        if not cache_gc.is_admin(g.user_data.id):
+            abort(403)
+        return jsonify(cache_gc.usage_report("uploaded_files"))
+
+    return app
 
 if __name__ == '__main__':
+    app = create_app()
     if argv[1:2] == ["prod"]:
         # TODO change to WSGI server for production https://community.plotly.com/t/how-to-add-your-dash-app-to-flask/51870/2
         # raise NotImplementedError("Production mode not implemented")
@@ -0,0 +1,201 @@
+"""
+Convert exported Compumedics folders into .fif files in bulk
+
+    python batch_convert.py <src> <dst> [-j JOBS] [--pad-zero] [--force]
+
+Every folder under <src> holding a .sdy file is a study, it is written to the same relative location under <dst>
+Progress is kept in <dst>/batch_convert.json, re-running the command only converts studies that are new,
+changed (by size and mtime of their files) or failed last time
+Studies of the report that are not under <src> anymore are kept as "stale", they do not count as failures
+The same file is the per-study report (time taken, input and output size)
+"""
+
+import os
+import os.path as op
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Any, Tuple, List
+
+_manifest_name = "batch_convert.json"
+_manifest_version = 1
+_index_dir_name = "__INDEX"
+
+def find_studies(src: str) -> List[str]:
+    # Same rule as Compumedics(): the first .sdy (sorted) of a folder is the study
+    studies = []
+    for root, dirs, files in os.walk(src):
+        dirs.sort()
+        sdy = sorted(f for f in files if f.lower().endswith(".sdy"))
+        if len(sdy) > 0:
+            studies.append(op.join(root, sdy[0]))
+    return studies
+
+def study_fingerprint(sdy_path: str) -> Tuple[str, int]:
+    # Hash of the relative path, size and mtime of every file of the study, and their total size
+    study_dir = op.dirname(sdy_path)
+    h = hashlib.sha1()
+    total = 0
+    for root, dirs, files in os.walk(study_dir):
+        dirs.sort()
+        for f in sorted(files):
+            path = op.join(root, f)
+            st = os.stat(path)
+            total += st.st_size
+            h.update(f"{op.relpath(path, study_dir)}|{st.st_size}|{st.st_mtime_ns}\n".encode("utf-8"))
+    return h.hexdigest(), total
+
+def _output_path(src: str, dst: str, sdy_path: str) -> str:
+    rel = op.relpath(op.dirname(sdy_path), src)
+    if rel == ".":
+        rel = op.splitext(op.basename(sdy_path))[0]
+    elif rel.lower().endswith(".eeg"):
+        rel = rel[:-4]
+    # MNE expects raw files to end with raw.fif
+    return op.join(dst, rel + "_raw.fif")
+
+def _output_size(out_path: str) -> int:
+    # Large recordings are split into <name>_raw-1.fif, <name>_raw-2.fif, ...
+    out_dir = op.dirname(out_path)
+    stem = op.basename(out_path)[:-len(".fif")]
+    return sum(
+        op.getsize(op.join(out_dir, f)) for f in os.listdir(out_dir)
+        if f == stem + ".fif" or (f.startswith(stem + "-") and f.endswith(".fif"))
+    )
+
+def convert_study(sdy_path: str, out_path: str, index_dir: str | None, pad_zero: bool) -> Dict[str, Any]:
+    """
+    Convert one study, run in the worker processes
+
+    Returns the report entry of the study
+    """
+    # Imported here so that the parent process does not need mne to plan the work
+    from compumedics_util import Compumedics
+
+    t0 = time.perf_counter()
+    # Studies are already converted in parallel, threads inside a worker would only compete with each other
+    c = Compumedics(sdy_path, index_dir=index_dir, n_workers=1)
+    raw = c.export_to_mne_raw(pad_zero=pad_zero, preload=False)
+    t_open = time.perf_counter() - t0
+
+    os.makedirs(op.dirname(out_path), exist_ok=True)
+    raw.save(out_path, overwrite=True, verbose="error")
+    t_total = time.perf_counter() - t0
+
+    return {
+        "n_channels": int(raw.info["nchan"]),
+        "n_times": int(raw.n_times),
+        "sfreq": float(raw.info["sfreq"]),
+        "n_events": len(c.events),
+        "open_sec": round(t_open, 3),
+        "total_sec": round(t_total, 3),
+        "output_bytes": _output_size(out_path),
+    }
+
+def load_manifest(manifest_path: str) -> Dict[str, Dict[str, Any]]:
+    if not op.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != _manifest_version:
+            return {}
+        return manifest["studies"]
+    except (OSError, ValueError, KeyError):
+        print("WARNING: Cannot read", manifest_path, "every study will be converted")
+        return {}
+
+def save_manifest(manifest_path: str, studies: Dict[str, Dict[str, Any]]):
+    # Written after every study, so that an interrupted run can be resumed
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": _manifest_version, "studies": studies}, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+def batch_convert(src: str, dst: str, jobs: int | None = None, pad_zero: bool = False, force: bool = False) -> Dict[str, Dict[str, Any]]:
+    """
+    Convert every study under src into dst
+
+    jobs: int | None = None
+        Number of worker processes, None uses the cpu count
+
+    pad_zero: bool = False
+        Same as Compumedics.export_to_mne_raw()
+
+    force: bool = False
+        Convert every study even if it is unchanged since the last run
+    """
+    src = op.abspath(src)
+    dst = op.abspath(dst)
+    os.makedirs(dst, exist_ok=True)
+    manifest_path = op.join(dst, _manifest_name)
+    index_dir = op.join(dst, _index_dir_name)
+    studies = load_manifest(manifest_path)
+
+    todo = []
+    found = set()
+    for sdy_path in find_studies(src):
+        key = op.relpath(sdy_path, src)
+        found.add(key)
+        out_path = _output_path(src, dst, sdy_path)
+        fingerprint, input_bytes = study_fingerprint(sdy_path)
+        done = studies.get(key)
+        if not force and done is not None and done.get("status") == "ok" and done.get("fingerprint") == fingerprint \
+            and done.get("pad_zero") == pad_zero and op.isfile(done.get("output", "")):
+            print("Skipped (unchanged):", key)
+            continue
+        studies[key] = {
+            "status": "pending",
+            "fingerprint": fingerprint,
+            "pad_zero": pad_zero,
+            "input_bytes": input_bytes,
+            "output": out_path,
+        }
+        todo.append((key, sdy_path, out_path))
+    for key, entry in studies.items():
+        if key not in found and entry.get("status") != "stale":
+            # Source removed (or moved) since it was listed, its output is left alone
+            print("Stale (source is gone):", key)
+            entry["status"] = "stale"
+    save_manifest(manifest_path, studies)
+    print(f"{len(todo)} study(s) to convert")
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(convert_study, sdy_path, out_path, index_dir, pad_zero): key
+            for key, sdy_path, out_path in todo
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            entry = studies[key]
+            try:
+                entry.update(future.result())
+                entry["status"] = "ok"
+                entry.pop("error", None)
+                print(f"Converted {key} in {entry['total_sec']}s ({entry['input_bytes']} -> {entry['output_bytes']} bytes)")
+            except Exception as e:
+                entry["status"] = "failed"
+                entry["error"] = repr(e)
+                print(f"FAILED {key}: {e!r}")
+            save_manifest(manifest_path, studies)
+
+    return studies
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert exported Compumedics folders into .fif files")
+    parser.add_argument("src", help="Folder to search for studies (.sdy) in")
+    parser.add_argument("dst", help="Folder to write the .fif files and the report into")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes (default: cpu count)")
+    parser.add_argument("--pad-zero", action="store_true", help="Pad acquisition gaps with zeros")
+    parser.add_argument("--force", action="store_true", help="Convert unchanged studies again")
+    args = parser.parse_args()
+
+    studies = batch_convert(args.src, args.dst, jobs=args.jobs, pad_zero=args.pad_zero, force=args.force)
+    n_ok = sum(1 for s in studies.values() if s["status"] == "ok")
+    n_stale = sum(1 for s in studies.values() if s["status"] == "stale")
+    n_failed = len(studies) - n_ok - n_stale
+    print(f"{n_ok} ok, {n_failed} failed, {n_stale} stale, report in", op.join(op.abspath(args.dst), _manifest_name))
+    sys.exit(1 if n_failed > 0 else 0)
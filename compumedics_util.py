@@ -16,14 +16,23 @@ import numpy as np
 import os
 import os.path as op
 import re
+import hashlib
 from xml.etree import ElementTree as ET
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
 from typing import Tuple, Iterable, Dict, DefaultDict, Any
 from io import BufferedReader
 from glob import glob
 from access_parser import AccessParser
 import mne
-import ctypes
+from mne.io import BaseRaw
+
+try:
+    from mne._fiff.utils import _mult_cal_one
+except ImportError: # mne < 1.6
+    from mne.io.utils import _mult_cal_one
 
 # Pre compile for efficiency
 _data_root_re_ptrn = re.compile("EEGData", re.IGNORECASE)
@@ -39,6 +48,25 @@ def debug(*_, **__):
 # _inter1020 = ("Fp1", "Fp2", "F3", "F4", "F7", "F8", "C3", "C4", "T3", "T4", "P3", "P4", "T5", "T6", "O1", "O2", "A1", "A2", "Fz", "Cz", "Pz")
 _common_other_ch = ("emg", "eog", "ecg")
 _head_rad = 0.12
+_index_sidecar_ext = ".cmpidx.npz"
+# Bump when the content of the index sidecar changes
+_index_sidecar_version = 1
+_default_n_workers = min(os.cpu_count() or 1, 8)
+# Reads smaller than this (in samples x channels) are copied on the calling thread
+_parallel_read_min_size = 1 << 20
+# Max number of segment views kept alive per .rda file
+_sgmt_cache_size = 64
+_event_sidecar_ext = ".cmpev.npz"
+# Bump when the content of the event sidecar changes
+_event_sidecar_version = 1
+_sgmt_index_dtype = np.dtype([
+    ("rda", "<i4"),
+    ("sgmt", "<i4"),
+    ("first_sample", "<i8"),
+    # Position of the first sample of the segment in the merged recording
+    ("start", "<i8"),
+    ("n_samples", "<i8"),
+])
 
 @dataclass
 class CompumedicHeader():
@@ -58,30 +86,44 @@ class RdaSegment():
     n_samples: int
     is_closed: bool
     shape: Tuple[int, int]
-    _data: np.ndarray | None
 
 @dataclass
 class Rda():
     name: str
+    path: str
     sealed: bool
     pdel: int
-    _file: BufferedReader
+    _mmap: np.memmap
     _sgmt_pos: Tuple[int, ...]
     _sgmt: Tuple[RdaSegment, ...]
+    # LRU of segment views, bounded by _sgmt_cache_size
+    _cache: OrderedDict = field(default_factory=OrderedDict, repr=False)
+    _cache_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
 
     def __getitem__(self, idx: int) -> np.ndarray:
         if type(idx) is not int:
             raise ValueError()
+        with self._cache_lock:
+            sgmt_ndarr = self._cache.get(idx)
+            if sgmt_ndarr is not None:
+                self._cache.move_to_end(idx)
+                return sgmt_ndarr
+
         sgmt = self._sgmt[idx]
-        if sgmt._data is None:
-            self._file.seek(self._sgmt_pos[idx])
-            count = sgmt.shape[0] * sgmt.shape[1]
-            # TODO this does not check for truncated segment, use struct and magic number to check is better
-            sgmt._data = np.fromfile(self._file, dtype="<f4", count=count).reshape(sgmt.n_samples, -1).transpose()
-            
-            if sgmt._data.size != count:
-                raise "Data truncated"
-        return sgmt._data
+        pos = self._sgmt_pos[idx]
+        n_bytes = sgmt.shape[0] * sgmt.shape[1] * 4
+        if pos + n_bytes > self._mmap.size:
+            raise ValueError(f"Segment {idx} of {self.name} is truncated")
+
+        # Samples are stored interleaved (sample-major), so the (n_channels, n_samples) segment
+        # is a strided view of the mapped file, nothing is copied until the caller does so
+        sgmt_ndarr = self._mmap[pos:pos + n_bytes].view("<f4").reshape(sgmt.n_samples, sgmt.shape[0]).T
+
+        with self._cache_lock:
+            self._cache[idx] = sgmt_ndarr
+            if len(self._cache) > _sgmt_cache_size:
+                self._cache.popitem(last=False)
+        return sgmt_ndarr
     
     def __call__(self, idx: int) -> RdaSegment:
         if type(idx) is not int:
@@ -91,8 +133,18 @@ class Rda():
     def __len__(self) -> int:
         return len(self._sgmt_pos)
 
-    def __del__(self):
-        self._file.close()
+    def __getstate__(self):
+        # Pickled by reference to the file, the mapping and the views into it are re-created on load
+        state = self.__dict__.copy()
+        for k in ("_mmap", "_cache", "_cache_lock"):
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._mmap = np.memmap(self.path, dtype="<u1", mode="r")
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
 
 @dataclass
 class ElectrodePlacement():
@@ -100,22 +152,24 @@ class ElectrodePlacement():
     ch_pos: np.ndarray
     ch_names: Tuple[str, ...]
 
-@dataclass
-class Event():
-    event_id: int
-    event_type_id: int
-    event_category_id: int
-    event_kind_id: int
-    start_sec: float
-    duration_sec: float
-    event_name: str
-
 @dataclass
 class EventCategory():
     category_id: int
     category_name: str
     category_desc: str
 
+def _event_dtype(name_len: int = 1) -> np.dtype:
+    # One record per (start) event of the event database, event_name is sized to the longest name
+    return np.dtype([
+        ("event_id", "<i8"),
+        ("event_type_id", "<i8"),
+        ("event_category_id", "<i8"),
+        ("event_kind_id", "<i8"),
+        ("start_sec", "<f8"),
+        ("duration_sec", "<f8"),
+        ("event_name", f"<U{max(name_len, 1)}"),
+    ])
+
 def _case_insensitive_path_join(root: str, dir_re_ptrn: re.Pattern, err_on_fail=True) -> str:
     try:
         return op.join(
@@ -133,13 +187,109 @@ def _case_insensitive_path_join(root: str, dir_re_ptrn: re.Pattern, err_on_fail=
         else:
             return None
 
+def _stat_key(path: str) -> Tuple[int, int]:
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+def _index_sidecar_name(eeg_path: str, rda_path: str | None) -> str:
+    key = eeg_path if rda_path is None else eeg_path + "|" + rda_path
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16] + _index_sidecar_ext
+
+def _open_rda(rda_path: str, sealed: bool, pdel: int, sgmt_pos: Tuple[int, ...], sgmt: Tuple[RdaSegment, ...]) -> Rda:
+    return Rda(
+        name=op.basename(rda_path),
+        path=rda_path,
+        sealed=sealed,
+        pdel=pdel,
+        _mmap=np.memmap(rda_path, dtype="<u1", mode="r"),
+        _sgmt_pos=sgmt_pos,
+        _sgmt=sgmt
+    )
+
+def _read_index_sidecar(index_path: str) -> Dict[str, Any] | None:
+    if not op.isfile(index_path):
+        return None
+    try:
+        with np.load(index_path, allow_pickle=False) as f:
+            if int(f["version"]) != _index_sidecar_version:
+                debug("Index sidecar version mismatch")
+                return None
+
+            eeg_n_channels = int(f["eeg_n_channels"])
+            n_samples_per_rda = int(f["n_samples_per_rda"])
+            bounds = np.concatenate(([0], np.cumsum(f["rda_n_sgmt"]))).tolist()
+            sgmt_pos = f["sgmt_pos"].tolist()
+            sgmt_magic = f["sgmt_magic"].tolist()
+            sgmt_first_sample = f["sgmt_first_sample"].tolist()
+            sgmt_n_samples = f["sgmt_n_samples"].tolist()
+            sgmt_is_closed = f["sgmt_is_closed"].tolist()
+
+            rda = {}
+            for ridx, (name, key, sealed, pdel) in enumerate(zip(f["rda_names"].tolist(), f["rda_keys"].tolist(), f["rda_sealed"].tolist(), f["rda_pdel"].tolist())):
+                lo, hi = bounds[ridx], bounds[ridx + 1]
+                sgmt = tuple(
+                    RdaSegment(
+                        magic=sgmt_magic[i],
+                        first_sample=sgmt_first_sample[i],
+                        n_samples=sgmt_n_samples[i],
+                        is_closed=sgmt_is_closed[i],
+                        shape=(eeg_n_channels, sgmt_n_samples[i])
+                    ) for i in range(lo, hi)
+                )
+                rda[name] = (tuple(key), sealed, pdel, tuple(sgmt_pos[lo:hi]), sgmt)
+
+            ch_names = f["ch_names"].tolist()
+            return {
+                "sdy_key": tuple(f["sdy_key"].tolist()),
+                "hdr_key": tuple(f["hdr_key"].tolist()),
+                "compumedics_header": CompumedicHeader(
+                    ch_names=ch_names,
+                    n_channels=len(ch_names),
+                    sampling_freq=float(f["sampling_freq"])
+                ),
+                "eeg_header": EegHeader(
+                    n_samples_per_rda=None if n_samples_per_rda < 0 else n_samples_per_rda,
+                    n_channels=eeg_n_channels
+                ),
+                "rda": rda
+            }
+    except Exception as e:
+        debug("WARNING: Cannot read index sidecar:", e)
+        return None
+
+def _read_event_sidecar(ev_sidecar_path: str, ev_key: Tuple[int, int]) -> Tuple[np.ndarray, Tuple["EventCategory", ...], Dict[str | int, int | str]] | None:
+    if not op.isfile(ev_sidecar_path):
+        return None
+    try:
+        with np.load(ev_sidecar_path, allow_pickle=False) as f:
+            if int(f["version"]) != _event_sidecar_version:
+                debug("Event sidecar version mismatch")
+                return None
+            if tuple(f["ev_key"].tolist()) != ev_key:
+                debug("Event database changed since the event sidecar was written")
+                return None
+
+            events = f["events"]
+            cat = tuple(
+                EventCategory(category_id=cid, category_name=name, category_desc=desc)
+                for cid, name, desc in zip(f["cat_id"].tolist(), f["cat_name"].tolist(), f["cat_desc"].tolist())
+            )
+            ev_kind = {}
+            for ev_k_id, ev_name in enumerate(f["kind_names"].tolist()):
+                ev_kind[ev_name] = ev_k_id
+                ev_kind[ev_k_id] = ev_name
+            return events, cat, ev_kind
+    except Exception as e:
+        debug("WARNING: Cannot read event sidecar:", e)
+        return None
+
 class Compumedics():
     """
     A exported Compumedics folder 
     """
 
 
-    def __init__(self, path: str, skip_consistency_check = True) -> None:
+    def __init__(self, path: str, skip_consistency_check = True, index_dir: str | None = None, n_workers: int | None = None, load_events: bool = True) -> None:
         """
         Load an exported Compumedics folder
 
@@ -150,23 +300,58 @@ class Compumedics():
         
         skip_consistency_check: bool = True
             Skip consistency checking among headers, should be fine to skip 
+
+        index_dir: str | None = None
+            Directory to keep the index sidecar of the study in
+            The sidecar holds the headers and the segment layout of every .rda file, keyed by their sizes and mtimes,
+            so that re-opening the study does not need to re-parse the headers or walk the .rda files again
+            Only .rda files that are new or changed since the sidecar was written are scanned
+
+        n_workers: int | None = None
+            Number of threads used to scan .rda files and to copy segments out of them
+            None uses min(cpu count, 8), 1 disables threading
+            The result is identical to the serial path
+
+        load_events: bool = True
+            False leaves the events empty without reading the event database (or its sidecar), e.g. for a summary
         """
 
         path = op.abspath(path)
         debug("Start to import", path)
+        self.n_workers = _default_n_workers if n_workers is None else max(int(n_workers), 1)
+        self._executor = None
 
         debug("Checking necessary files...")
         eeg_path, sdy_path, hdr_path, rda_paths = self._check_compulsary_paths(path)
+        self.sdy_path = sdy_path
+        self._sgmt_index = {}
         debug("Checking optional files...")
         elt_plcm_paths, ev_path = self._check_optional_paths(eeg_path)
 
-        debug("Reading Compumedics header (.sdy) file")
-        self.compumedics_header: CompumedicHeader = self._read_cpmd_hdr(sdy_path)
-        debug("Compumedics header file ok")
-        
-        debug("Reading EEG header (eegdata.ini) file...")
-        self.eeg_header: EegHeader = self._read_eeg_hdr(hdr_path)
-        debug("EEG header file ok")
+        index_path = None
+        sidecar = None
+        if index_dir is not None:
+            index_path = op.join(index_dir, _index_sidecar_name(eeg_path, path if path[-4:] == ".rda" else None))
+            debug("Reading index sidecar", index_path)
+            sidecar = _read_index_sidecar(index_path)
+
+        sdy_key = _stat_key(sdy_path)
+        hdr_key = _stat_key(hdr_path)
+        if sidecar is not None and sidecar["sdy_key"] == sdy_key and sidecar["hdr_key"] == hdr_key:
+            debug("Headers loaded from index sidecar")
+            self.compumedics_header: CompumedicHeader = sidecar["compumedics_header"]
+            self.eeg_header: EegHeader = sidecar["eeg_header"]
+        else:
+            # Segment layout depends on the headers, nothing in the sidecar can be reused
+            sidecar = None
+
+            debug("Reading Compumedics header (.sdy) file")
+            self.compumedics_header: CompumedicHeader = self._read_cpmd_hdr(sdy_path)
+            debug("Compumedics header file ok")
+            
+            debug("Reading EEG header (eegdata.ini) file...")
+            self.eeg_header: EegHeader = self._read_eeg_hdr(hdr_path)
+            debug("EEG header file ok")
 
         if skip_consistency_check:
             debug("Consistency check is skipped")
@@ -176,8 +361,26 @@ class Compumedics():
             debug("Headers consistency ok")
 
         debug("Reading .rda file(s)...")
-        self.rda: Tuple[Rda, ...] = tuple(map(self._read_rda_hdr, rda_paths))
-        debug(".rda files loaded lazily")
+        indexed_rda = {} if sidecar is None else sidecar["rda"]
+        rda_keys = tuple(map(_stat_key, rda_paths))
+        rda = [None] * len(rda_paths)
+        stale = []
+        for ridx, (rda_path, rda_key) in enumerate(zip(rda_paths, rda_keys)):
+            indexed = indexed_rda.get(op.basename(rda_path))
+            if indexed is not None and indexed[0] == rda_key:
+                rda[ridx] = _open_rda(rda_path, *indexed[1:])
+            else:
+                stale.append(ridx)
+        # Scanning is a seek + small read per segment, overlap the latency of slow storage across files
+        for ridx, r in zip(stale, self._map(self._read_rda_hdr, [rda_paths[ridx] for ridx in stale])):
+            rda[ridx] = r
+        n_scanned = len(stale)
+        self.rda: Tuple[Rda, ...] = tuple(rda)
+        debug(f".rda files loaded lazily, {n_scanned} file(s) scanned")
+
+        if index_path is not None and (sidecar is None or n_scanned > 0 or len(indexed_rda) != len(rda_paths)):
+            debug("Writing index sidecar", index_path)
+            self._write_index_sidecar(index_path, sdy_key, hdr_key, rda_keys)
         
         if len(elt_plcm_paths) > 0:
             debug("Reading electrode placement file(s)...")
@@ -190,16 +393,85 @@ class Compumedics():
 
             debug("Electrode placement file(s) done")
 
-        if ev_path is not None:
+        self.events: np.ndarray = np.empty(0, dtype=_event_dtype())
+        self.event_category: Tuple[EventCategory, ...] = ()
+        self.event_kind: Dict[str | int, int | str] = {}
+        if ev_path is not None and load_events:
             debug("Reading event database...")
-            self.events, self.event_category, self.event_kind = self._parse_event(ev_path)
+            ev_key = _stat_key(ev_path)
+            ev_sidecar_path = None if index_path is None else index_path[:-len(_index_sidecar_ext)] + _event_sidecar_ext
+            parsed = None if ev_sidecar_path is None else _read_event_sidecar(ev_sidecar_path, ev_key)
+            if parsed is not None:
+                debug("Events loaded from event sidecar")
+            else:
+                parsed = self._parse_event(ev_path)
+                # A failed parse is not persisted, so it is retried the next time the study is opened
+                if parsed is not None and ev_sidecar_path is not None:
+                    debug("Writing event sidecar", ev_sidecar_path)
+                    self._write_event_sidecar(ev_sidecar_path, ev_key, *parsed)
+            if parsed is not None:
+                self.events, self.event_category, self.event_kind = parsed
             debug("Event database done")
 
         debug("Import complete")
-        
-    def export_to_mne_raw(self, link_event: bool | Iterable[int] = True, link_elt_plcm: bool | int | str = "standard_1020", pad_zero: bool = False):
+
+    def __deepcopy__(self, memo):
+        # The reader is read-only after construction, copies of a RawCompumedics can share it
+        # instead of duplicating every memory mapped .rda file
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+    def n_times(self, pad_zero: bool = False) -> int:
         """
-        Export the read data to a MNE RawArray object
+        Number of samples in the merged recording
+        """
+        index = self._get_sgmt_index(pad_zero)
+        if len(index) == 0:
+            return 0
+        return int(index["start"][-1] + index["n_samples"][-1])
+
+    def read_window(self, tmin: float, tmax: float, picks: Iterable[str | int] | None = None, pad_zero: bool = False) -> np.ndarray:
+        """
+        Read the samples between tmin and tmax (in seconds) without merging the whole study
+
+        picks: Iterable[str | int] | None = None
+            Names or indices of the channels to read, all channels if None
+
+        pad_zero: bool = False
+            Same as export_to_mne_raw()
+        """
+        sfreq = self.compumedics_header.sampling_freq
+        return self.read_window_samples(int(round(tmin * sfreq)), int(round(tmax * sfreq)), picks=picks, pad_zero=pad_zero)
+
+    def read_window_samples(self, start: int, stop: int, picks: Iterable[str | int] | None = None, pad_zero: bool = False) -> np.ndarray:
+        """
+        Read samples [start, stop) as a (n_picks, n_samples) float32 array
+        Only the byte ranges of the overlapping segments are touched, and only the picked rows are copied out
+
+        picks: Iterable[str | int] | None = None
+            Names or indices of the channels to read, all channels if None
+
+        pad_zero: bool = False
+            Same as export_to_mne_raw()
+        """
+        start = max(int(start), 0)
+        stop = min(int(stop), self.n_times(pad_zero))
+        if start >= stop:
+            raise ValueError(f"No data in range [{start}, {stop})")
+
+        picks = self._ch_idx(picks)
+        n_out = self.compumedics_header.n_channels if picks is None else len(picks)
+        out = np.empty((n_out, stop - start), dtype="<f4")
+        self._read_sgmt_range(start, stop, out, pad_zero, picks=picks)
+        return out
+
+    def export_to_mne_raw(self, link_event: bool | Iterable[int] = True, link_elt_plcm: bool | int | str = "standard_1020", pad_zero: bool = False, preload: bool = True):
+        """
+        Export the read data to a MNE Raw object
         
         link_event: bool | Iterable[int] = True
             Mark the exported RawArray with data in the event database
@@ -215,6 +487,11 @@ class Compumedics():
 
         pad_zero: bool = False
             Pad zeros when the first sample of a segment does not line up with the last sample of previous segment
+            Padded ranges are marked with BAD_ACQ_SKIP annotations, and are never stored unless the raw is preloaded
+
+        preload: bool = True
+            If False, the returned RawCompumedics object does not hold any sample
+            Samples are read from the .rda files on demand, only segments overlapping the requested range are touched
         """
         def check_channel_belongs_to_montage(ch_name: str, montage: mne.channels.DigMontage | None):
             if montage is None:
@@ -223,9 +500,6 @@ class Compumedics():
                 return ch_name in montage.ch_names
 
         debug("Converting Compumedics files into MNE objects")
-        debug("Loading all .rda segments...")
-        all_sgmt_ndarr = self._merge_all_rda_sgmt(pad_zero=pad_zero)
-        debug("Loaded .rda segments, shape =", all_sgmt_ndarr.shape)
 
         ch_types = []
 
@@ -278,7 +552,7 @@ class Compumedics():
         elif isinstance(link_event, Iterable):
             debug("Only events that belongs to the following category will be linked:", link_event)
             debug("Category name:", [cat.category_name for cat in self.event_category])
-            rel_ev = tuple(filter(lambda e: e.event_category_id in link_event, self.events))
+            rel_ev = self.events[np.isin(self.events["event_category_id"], list(link_event))]
             debug(f"Linking {len(rel_ev)} event(s)")
             event_ndarr = self._make_event_ndarr(rel_ev)
         debug("Event processing ok")
@@ -292,20 +566,26 @@ class Compumedics():
         debug("Info:", mne_info)
 
         ann = None
-        if event_ndarr is not None:
+        if event_ndarr is not None and len(event_ndarr) > 0:
             ann = mne.annotations_from_events(
                 event_ndarr,
                 self.compumedics_header.sampling_freq,
                 event_desc=lambda eid: self.event_kind[eid]
             )
+
+        gap_starts, gap_lens = self._find_gaps(pad_zero)
+        if len(gap_starts) > 0:
+            debug(f"Marking {len(gap_starts)} acquisition gap(s) as BAD_ACQ_SKIP")
+            gap_ann = mne.Annotations(
+                onset=gap_starts / self.compumedics_header.sampling_freq,
+                duration=gap_lens / self.compumedics_header.sampling_freq,
+                description=["BAD_ACQ_SKIP"] * len(gap_starts)
+            )
+            ann = gap_ann if ann is None else ann + gap_ann
         debug("Annotation:", ann)
 
-        raw = mne.io.RawArray(
-            data=all_sgmt_ndarr,
-            info=mne_info
-        )
+        raw = RawCompumedics(self, mne_info, pad_zero=pad_zero, preload=preload)
 
-        mne.add_reference_channels(raw, "ref")
         raw.set_montage(montage)
         if ann is not None:
             raw.set_annotations(ann)
@@ -421,24 +701,17 @@ class Compumedics():
     # TODO this function assume the file encoding have sizeof(char) = 1, which may or may not be true universally 
     def _read_rda_hdr(self, rda_path: str):
         debug(f"Opening .rda file: {rda_path}")
-        file = open(rda_path, "rb")
-        sealed = struct.unpack_from("<?", file.read(1))[0]
-        pdel = struct.unpack_from("<l", file.read(4))[0]
-        # Unused
-        file.seek(file.tell() + 95)
-
-        debug("Reading .rda segments...")
-        sgmt_pos, sgmt = self._read_all_rda_sgmt(file)
-        debug(f"Read {len(sgmt)} segment(s), n_samples:", list(map(lambda s: s.n_samples, sgmt)))
-
-        return Rda(
-            name=op.basename(rda_path),
-            sealed=sealed,
-            pdel=pdel,
-            _file=file,
-            _sgmt_pos=sgmt_pos,
-            _sgmt=sgmt
-        )
+        with open(rda_path, "rb") as file:
+            sealed = struct.unpack_from("<?", file.read(1))[0]
+            pdel = struct.unpack_from("<l", file.read(4))[0]
+            # Unused
+            file.seek(file.tell() + 95)
+
+            debug("Reading .rda segments...")
+            sgmt_pos, sgmt = self._read_all_rda_sgmt(file)
+            debug(f"Read {len(sgmt)} segment(s), n_samples:", list(map(lambda s: s.n_samples, sgmt)))
+
+        return _open_rda(rda_path, sealed, pdel, tuple(sgmt_pos), tuple(sgmt))
         
     # after the end of the segment, -1L (the magic number) will appear, and then the first_sample, n_samples, closed, and 175 bytes of padding
     def _read_all_rda_sgmt(self, file: BufferedReader) -> Tuple[Tuple[int, ...], Tuple[RdaSegment, ...]]:
@@ -464,8 +737,7 @@ class Compumedics():
                     first_sample=first_sample,
                     n_samples=n_samples,
                     is_closed=is_closed,
-                    shape=shape,
-                    _data=None
+                    shape=shape
                 )
             )
             
@@ -474,6 +746,58 @@ class Compumedics():
         
         return sgmt_pos, sgmt
 
+    def _write_index_sidecar(self, index_path: str, sdy_key: Tuple[int, int], hdr_key: Tuple[int, int], rda_keys: Tuple[Tuple[int, int], ...]):
+        sgmt = [s for r in self.rda for s in r._sgmt]
+        n_samples_per_rda = self.eeg_header.n_samples_per_rda
+        try:
+            os.makedirs(op.dirname(index_path), exist_ok=True)
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as file:
+                np.savez(
+                    file,
+                    version=_index_sidecar_version,
+                    sdy_key=np.array(sdy_key, dtype="<i8"),
+                    hdr_key=np.array(hdr_key, dtype="<i8"),
+                    ch_names=np.array(self.compumedics_header.ch_names, dtype=str),
+                    sampling_freq=self.compumedics_header.sampling_freq,
+                    n_samples_per_rda=-1 if n_samples_per_rda is None else n_samples_per_rda,
+                    eeg_n_channels=self.eeg_header.n_channels,
+                    rda_names=np.array([r.name for r in self.rda], dtype=str),
+                    rda_keys=np.array(rda_keys, dtype="<i8").reshape(-1, 2),
+                    rda_sealed=np.array([r.sealed for r in self.rda], dtype=bool),
+                    rda_pdel=np.array([r.pdel for r in self.rda], dtype="<i8"),
+                    rda_n_sgmt=np.array([len(r) for r in self.rda], dtype="<i8"),
+                    sgmt_pos=np.array([p for r in self.rda for p in r._sgmt_pos], dtype="<i8"),
+                    sgmt_magic=np.array([s.magic for s in sgmt], dtype="<i8"),
+                    sgmt_first_sample=np.array([s.first_sample for s in sgmt], dtype="<i8"),
+                    sgmt_n_samples=np.array([s.n_samples for s in sgmt], dtype="<i8"),
+                    sgmt_is_closed=np.array([s.is_closed for s in sgmt], dtype=bool),
+                )
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            # The sidecar is only an accelerator
+            debug("WARNING: Cannot write index sidecar:", e)
+
+    def _write_event_sidecar(self, ev_sidecar_path: str, ev_key: Tuple[int, int], events: np.ndarray, cat: Tuple[EventCategory, ...], ev_kind: Dict[str | int, int | str]):
+        try:
+            os.makedirs(op.dirname(ev_sidecar_path), exist_ok=True)
+            tmp_path = f"{ev_sidecar_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as file:
+                np.savez(
+                    file,
+                    version=_event_sidecar_version,
+                    ev_key=np.array(ev_key, dtype="<i8"),
+                    events=events,
+                    # ev_kind maps both ways, only the names (in id order) are kept
+                    kind_names=np.array([ev_kind[i] for i in range(len(ev_kind) // 2)], dtype=str),
+                    cat_id=np.array([c.category_id for c in cat], dtype="<i8"),
+                    cat_name=np.array(["" if c.category_name is None else c.category_name for c in cat], dtype=str),
+                    cat_desc=np.array(["" if c.category_desc is None else c.category_desc for c in cat], dtype=str),
+                )
+            os.replace(tmp_path, ev_sidecar_path)
+        except OSError as e:
+            debug("WARNING: Cannot write event sidecar:", e)
+
     def _read_elt_plcm(self, elt_plcm_path: str):
         try:
             debug("Reading electrode placement file:", elt_plcm_path)
@@ -512,11 +836,12 @@ class Compumedics():
             debug(e)
             return None
 
-    def _parse_event(self, ev_path: str) -> Tuple[Tuple[Event, ...], Tuple[EventCategory, ...], Dict[str | int, int | str]]:
-        def parse_time(ev_table: DefaultDict[Any, list], col_common_name: str, row: int):
-            hi = col_common_name + "Hi"
-            lo = col_common_name + "Lo"
-            return ((ev_table[hi][row] << 32) + ctypes.c_uint32(ev_table[lo][row]).value) / 1_000_000_000
+    def _parse_event(self, ev_path: str) -> Tuple[np.ndarray, Tuple[EventCategory, ...], Dict[str | int, int | str]] | None:
+        def parse_time(ev_table: DefaultDict[Any, list], col_common_name: str, keep: np.ndarray) -> np.ndarray:
+            hi = np.asarray(ev_table[col_common_name + "Hi"], dtype="<i8")[keep]
+            # Lo is stored as a signed 32 bits integer, reinterpret it as unsigned
+            lo = np.asarray(ev_table[col_common_name + "Lo"], dtype="<i8")[keep] & 0xFFFFFFFF
+            return ((hi << 32) + lo) / 1_000_000_000
 
         try:
             debug("Parsing event database", ev_path)
@@ -525,27 +850,29 @@ class Compumedics():
 
             debug("Processing EEGEvent")
             ev_table = db.parse_table("EEGEvent")
-            ev = []
+            keep = np.invert(np.asarray(ev_table["IsEndEvent"], dtype=bool))
+            ev_names = np.asarray(ev_table["EventString"], dtype=str)[keep]
+
             # FIXME probably somewhere in the eventdb?
+            # Kind ids are given in order of first appearance
+            uniq_names, first_idx, inverse = np.unique(ev_names, return_index=True, return_inverse=True)
+            order = np.argsort(first_idx, kind="stable")
+            rank = np.empty(len(order), dtype="<i8")
+            rank[order] = np.arange(len(order))
             ev_kind = {}
-            for row in np.nditer(np.where(np.invert(np.array(ev_table["IsEndEvent"])))):
-                ev_name = ev_table["EventString"][row]
-                if ev_name not in ev_kind.keys():
-                    ev_k_id = len(ev_kind)
-                    ev_kind[ev_name] = ev_k_id
-                    ev_kind[ev_k_id] = ev_name
-                else:
-                    ev_k_id = ev_kind[ev_name]
-                ev.append(Event(
-                    event_id=ev_table["EventID"][row],
-                    event_type_id=ev_table["EventTypeID"][row],
-                    event_category_id=ev_table["EventCategoryID"][row],
-                    event_kind_id=ev_k_id,
-                    start_sec=parse_time(ev_table, "StartSecond", row),
-                    duration_sec=parse_time(ev_table, "Duration", row),
-                    event_name=ev_table["EventString"][row]
-                ))
-            debug(f"Found {len(ev)} event(s), {len(ev_kind)} unique name(s)")
+            for ev_k_id, ev_name in enumerate(uniq_names[order].tolist()):
+                ev_kind[ev_name] = ev_k_id
+                ev_kind[ev_k_id] = ev_name
+
+            ev = np.empty(len(ev_names), dtype=_event_dtype(max(map(len, uniq_names.tolist()), default=1)))
+            ev["event_id"] = np.asarray(ev_table["EventID"], dtype="<i8")[keep]
+            ev["event_type_id"] = np.asarray(ev_table["EventTypeID"], dtype="<i8")[keep]
+            ev["event_category_id"] = np.asarray(ev_table["EventCategoryID"], dtype="<i8")[keep]
+            ev["event_kind_id"] = rank[inverse.reshape(-1)]
+            ev["start_sec"] = parse_time(ev_table, "StartSecond", keep)
+            ev["duration_sec"] = parse_time(ev_table, "Duration", keep)
+            ev["event_name"] = ev_names
+            debug(f"Found {len(ev)} event(s), {len(uniq_names)} unique name(s)")
 
             debug("Processing EEGEventCategory")
             cat_table = db.parse_table("EEGEventCategory")
@@ -560,34 +887,108 @@ class Compumedics():
                 )
             debug(f"Found {len(cat)} event categories")
 
-            return tuple(ev), tuple(cat), ev_kind
+            return ev, tuple(cat), ev_kind
         except Exception as e:
             debug("ERROR occured when processing event database:")
             debug(e)
             debug(e.args)
-            return (), (), {}
+            return None
 
-    def _merge_all_rda_sgmt(self, pad_zero: bool) -> np.ndarray:
-        all_sgmt = []
+    def _merge_all_rda_sgmt(self, pad_zero: bool, dtype: np.dtype | str = "<f4") -> np.ndarray:
+        # The final shape is known from the segment index, so the output is allocated once and filled in place
+        # Samples keep the float32 of the .rda files unless another dtype is asked for
+        n_times = self.n_times(pad_zero)
+        all_sgmt_ndarr = np.empty((self.eeg_header.n_channels, n_times), dtype=dtype)
+        self._read_sgmt_range(0, n_times, all_sgmt_ndarr, pad_zero)
+        return all_sgmt_ndarr
+
+    def _find_gaps(self, pad_zero: bool) -> Tuple[np.ndarray, np.ndarray]:
+        # Start and length (in samples of the merged recording) of the zero-filled gaps
+        # Without padding segments are butted together, so there is no gap
+        index = self._get_sgmt_index(pad_zero)
+        if not pad_zero or len(index) == 0:
+            return np.empty(0, dtype="<i8"), np.empty(0, dtype="<i8")
+        sgmt_stops = index["start"] + index["n_samples"]
+        gap_starts = np.concatenate(([0], sgmt_stops[:-1]))
+        gap_lens = index["start"] - gap_starts
+        is_gap = gap_lens > 0
+        return gap_starts[is_gap], gap_lens[is_gap]
+
+    def _get_sgmt_index(self, pad_zero: bool) -> np.ndarray:
+        index = self._sgmt_index.get(pad_zero)
+        if index is not None:
+            return index
+
+        index = np.empty(sum(map(len, self.rda)), dtype=_sgmt_index_dtype)
+        i = 0
         n_sample_merged = 0
         for ridx, r in enumerate(self.rda):
             for sidx in range(len(r)):
                 sgmt = r(sidx)
-                sgmt_ndarr = r[sidx]
+                # Acquisition gaps are only kept when padding, otherwise segments are butted together
                 if sgmt.first_sample > n_sample_merged and pad_zero:
-                    debug(f"Padding 0s at time index [{n_sample_merged}, {sgmt.first_sample}]")
-                    all_sgmt.append(
-                        np.zeros(
-                            (
-                                self.compumedics_header.n_channels,
-                                sgmt.first_sample - n_sample_merged
-                            )
-                        )
-                    )
                     n_sample_merged = sgmt.first_sample
-                all_sgmt.append(sgmt_ndarr)
+                index[i] = (ridx, sidx, sgmt.first_sample, n_sample_merged, sgmt.n_samples)
                 n_sample_merged += sgmt.n_samples
-        return np.concatenate(all_sgmt, axis=1)
+                i += 1
+
+        self._sgmt_index[pad_zero] = index
+        return index
+
+    def _read_sgmt_range(self, start: int, stop: int, out: np.ndarray, pad_zero: bool, picks: np.ndarray | None = None):
+        # Fill out[:, :stop - start] with samples [start, stop) of the merged recording
+        # Only the segments overlapping the range are read, gaps are filled with zeros
+        index = self._get_sgmt_index(pad_zero)
+        sgmt_starts = index["start"]
+        rows = slice(None) if picks is None else picks
+
+        # Last segment starting at or before `start`
+        first = max(int(np.searchsorted(sgmt_starts, start, side="right")) - 1, 0)
+        filled = start
+        copies = []
+        for i in range(first, len(index)):
+            sgmt_start = int(sgmt_starts[i])
+            if sgmt_start >= stop:
+                break
+            lo = max(sgmt_start, start)
+            hi = min(sgmt_start + int(index["n_samples"][i]), stop)
+            if lo >= hi:
+                continue
+            if lo > filled:
+                out[:, filled - start:lo - start] = 0
+            copies.append((int(index["rda"][i]), int(index["sgmt"][i]), lo, hi, sgmt_start))
+            filled = hi
+        if filled < stop:
+            out[:, filled - start:stop - start] = 0
+
+        def copy_sgmt(c):
+            ridx, sidx, lo, hi, sgmt_start = c
+            out[:, lo - start:hi - start] = self.rda[ridx][sidx][rows, lo - sgmt_start:hi - sgmt_start]
+
+        # Every segment lands in its own slice of out, small reads are not worth the thread hand-off
+        if out.shape[0] * (stop - start) < _parallel_read_min_size:
+            for c in copies:
+                copy_sgmt(c)
+        else:
+            for _ in self._map(copy_sgmt, copies):
+                pass
+
+    def _map(self, func, items):
+        # Ordered map over the worker threads of this reader
+        items = list(items)
+        if self.n_workers == 1 or len(items) < 2:
+            return list(map(func, items))
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.n_workers, thread_name_prefix="compumedics")
+        return list(self._executor.map(func, items))
+
+    def _ch_idx(self, picks: Iterable[str | int] | None) -> np.ndarray | None:
+        if picks is None:
+            return None
+        if isinstance(picks, (str, int)):
+            picks = (picks,)
+        ch_names = self.compumedics_header.ch_names
+        return np.array([ch_names.index(p) if isinstance(p, str) else int(p) for p in picks], dtype=int)
 
     def _make_dig_montage(self, idx=0):
         elt_plcm = self.electrode_placements[idx]
@@ -619,14 +1020,44 @@ class Compumedics():
 
         return montage
     
-    def _make_event_ndarr(self, event: Tuple[Event]):
-        # print(event)
+    def _make_event_ndarr(self, event: np.ndarray):
         event_ndarr = np.zeros((len(event), 3))
-        for eidx, ev in enumerate(event):
-            event_ndarr[eidx][0] = ev.start_sec * self.compumedics_header.sampling_freq
-            event_ndarr[eidx][2] = ev.event_kind_id
+        event_ndarr[:, 0] = event["start_sec"] * self.compumedics_header.sampling_freq
+        event_ndarr[:, 2] = event["event_kind_id"]
         return event_ndarr
 
+class RawCompumedics(BaseRaw):
+    """
+    MNE Raw object reading its samples from the .rda files of a Compumedics study
+    Use Compumedics.export_to_mne_raw() to create one
+    """
+
+    def __init__(self, compumedics: Compumedics, info: mne.Info, pad_zero: bool = False, preload: bool = False, verbose=None):
+        super().__init__(
+            info,
+            preload=preload,
+            first_samps=(0,),
+            last_samps=(compumedics.n_times(pad_zero) - 1,),
+            filenames=(compumedics.sdy_path,),
+            raw_extras=[{"reader": compumedics, "pad_zero": pad_zero}],
+            orig_format="single",
+            verbose=verbose
+        )
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        extras = self._raw_extras[fi]
+        reader: Compumedics = extras["reader"]
+        n_channels = reader.compumedics_header.n_channels
+        # idx holds every channel needed by the request (or by its projector), read only those rows
+        picks = np.arange(n_channels)[idx]
+        if len(picks) == n_channels:
+            picks = None
+            block = np.empty((n_channels, stop - start), dtype="<f4")
+        else:
+            block = np.empty((len(picks), stop - start), dtype="<f4")
+        reader._read_sgmt_range(start, stop, block, extras["pad_zero"], picks=picks)
+        _mult_cal_one(data, block, slice(None), cals, mult)
+
 if __name__ == "__main__":
     # c = Compumedics("ainudin\\data\\Export-#1430_2484_2023-11-20_14-28-18.eeg\\Export-#1430_2484_2023-11-20_14-28-18.sdy")
     # r = mne.io.read_raw("C:\\Users\\Puah Jia Hong\\Desktop\\gra\\patient\\ainudin\\data\\Ainudin.edf",encoding="latin1", preload=True)
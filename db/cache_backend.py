@@ -0,0 +1,349 @@
+"""
+Pluggable cache backends shared by the worker processes
+
+Every backend maps a str key to a python object, with an optional time to live (seconds, 0 = never expire)
+Objects are serialized with pickle protocol 5, array buffers are shipped out-of-band as raw bytes
+"""
+
+import os
+import time
+import struct
+import pickle
+import hashlib
+import threading
+from typing import Any, Dict, List, Iterable
+
+try:
+    import pymemcache
+    from pymemcache.client.hash import HashClient
+except ImportError:
+    pymemcache = None
+
+_SER_MAGIC = b"GNS1"
+_SER_HDR = struct.Struct("<4sIQ")
+# Buffers are aligned so that arrays deserialized in place are aligned too
+_SER_ALIGN = 64
+
+# Default item size limit of memcached
+_MEMCACHED_ITEM_LIMIT = 1 << 20
+# Room left in every item for the key and memcached's own item header
+_MEMCACHED_ITEM_OVERHEAD = 1 << 10
+_MEMCACHED_INLINE = b"GNC0"
+_MEMCACHED_CHUNKED = b"GNC1"
+_MEMCACHED_CHUNK_HDR = struct.Struct("<4sQI16s")
+# memcached treats expire times longer than 30 days as unix timestamps
+_MEMCACHED_MAX_RELATIVE_EXPIRE = 30 * 24 * 60 * 60
+
+_DISK_HDR = struct.Struct("<d")
+
+def _align(n: int) -> int:
+    return (n + _SER_ALIGN - 1) // _SER_ALIGN * _SER_ALIGN
+
+def serialize(obj) -> bytearray:
+    """
+    Serialize obj into a single buffer
+
+    Contiguous arrays are not pickled element-wise, their memory is copied once into the output as-is
+    """
+    buffers = []
+    pkl = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    raws = [b.raw() for b in buffers]
+
+    hdr_len = _SER_HDR.size + 8 * len(raws)
+    offset = _align(hdr_len + len(pkl))
+    offsets = []
+    for raw in raws:
+        offsets.append(offset)
+        offset = _align(offset + raw.nbytes)
+
+    out = bytearray(offset)
+    _SER_HDR.pack_into(out, 0, _SER_MAGIC, len(raws), len(pkl))
+    struct.pack_into(f"<{len(raws)}Q", out, _SER_HDR.size, *(raw.nbytes for raw in raws))
+    out[hdr_len:hdr_len + len(pkl)] = pkl
+    for raw, off in zip(raws, offsets):
+        out[off:off + raw.nbytes] = raw
+    return out
+
+def deserialize(data: bytes | bytearray) -> Any:
+    """
+    Inverse of serialize()
+
+    Arrays are views of data, so data is copied first if it is not writable
+    """
+    if not isinstance(data, bytearray):
+        data = bytearray(data)
+    mv = memoryview(data)
+    magic, n_buffers, pkl_len = _SER_HDR.unpack_from(mv, 0)
+    if magic != _SER_MAGIC:
+        raise ValueError("Not a serialized cache item")
+    lens = struct.unpack_from(f"<{n_buffers}Q", mv, _SER_HDR.size)
+    hdr_len = _SER_HDR.size + 8 * n_buffers
+
+    buffers = []
+    offset = _align(hdr_len + pkl_len)
+    for n in lens:
+        buffers.append(mv[offset:offset + n])
+        offset = _align(offset + n)
+    return pickle.loads(mv[hdr_len:hdr_len + pkl_len], buffers=buffers)
+
+def _hash_key(key: str) -> str:
+    # memcached keys are limited to 250 bytes without spaces, file names should not get too long either
+    return "genii:" + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+class CacheBackend():
+    """
+    Interface of a cache backend
+    """
+
+    def get(self, key: str, default=None) -> Any:
+        raise NotImplementedError()
+
+    def set(self, key: str, val: Any, expire: int = 0):
+        """
+        key: str
+            Any str, backends derive their own storage key from it
+
+        expire: int = 0
+            Time to live in seconds, 0 never expires
+        """
+        raise NotImplementedError()
+
+    def delete(self, key: str) -> bool:
+        raise NotImplementedError()
+
+class InProcessBackend(CacheBackend):
+    """
+    Objects are kept as-is in a dict, only shared between the threads of one process
+    """
+
+    def __init__(self):
+        self._items: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default=None) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            expire_at, val = item
+            if expire_at and expire_at < time.time():
+                del self._items[key]
+                return default
+            return val
+
+    def set(self, key: str, val: Any, expire: int = 0):
+        with self._lock:
+            self._items[key] = (time.time() + expire if expire else 0, val)
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._items.pop(key, None) is not None
+
+class DiskBackend(CacheBackend):
+    """
+    One serialized file per key in a local directory, shared by the processes of one machine
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, _hash_key(key)[len("genii:"):] + ".gnc")
+
+    def get(self, key: str, default=None) -> Any:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                expire_at, = _DISK_HDR.unpack(f.read(_DISK_HDR.size))
+                if expire_at and expire_at < time.time():
+                    f.close()
+                    self.delete(key)
+                    return default
+                data = bytearray(os.fstat(f.fileno()).st_size - _DISK_HDR.size)
+                f.readinto(data)
+        except (OSError, struct.error):
+            return default
+        return deserialize(data)
+
+    def set(self, key: str, val: Any, expire: int = 0):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_DISK_HDR.pack(time.time() + expire if expire else 0))
+            f.write(serialize(val))
+        # Readers see either the old or the new item, never half of it
+        os.replace(tmp_path, path)
+
+    def delete(self, key: str) -> bool:
+        try:
+            os.remove(self._path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+class InProcessMemcachedClient():
+    """
+    Stand-in for a pymemcache client when no memcached server is available
+
+    Only holds bytes, enforces the item size limit and the expire time like memcached does,
+    but is not shared between processes
+    """
+
+    def __init__(self, item_size_limit: int = _MEMCACHED_ITEM_LIMIT):
+        self.item_size_limit = item_size_limit
+        self._items: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def _expire_at(self, expire: int) -> float:
+        if not expire:
+            return 0
+        return expire if expire > _MEMCACHED_MAX_RELATIVE_EXPIRE else time.time() + expire
+
+    def get(self, key: str, default=None, **kwargs) -> bytes | None:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            expire_at, val = item
+            if expire_at and expire_at < time.time():
+                del self._items[key]
+                return default
+            return val
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, bytes]:
+        out = {}
+        for key in keys:
+            val = self.get(key)
+            if val is not None:
+                out[key] = val
+        return out
+
+    def set(self, key: str, value: bytes, expire: int = 0, noreply=None, **kwargs) -> bool:
+        if len(key) + len(value) > self.item_size_limit:
+            # SERVER_ERROR object too large for cache
+            return False
+        with self._lock:
+            self._items[key] = (self._expire_at(expire), bytes(value))
+        return True
+
+    def set_many(self, values: Dict[str, bytes], expire: int = 0, noreply=None, **kwargs) -> List[str]:
+        return [key for key, value in values.items() if not self.set(key, value, expire)]
+
+    def delete(self, key: str, noreply=None, **kwargs) -> bool:
+        with self._lock:
+            return self._items.pop(key, None) is not None
+
+class MemcachedBackend(CacheBackend):
+    """
+    Cache on memcached (or anything speaking its protocol through a pymemcache-like client)
+
+    Values larger than the item size limit are split into chunks under their own keys,
+    the item under the key itself then only tells where the chunks are
+    """
+
+    def __init__(self, client, item_size_limit: int = _MEMCACHED_ITEM_LIMIT):
+        self.client = client
+        self.chunk_size = item_size_limit - _MEMCACHED_ITEM_OVERHEAD
+
+    def get(self, key: str, default=None) -> Any:
+        hkey = _hash_key(key)
+        head = self.client.get(hkey)
+        if head is None:
+            return default
+        head = bytes(head)
+
+        if head[:4] == _MEMCACHED_INLINE:
+            return deserialize(bytearray(head[4:]))
+
+        magic, total_len, n_chunks, token = _MEMCACHED_CHUNK_HDR.unpack_from(head)
+        if magic != _MEMCACHED_CHUNKED:
+            return default
+        chunk_keys = [f"{hkey}:{token.hex()}:{i}" for i in range(n_chunks)]
+        chunks = self.client.get_many(chunk_keys)
+        # Chunks are evicted independently of the head
+        if len(chunks) != n_chunks:
+            return default
+        data = bytearray(total_len)
+        offset = 0
+        for k in chunk_keys:
+            chunk = chunks[k]
+            data[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        if offset != total_len:
+            return default
+        return deserialize(data)
+
+    def set(self, key: str, val: Any, expire: int = 0):
+        hkey = _hash_key(key)
+        data = serialize(val)
+
+        if len(data) + len(_MEMCACHED_INLINE) <= self.chunk_size:
+            self.client.set(hkey, _MEMCACHED_INLINE + bytes(data), expire=expire)
+            return
+
+        # Every version of the value gets its own chunk keys, a reader never mixes chunks of two versions
+        token = os.urandom(16)
+        mv = memoryview(data)
+        chunks = {
+            f"{hkey}:{token.hex()}:{i}": bytes(mv[offset:offset + self.chunk_size])
+            for i, offset in enumerate(range(0, len(data), self.chunk_size))
+        }
+        failed = self.client.set_many(chunks, expire=expire)
+        if failed:
+            raise RuntimeError(f"Cannot store {len(failed)} chunk(s) of {key}")
+        # The head goes last, so that it never points to chunks that are not there yet
+        self.client.set(hkey, _MEMCACHED_CHUNK_HDR.pack(_MEMCACHED_CHUNKED, len(data), len(chunks), token), expire=expire)
+
+    def delete(self, key: str) -> bool:
+        # Orphaned chunks are left to memcached's LRU
+        return bool(self.client.delete(_hash_key(key), noreply=False))
+
+def _make_memcached_client(servers: str):
+    if pymemcache is None:
+        raise ImportError("pymemcache is not installed")
+    servers = [s.strip() for s in servers.split(",") if s.strip()]
+    if len(servers) == 1:
+        client = pymemcache.Client(servers[0], connect_timeout=1, timeout=5)
+    else:
+        client = HashClient(servers, connect_timeout=1, timeout=5)
+    client.set("genii:online", b"1")
+    return client
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend() -> CacheBackend | None:
+    """
+    The cache backend shared by the worker processes, selected by the environment
+
+    GENII_CACHE_BACKEND
+        "" or "none" (default): no shared cache
+        "memory": InProcessBackend
+        "disk": DiskBackend in GENII_CACHE_DISK_DIR (default uploaded_files/__NEUROII_SHARED)
+        "memcached": MemcachedBackend on GENII_MEMCACHED_SERVERS (default 127.0.0.1:11211, comma separated)
+            falls back to InProcessMemcachedClient if the servers cannot be reached
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            return _backend or None
+
+        kind = os.environ.get("GENII_CACHE_BACKEND", "none").lower()
+        if kind in ("", "none"):
+            _backend = False
+        elif kind == "memory":
+            _backend = InProcessBackend()
+        elif kind == "disk":
+            _backend = DiskBackend(os.environ.get("GENII_CACHE_DISK_DIR", os.path.join("uploaded_files", "__NEUROII_SHARED")))
+        elif kind == "memcached":
+            try:
+                client = _make_memcached_client(os.environ.get("GENII_MEMCACHED_SERVERS", "127.0.0.1:11211"))
+            except Exception as e:
+                print("WARNING: Memcached not reachable:", e)
+                print("WARNING: Using an in-process stand-in, objects are not shared with other processes")
+                client = InProcessMemcachedClient()
+            _backend = MemcachedBackend(client)
+        else:
+            raise ValueError(f"Unknown GENII_CACHE_BACKEND '{kind}'")
+        return _backend or None
@@ -0,0 +1,255 @@
+"""
+Garbage collection of the disk cache
+
+    <root>/<user id>/__NEUROII_CACHE    private copies, journals and refs of a user, Compumedics index sidecars
+    <root>/__NEUROII_CACHE              derived products shared by every user (see memcached_util.derived_item_path())
+    DiskBackend root                    objects shared by the worker processes (GENII_CACHE_BACKEND=disk)
+
+A cached item is a disk copy together with its journal, ref and lock (same name plus _JOURNAL_EXT / _REF_EXT / LOCK_EXT),
+its last access is the newest mtime among them (memcached_util touches copies when it opens them)
+Items are removed, least recently used first, when
+    they were not accessed for GENII_CACHE_TTL_SEC (default 3 hours, same as file_io.expire)
+    the private items of a user exceed GENII_CACHE_USER_QUOTA_BYTES (default 20 GiB)
+    all items exceed GENII_CACHE_TOTAL_QUOTA_BYTES (default 200 GiB)
+Items are removed while holding their exclusive lock (see db.file_lock), an item locked by anyone is skipped
+Objects in the memory cache of this process are never removed, and their copies are touched on every sweep,
+so an object kept open by any worker process (each runs a sweeper) stays fresh
+A removed item is re-opened from the original file the next time it is needed, unsaved edits in it are lost
+
+    python -m db.cache_gc report|sweep [root]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Any
+
+from .memcached_util import _CACHE_DIR, _JOURNAL_EXT, _REF_EXT, _CONTENT_HASH_MEMO, pinned_cache_paths
+from .cache_backend import get_backend, DiskBackend
+from .file_lock import FileLock, LOCK_EXT
+
+_CACHE_TTL_SEC = float(os.environ.get("GENII_CACHE_TTL_SEC", 3 * 60 * 60))
+_USER_QUOTA_BYTES = int(os.environ.get("GENII_CACHE_USER_QUOTA_BYTES", 20 << 30))
+_TOTAL_QUOTA_BYTES = int(os.environ.get("GENII_CACHE_TOTAL_QUOTA_BYTES", 200 << 30))
+_SWEEP_INTERVAL_SEC = float(os.environ.get("GENII_CACHE_SWEEP_SEC", 10 * 60))
+# Temporary files of interrupted writes (tmp*, *.tmp, *.old) are only removed once they are this old
+_STALE_TMP_SEC = 60 * 60
+# Users allowed to see the usage report and purge the cache, comma separated ids, nobody unless it is set
+_ADMIN_IDS = tuple(i.strip() for i in os.environ.get("GENII_ADMIN_IDS", "").split(",") if i.strip())
+# Owner of the items that do not belong to a user
+_SHARED_OWNER = "shared"
+
+@dataclass
+class _CacheItem():
+    owner: str
+    # Path of the disk copy, whether or not it exists (an item can be a journal alone)
+    path: str
+    # Disk copy first, then its sidecars
+    paths: List[str]
+    n_bytes: int
+    last_access: float
+    in_use: bool = False
+
+def _path_stat(path: str):
+    # Size and mtime of a file, or of a directory (GENII) and everything in it
+    # The mtime of a directory changes whenever it is written or touched, the files in it are never touched
+    st = os.stat(path)
+    if not os.path.isdir(path):
+        return st.st_size, st.st_mtime
+    n_bytes = 0
+    for dir_path, _, names in os.walk(path):
+        for name in names:
+            n_bytes += os.stat(os.path.join(dir_path, name)).st_size
+    return n_bytes, st.st_mtime
+
+def _is_tmp(name: str) -> bool:
+    return name.startswith("tmp") or name.endswith((".tmp", ".old"))
+
+def _item_name(name: str) -> str:
+    for ext in (_JOURNAL_EXT, _REF_EXT, LOCK_EXT):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+def _scan_dir(cache_dir: str, owner: str, now: float, stale: List[str]) -> List[_CacheItem]:
+    items: Dict[str, _CacheItem] = {}
+    try:
+        names = os.listdir(cache_dir)
+    except FileNotFoundError:
+        return []
+    for name in sorted(names):
+        path = os.path.join(cache_dir, name)
+        try:
+            n_bytes, mtime = _path_stat(path)
+        except OSError:
+            # Removed while scanning
+            continue
+        if _item_name(name) == _CONTENT_HASH_MEMO:
+            continue
+        if _is_tmp(name):
+            if now - mtime > _STALE_TMP_SEC:
+                stale.append(path)
+            continue
+        item_name = _item_name(name)
+        item = items.get(item_name)
+        if item is None:
+            item = items[item_name] = _CacheItem(owner, os.path.join(cache_dir, item_name), [], 0, 0)
+        if name == item_name:
+            item.paths.insert(0, path)
+        else:
+            item.paths.append(path)
+        item.n_bytes += n_bytes
+        item.last_access = max(item.last_access, mtime)
+    return list(items.values())
+
+def _shared_dirs(root: str) -> List[str]:
+    dirs = [os.path.join(root, _CACHE_DIR)]
+    backend = get_backend()
+    if isinstance(backend, DiskBackend):
+        dirs.append(backend.root)
+    return dirs
+
+def scan_cache(root: str, stale: List[str] | None = None) -> List[_CacheItem]:
+    """
+    Every cached item under root (the directory holding the working directories of the users)
+
+    stale: List[str] | None = None
+        Filled with leftovers of interrupted writes that can be removed
+    """
+    now = time.time()
+    stale = [] if stale is None else stale
+    items = []
+    for name in sorted(os.listdir(root)):
+        cache_dir = os.path.join(root, name, _CACHE_DIR)
+        if name != _CACHE_DIR and os.path.isdir(cache_dir):
+            items.extend(_scan_dir(cache_dir, name, now, stale))
+    for cache_dir in _shared_dirs(root):
+        items.extend(_scan_dir(cache_dir, _SHARED_OWNER, now, stale))
+    return items
+
+def _remove(path: str) -> bool:
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def sweep_cache(root: str) -> Dict[str, Any]:
+    """
+    Enforce the TTL and the quotas once, returns what was removed
+    """
+    now = time.time()
+    pinned = set(os.path.realpath(p) for p in pinned_cache_paths())
+    for path in pinned:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    stale = []
+    items = scan_cache(root, stale)
+    for path in stale:
+        _remove(path)
+
+    removed: List[_CacheItem] = []
+    def evict(item: _CacheItem) -> bool:
+        try:
+            with FileLock(item.path, blocking=False):
+                # The lock file is created by taking the lock if there was none
+                for path in set(item.paths + [item.path + LOCK_EXT]):
+                    _remove(path)
+        except BlockingIOError:
+            # Being read or written right now, so not stale
+            return False
+        removed.append(item)
+        return True
+
+    kept = []
+    for item in sorted(items, key=lambda i: i.last_access):
+        if os.path.realpath(item.path) in pinned:
+            item.in_use = True
+            kept.append(item)
+        elif not (now - item.last_access > _CACHE_TTL_SEC and evict(item)):
+            kept.append(item)
+
+    user_bytes: Dict[str, int] = {}
+    for item in kept:
+        user_bytes[item.owner] = user_bytes.get(item.owner, 0) + item.n_bytes
+    total_bytes = sum(user_bytes.values())
+
+    for item in kept:
+        if item.in_use:
+            continue
+        over_user = item.owner != _SHARED_OWNER and user_bytes[item.owner] > _USER_QUOTA_BYTES
+        if (over_user or total_bytes > _TOTAL_QUOTA_BYTES) and evict(item):
+            user_bytes[item.owner] -= item.n_bytes
+            total_bytes -= item.n_bytes
+
+    return {
+        "removed_items": len(removed),
+        "removed_bytes": sum(i.n_bytes for i in removed),
+        "removed_tmp": len(stale),
+        "total_bytes": total_bytes,
+    }
+
+def usage_report(root: str) -> Dict[str, Any]:
+    """
+    Cache usage per user (and of the shared items), for the admin
+    """
+    now = time.time()
+    users: Dict[str, Dict[str, Any]] = {}
+    for item in scan_cache(root):
+        u = users.setdefault(item.owner, {"bytes": 0, "items": 0, "oldest_access_sec": 0., "newest_access_sec": None})
+        u["bytes"] += item.n_bytes
+        u["items"] += 1
+        age = round(now - item.last_access, 1)
+        u["oldest_access_sec"] = max(u["oldest_access_sec"], age)
+        u["newest_access_sec"] = age if u["newest_access_sec"] is None else min(u["newest_access_sec"], age)
+    return {
+        "total_bytes": sum(u["bytes"] for u in users.values()),
+        "ttl_sec": _CACHE_TTL_SEC,
+        "user_quota_bytes": _USER_QUOTA_BYTES,
+        "total_quota_bytes": _TOTAL_QUOTA_BYTES,
+        "users": users,
+    }
+
+def is_admin(user_id) -> bool:
+    return str(user_id) in _ADMIN_IDS
+
+def _sweep_loop(root: str):
+    while True:
+        try:
+            result = sweep_cache(root)
+            if result["removed_items"] > 0 or result["removed_tmp"] > 0:
+                print("Cache sweep:", result)
+        except Exception as e:
+            print("WARNING: Cache sweep failed:", e)
+        time.sleep(_SWEEP_INTERVAL_SEC)
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+def start_sweeper(root: str):
+    """
+    Sweep the cache under root every GENII_CACHE_SWEEP_SEC on a daemon thread, once per process
+    """
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=_sweep_loop, args=(root,), name="cache-sweeper", daemon=True)
+            _sweeper.start()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("report", "sweep"):
+        print("Usage: python -m db.cache_gc report|sweep [root]")
+        sys.exit(1)
+    root = sys.argv[2] if len(sys.argv) > 2 else "uploaded_files"
+    result = usage_report(root) if sys.argv[1] == "report" else sweep_cache(root)
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,131 @@
+"""
+Reader/writer locks on cached items, shared by the threads of a process and by the worker processes
+
+The lock of an item is an flock() on a small file next to it (same name plus LOCK_EXT)
+    shared      opening the disk copy and replaying the journal
+    exclusive   saving the disk copy, appending to / truncating the journal, removing the item
+Every acquire by a thread opens the lock file again, flock() locks belong to the open file, so threads of one process
+exclude each other the same way processes do
+A thread already holding the lock of an item takes it again without waiting (nested get / flush paths),
+an exclusive lock inside a shared one of the same thread can not be granted and raises RuntimeError
+On Windows msvcrt.locking() is used instead of flock(), it only has exclusive locks, shared locks are exclusive there
+"""
+
+import os
+import time
+import threading
+from typing import Dict, List
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+LOCK_EXT = ".lock"
+# msvcrt.locking() can not wait, a held lock is tried again after this long
+_WINDOWS_RETRY_SEC = 0.01
+
+class FileLock():
+    """
+    with FileLock(path, shared=True): ...
+
+    path: str
+        Path of the cached item, the lock file is path + LOCK_EXT
+
+    shared: bool = False
+        Any number of shared holders, or one exclusive holder
+
+    blocking: bool = True
+        Raise BlockingIOError instead of waiting when the lock is held
+    """
+
+    def __init__(self, path: str, shared: bool = False, blocking: bool = True):
+        self.lock_path = path + LOCK_EXT
+        self.shared = shared
+        self.blocking = blocking
+        self._held = None
+
+    def __enter__(self):
+        key = os.path.realpath(self.lock_path)
+        held = _held_locks().get(key)
+        if held is not None:
+            # [fd, shared, count] of the outer lock of this thread
+            if held[1] and not self.shared:
+                raise RuntimeError(f"{self.lock_path} is held shared by this thread, it can not be taken exclusive")
+            held[2] += 1
+            self._held = key
+            return self
+
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        while True:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                _lock(fd, self.shared, self.blocking, self.lock_path)
+                # The lock file is removed together with its item (see cache_gc),
+                # a lock taken on a file that was unlinked meanwhile protects nothing
+                if os.fstat(fd).st_ino == os.stat(self.lock_path).st_ino:
+                    _held_locks()[key] = [fd, self.shared, 1]
+                    self._held = key
+                    return self
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._held is None:
+            return
+        locks = _held_locks()
+        held = locks[self._held]
+        held[2] -= 1
+        if held[2] == 0:
+            del locks[self._held]
+            _unlock(held[0])
+            os.close(held[0])
+        self._held = None
+
+_local = threading.local()
+
+def _forget_held_locks():
+    # A forked child does not hold the locks of its parent, the lock files it inherited belong to the parent
+    global _local
+    _local = threading.local()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_held_locks)
+
+def _held_locks() -> Dict[str, List]:
+    # Locks held by the calling thread, by realpath of their lock file
+    locks = getattr(_local, "locks", None)
+    if locks is None:
+        locks = _local.locks = {}
+    return locks
+
+def _lock(fd: int, shared: bool, blocking: bool, lock_path: str):
+    if fcntl is not None:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        fcntl.flock(fd, flags if blocking else flags | fcntl.LOCK_NB)
+        return
+    # Windows: the first byte of the file stands for the whole lock
+    while True:
+        try:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return
+        except OSError:
+            if not blocking:
+                raise BlockingIOError(f"{lock_path} is locked")
+        time.sleep(_WINDOWS_RETRY_SEC)
+
+def _unlock(fd: int):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        return
+    os.lseek(fd, 0, os.SEEK_SET)
+    msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
@@ -1,49 +1,214 @@
-from dataclasses import dataclass
-from typing import Tuple
+from dataclasses import dataclass, field
+from typing import Tuple, List, Any
+from collections import OrderedDict
 from .data_structure import File
+from .cache_backend import get_backend
+from .file_lock import FileLock
+from genii_format import GENII_EXT, is_file_backed, current_genii, commit_genii, remove_genii
 import os
+import json
+import time
+import hashlib
+import atexit
+import threading
+import numpy as np
 from flask import g, abort
 import mne
 
 # HACK current strategy: make a copy of original file instead of proper caching
 _CACHE_DIR = "__NEUROII_CACHE"
+# Budget of the in-memory object cache, shared by every user of this process
+_MEM_CACHE_BYTES = int(os.environ.get("GENII_MEM_CACHE_BYTES", 4 << 30))
+# Rough size of everything that is not sample data (info, annotations, python objects)
+_MEM_CACHE_OVERHEAD = 64 << 10
+# Edits are written to the disk copy once the object has not changed for this long
+_FLUSH_DEBOUNCE_SEC = float(os.environ.get("GENII_CACHE_DEBOUNCE_SEC", 2))
+_JOURNAL_EXT = ".journal.jsonl"
+# Journaled changes of how an object is shown (see file_io.apply_edit()), its samples and data edits are left alone
+DISPLAY_EDITS = ("display",)
+# The journal is folded into a full save of the disk copy once it grows past this, or its oldest edit is this old
+_JOURNAL_COMPACT_BYTES = 64 << 10
+_JOURNAL_COMPACT_SEC = float(os.environ.get("GENII_JOURNAL_COMPACT_SEC", 7 * 24 * 60 * 60))
+# Points a private cache entry to a read-only copy in the shared cache dir
+_REF_EXT = ".ref.json"
+_CONTENT_HASH_MEMO = "content_hash.json"
+# Files larger than this are hashed from blocks spread over them (head and tail included), a study can be tens of GB
+_CONTENT_HASH_BLOCK = 64 << 10
+_CONTENT_HASH_N_BLOCKS = 64
+# Budget of preloaded sample data per user, within _MEM_CACHE_BYTES
+# Disk-backed objects do not count, they are only preloaded for operations that need every sample
+_USER_PRELOAD_BYTES = int(os.environ.get("GENII_USER_PRELOAD_BYTES", 1 << 30))
 
-# In development env without memcached running, fallback to sqlite3 in memory database
-# try:
-#     import pymemcache
-#     client = pymemcache.Client('localhost:11211', serde=pymemcache.serde.pickle_serde)
-#     client.set("online", True)
-
-# except:
-#     import sqlite3
-#     import pickle
-#     class Client():
-#         def __init__(self):
-#             print("WARNING: Memcached not setup. Using Sqlite3 as fallback, this is not thread-safe, not memory efficient and should not be used in production")
-#             # HACK This is not thread safe, do not use in production
-#             self.con = sqlite3.connect(":memory:", check_same_thread=False)
-#             self.con.cursor().execute("CREATE TABLE cache_table (key TEXT PRIMARY KEY, val BLOB);")
-#         def get(self, key, default=None, **kwargs):
-#             cur = self.con.cursor()
-#             query = "SELECT val FROM cache_table where key = ?"
-#             cur.execute(query, (key, ))
-#             try:
-#                 return pickle.loads(cur.fetchone()[0])
-#             except:
-#                 return default
-            
-#         def set(self, key, val, **kwargs):
-#             cur = self.con.cursor()
-#             b = pickle.dumps(val)
-#             if self.get(key) is not None:
-#                 query = "UPDATE cache_table SET val = ? WHERE key = ?"
-#                 params = (b, key)
-#             else:
-#                 query = "INSERT INTO cache_table(key, val) values(?, ?)"
-#                 params = (key, b)
-#             cur.execute(query, params)
-
-#     client = Client()
+@dataclass
+class _CacheEntry():
+    file: File
+    n_bytes: int
+    disk_path: str
+    mem_key: Tuple[Any, str]
+    # True if the disk copy (or the original file when there is no disk copy) matches the object in memory
+    saved: bool = True
+    # Unsaved edits are written by the flusher once the entry has not changed for _FLUSH_DEBOUNCE_SEC,
+    # other unsaved entries (clean objects with an outdated disk copy) wait for eviction or an explicit flush
+    due: bool = False
+    # The object still has to be put into the shared backend
+    share: bool = False
+    # Read-only copy in the shared cache dir the object is saved as instead of disk_path
+    # Only set for objects that are fully determined by the content of the original file and their state
+    shared_path: str | None = None
+    state: dict | None = None
+    expire: int = 0
+    # Version of the object in the shared backend this entry was read from or written to
+    version: str | None = None
+    # Bumped on every change, a flush only marks the entry saved if nothing changed while it was written
+    generation: int = 0
+    changed_at: float = 0
+    removed: bool = False
+    flush_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+class _ObjectCache():
+    """
+    LRU of opened File objects, bounded by the total size of their sample data
+
+    Keyed by (user id, realpath), views of an object (see put_view_item()) by (user id, realpath, state tag)
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries: OrderedDict[Tuple[Any, str], _CacheEntry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> _CacheEntry | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, file: File, disk_path: str, dirty: bool = False, has_disk_copy: bool = False, share: bool = False, expire: int = 0, version: str | None = None, shared_path: str | None = None, state: dict | None = None) -> Tuple[_CacheEntry, List[_CacheEntry]]:
+        # The entry of a key is updated in place, so that there is only ever one flush in progress per disk copy
+        # Returns the entry and the evicted entries, the caller writes back the unsaved ones outside of the lock
+        evicted = []
+        n_bytes = _estimate_n_bytes(file.item)
+        with self._lock:
+            entry = self._entries.get(key)
+            # Re-caching the object an entry already holds (every render does) leaves its disk copy as current as it was
+            replaced = entry is None or entry.file.item is not file.item or entry.state != state
+            if entry is None:
+                entry = _CacheEntry(file=file, n_bytes=0, disk_path=disk_path, mem_key=key, version=version)
+                self._entries[key] = entry
+            else:
+                self._entries.move_to_end(key)
+            self.n_bytes += n_bytes - entry.n_bytes
+            entry.file = file
+            entry.n_bytes = n_bytes
+            entry.expire = expire
+            entry.shared_path = shared_path
+            entry.state = state
+            if dirty:
+                entry.saved = False
+                entry.due = True
+            elif has_disk_copy and replaced:
+                entry.saved = False
+            entry.share = entry.share or share
+            entry.generation += 1
+            entry.changed_at = time.monotonic()
+
+            # The newest entry is always kept, even if it alone is over budget
+            while self.n_bytes > self.max_bytes and len(self._entries) > 1:
+                _, e = self._entries.popitem(last=False)
+                self.n_bytes -= e.n_bytes
+                evicted.append(e)
+        return entry, evicted
+
+    def touch(self, key, compact: bool = False, share: bool = False) -> bool:
+        # Record a journaled edit, returns True if the flusher has something to do for the entry
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            # Copy on write, the edit is private to the user, so is every later save of the object
+            entry.shared_path = None
+            if compact:
+                entry.saved = False
+                entry.due = True
+            entry.share = entry.share or share
+            if compact or share:
+                entry.generation += 1
+                entry.changed_at = time.monotonic()
+            return entry.due or entry.share
+
+    def resize(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                n_bytes = _estimate_n_bytes(entry.file.item)
+                self.n_bytes += n_bytes - entry.n_bytes
+                entry.n_bytes = n_bytes
+
+    def make_room(self, user_id, n_bytes: int, max_bytes: int, keep_key=None) -> List[_CacheEntry]:
+        # Drop the least recently used preloaded entries of a user until n_bytes more fit into max_bytes
+        # Returns the dropped entries, the caller writes back the unsaved ones outside of the lock
+        evicted = []
+        with self._lock:
+            mine = [
+                e for k, e in self._entries.items()
+                if k[0] == user_id and k != keep_key and e.n_bytes > _MEM_CACHE_OVERHEAD
+            ]
+            used = sum(e.n_bytes for e in mine)
+            for e in mine:
+                if used + n_bytes <= max_bytes:
+                    break
+                del self._entries[e.mem_key]
+                self.n_bytes -= e.n_bytes
+                used -= e.n_bytes
+                evicted.append(e)
+        return evicted
+
+    def pop_views(self, key) -> List[_CacheEntry]:
+        # Every view (see put_view_item()) of the object of key
+        with self._lock:
+            keys = [k for k in self._entries if len(k) == 3 and k[:2] == key]
+            entries = [self._entries.pop(k) for k in keys]
+            self.n_bytes -= sum(e.n_bytes for e in entries)
+            return entries
+
+    def pop(self, key) -> _CacheEntry | None:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.n_bytes -= entry.n_bytes
+            return entry
+
+    def pending(self, changed_before: float | None = None) -> List[_CacheEntry]:
+        # Entries with something to write, only the ones not changed since changed_before if given
+        with self._lock:
+            if changed_before is None:
+                return [e for e in self._entries.values() if not e.saved or e.share]
+            return [e for e in self._entries.values() if (e.due or e.share) and e.changed_at <= changed_before]
+
+_object_cache = _ObjectCache(_MEM_CACHE_BYTES)
+
+def _estimate_n_bytes(item) -> int:
+    n_bytes = _MEM_CACHE_OVERHEAD
+    for attr in ("_data", "data"):
+        data = getattr(item, attr, None)
+        # Memory mapped samples are backed by their file, the OS can drop them at any time
+        if isinstance(data, np.ndarray) and not is_file_backed(data):
+            n_bytes += data.nbytes
+            break
+    return n_bytes
+
+def _mem_cache_key(key):
+    return g.user_data["id"], os.path.realpath(key)
+
+def _shared_cache_key(mem_key):
+    # The object and a small version stamp are kept under separate keys,
+    # so that checking whether the local copy is still current does not transfer the object
+    user_id, real_path = mem_key
+    key = f"{user_id}|{real_path}"
+    return key, key + "|v"
 
 # FIXME duplicated function
 def validate_access(path):
@@ -59,56 +224,648 @@ def get_cached_item(key, default=None) -> File:
     # HACK
     validate_access(key)
 
-    cached_item_path = os.path.join(
-        g.user_data["wd"],
-        _CACHE_DIR,
-        _generate_cached_item_name(os.path.basename(key))
-    )
+    mem_key = _mem_cache_key(key)
+    backend = get_backend()
+    shared_key, stamp_key = _shared_cache_key(mem_key)
+    entry = _object_cache.get(mem_key)
+    if entry is not None:
+        if backend is None:
+            return entry.file
+        stamp = backend.get(stamp_key)
+        # Local edits that are not flushed yet win over the shared copy
+        if stamp is None or stamp == entry.version or entry.due or entry.share:
+            return entry.file
+        # Changed by another worker process
+        _object_cache.pop(mem_key)
 
-    if os.path.exists(cached_item_path) and os.path.isfile(cached_item_path):
-        from file_io import _open_file_without_caching
-        return _open_file_without_caching(cached_item_path)
-    return default
-    # return client.get(key, default)
+    cached_item_path = _cached_item_path(key)
 
-def set_cache_item(key, val: File, expire=0):
-    # HACK
-    # check cache dir exist
+    if backend is not None:
+        version = backend.get(stamp_key)
+        file = None if version is None else backend.get(shared_key)
+        if file is not None:
+            # Edits journaled after the object was shipped are not in it, replaying is idempotent
+            with FileLock(cached_item_path, shared=True):
+                _replay_journal(cached_item_path, file)
+            # Whoever put it in the shared backend took care of the disk copy
+            _write_back(_object_cache.put(mem_key, file, cached_item_path, version=version)[1])
+            return file
+
+    from file_io import _open_file_without_caching
+    file = None
+    shared_path = state = None
+    # The copy and the journal must be read together, a flush saves one and truncates the other
+    with FileLock(cached_item_path, shared=True):
+        if _copy_exists(cached_item_path):
+            _touch(cached_item_path)
+            file = _open_file_without_caching(cached_item_path)
+            file.path = key
+            _replay_journal(cached_item_path, file)
+        else:
+            ref = _read_ref(cached_item_path)
+            if ref is not None:
+                shared_path, state = ref
+                _touch(cached_item_path + _REF_EXT)
+                _touch(shared_path)
+                with FileLock(shared_path, shared=True):
+                    file = _open_file_without_caching(shared_path)
+                file.path = key
+                if state is not None:
+                    file.item.info["temp"] = {"state": state}
+                # Edited since, the shared copy is only the base of the private journal
+                if _replay_journal(cached_item_path, file) > 0:
+                    shared_path = None
+    if file is None:
+        return default
+    # Outside of the lock, writing back evicted entries takes their locks
+    _write_back(_object_cache.put(mem_key, file, cached_item_path, shared_path=shared_path, state=state)[1])
+    return file
+
+def peek_cached_item(key) -> File | None:
+    """
+    The cached object of key if it is already in memory, nothing is opened or loaded otherwise
+    """
+    validate_access(key)
+    entry = _object_cache.get(_mem_cache_key(key))
+    return None if entry is None else entry.file
+
+def cached_copy_path(key) -> str | None:
+    """
+    Path of the newest saved copy of the cached object of key (private or shared), None if there is none
+
+    Edits still in the journal are not in the copy
+    """
+    cached_item_path = _cached_item_path(key)
+    if _copy_exists(cached_item_path):
+        return cached_item_path
+    ref = _read_ref(cached_item_path)
+    return None if ref is None else ref[0]
+
+def reserve_preload(key, n_bytes: int):
+    """
+    Make room in the preload budget of the user for n_bytes of sample data of key
+
+    Least recently used preloaded objects of the user are written back and dropped from memory,
+    they are opened again (disk-backed) the next time they are used
+
+    Raises MemoryError if n_bytes alone is over the budget
+    """
+    if n_bytes > _USER_PRELOAD_BYTES:
+        raise MemoryError(
+            f"{os.path.basename(key)} needs {n_bytes / (1 << 20):.0f} MiB in memory, "
+            f"the limit is {_USER_PRELOAD_BYTES / (1 << 20):.0f} MiB per user (GENII_USER_PRELOAD_BYTES)"
+        )
+    mem_key = _mem_cache_key(key)
+    _write_back(_object_cache.make_room(mem_key[0], n_bytes, _USER_PRELOAD_BYTES, keep_key=mem_key))
+
+def refresh_cached_size(key):
+    # The sample data of a cached object was loaded or dropped in place
+    _object_cache.resize(_mem_cache_key(key))
+
+def get_cache_dir():
     cache_dir = os.path.join(g.user_data["wd"], _CACHE_DIR)
     if not os.path.isdir(cache_dir):
         os.mkdir(cache_dir)
-    
+    return cache_dir
+
+def set_cache_item(key, val: File, expire=0, shared_path=None, state=None, journaled=False):
+    """
+    shared_path: str | None = None
+        For dirty objects: see derived_item_path(), the object is saved there (once for every user) instead of the private cache dir
+        Clean objects keep the shared copy of their previous version
+
+    state: dict | None = None
+        The processing state of a shared object, restored into info["temp"] when it is re-opened
+
+    journaled: bool = False
+        val is the original file with its journal replayed (see replay_cache_journal()), the journal stays the record
+        of its edits, it is only saved (and the journal compacted) once the journal is due, see _journal_due()
+    """
+    cached_item_path = _cached_item_path(key)
+    mem_key = _mem_cache_key(key)
+    dirty = val.dirty
+    if dirty and journaled:
+        dirty = _journal_due(cached_item_path + _JOURNAL_EXT)
+    if not val.dirty:
+        entry = _object_cache.get(mem_key)
+        shared_path, state = (None, None) if entry is None else (entry.shared_path, entry.state)
+
+    # The disk copy is only written when it is needed:
+    # edits of dirty objects are written behind by the flusher (see flush_cache()),
+    # clean objects are written back on eviction if a (now outdated) disk copy exists,
+    # otherwise the original file is still a valid copy of them
+    share = False
+    backend = get_backend()
+    if backend is not None:
+        # Clean objects are re-cached on every render, they are only shipped if no other worker has them yet
+        share = dirty or backend.get(_shared_cache_key(mem_key)[1]) is None
+
+    entry, evicted = _object_cache.put(
+        mem_key,
+        val,
+        cached_item_path,
+        dirty=dirty,
+        has_disk_copy=_copy_exists(cached_item_path) or os.path.isfile(cached_item_path + _REF_EXT),
+        share=share,
+        expire=expire,
+        shared_path=shared_path,
+        state=state
+    )
+    if entry.due or entry.share:
+        _start_flusher()
+    _write_back(evicted)
+
+def flush_cache(key=None, fsync=False) -> int:
+    """
+    Write the pending changes of cached objects now, instead of waiting for the flusher
+
+    key: str | None = None
+        Path of the file to flush, every cached object (of every user) if None
+
+    fsync: bool = False
+        Also wait until the written disk copies reach the storage device
+
+    Returns the number of objects written
+    """
+    if key is None:
+        entries = _object_cache.pending()
+    else:
+        validate_access(key)
+        entry = _object_cache.get(_mem_cache_key(key))
+        entries = [] if entry is None else [entry]
+    return sum(_flush_entry(e, fsync) for e in entries)
+
+def _flush_entry(entry: _CacheEntry, fsync=False) -> bool:
+    with entry.flush_lock:
+        with _object_cache._lock:
+            if entry.removed:
+                return False
+            generation = entry.generation
+            # Every edit journaled before this point is in the object about to be saved
+            journal_mark = time.time_ns()
+            file = entry.file
+            shared_path = entry.shared_path
+            state = entry.state
+            need_save = not entry.saved
+            need_share = entry.share
+        if not (need_save or need_share):
+            return False
+
+        if need_save and shared_path is not None:
+            # Shared copies are never overwritten, whoever saves first saves it for everyone
+            with FileLock(shared_path):
+                if not _copy_exists(shared_path):
+                    _save_cached_item(file, shared_path, fsync)
+            with FileLock(entry.disk_path):
+                _write_ref(entry.disk_path, shared_path, state)
+                _remove_cached_copy(entry.disk_path)
+        elif need_save:
+            with FileLock(entry.disk_path):
+                _save_cached_item(file, entry.disk_path, fsync)
+                _truncate_journal(entry.disk_path, journal_mark)
+                if os.path.isfile(entry.disk_path + _REF_EXT):
+                    os.remove(entry.disk_path + _REF_EXT)
+        version = _put_shared_item(entry.mem_key, file, entry.expire) if need_share else entry.version
+
+        with _object_cache._lock:
+            entry.version = version
+            # Changed while being written, the flusher will pick it up again
+            if entry.generation == generation:
+                entry.saved = True
+                entry.due = False
+                entry.share = False
+        return True
+
+def journal_cache_item(key, op: dict):
+    """
+    Append an edit, already applied to the cached object, to the journal of the cached item
+
+    The journal is replayed (see file_io.apply_edit()) whenever the object is re-opened from its disk copy
+    or its original file, so the edit survives eviction and restarts without saving the whole object
+    Edits must be idempotent, as a journal may be replayed onto an object that already contains some of them
+
+    op: dict
+        JSON serializable, the kind of edit is in op["op"]
+    """
+    validate_access(key)
+    cached_item_path = _cached_item_path(key)
+    journal_path = cached_item_path + _JOURNAL_EXT
+    line = json.dumps({"ts": time.time_ns(), **op})
+    with FileLock(cached_item_path):
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+        with open(journal_path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+        compact = _journal_due(journal_path)
+    if _object_cache.touch(_mem_cache_key(key), compact=compact, share=get_backend() is not None):
+        _start_flusher()
+
+def _journal_due(journal_path) -> bool:
+    # Big or old enough to be folded into a full save of the disk copy
+    try:
+        if os.path.getsize(journal_path) > _JOURNAL_COMPACT_BYTES:
+            return True
+        with open(journal_path, "r", encoding="utf-8") as f:
+            oldest = json.loads(f.readline())["ts"]
+    except (OSError, ValueError, KeyError):
+        return False
+    return time.time_ns() - oldest > _JOURNAL_COMPACT_SEC * 1e9
+
+def replay_cache_journal(key, file: File) -> int:
+    """
+    Replay the journal of the cached item onto file, freshly opened from the original file
+    """
+    cached_item_path = _cached_item_path(key)
+    with FileLock(cached_item_path, shared=True):
+        return _replay_journal(cached_item_path, file)
+
+def read_cache_journal(key) -> List[dict]:
+    """
+    The edits in the journal of the cached item, oldest first, without opening the object
+    """
+    cached_item_path = _cached_item_path(key)
+    with FileLock(cached_item_path, shared=True):
+        return _read_journal(cached_item_path)
+
+def _read_journal(cached_item_path) -> List[dict]:
+    # The caller holds the lock of the cached item
+    journal_path = cached_item_path + _JOURNAL_EXT
+    if not os.path.isfile(journal_path):
+        return []
+    with open(journal_path, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    ops = []
+    for line in lines:
+        try:
+            ops.append(json.loads(line))
+        except ValueError:
+            # Torn last line of a crashed append
+            continue
+    return ops
+
+def _replay_journal(cached_item_path, file: File) -> int:
+    # The caller holds the lock of the cached item, returns the number of data edits (not DISPLAY_EDITS) replayed
+    from file_io import apply_edit
+    n_edits = 0
+    for op in _read_journal(cached_item_path):
+        apply_edit(file.item, op)
+        n_edits += op["op"] not in DISPLAY_EDITS
+    if n_edits > 0:
+        file.dirty = True
+    return n_edits
+
+def _truncate_journal(cached_item_path, before_ns: int):
+    # Drop the edits that are now part of the disk copy, the caller holds the exclusive lock of the cached item
+    journal_path = cached_item_path + _JOURNAL_EXT
+    if not os.path.isfile(journal_path):
+        return
+    with open(journal_path, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    keep = []
+    for line in lines:
+        try:
+            if json.loads(line)["ts"] > before_ns:
+                keep.append(line)
+        except (ValueError, KeyError):
+            pass
+    if len(keep) == 0:
+        os.remove(journal_path)
+        return
+    tmp_path = f"{journal_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(keep) + "\n")
+    os.replace(tmp_path, journal_path)
+
+def _flush_loop():
+    while True:
+        time.sleep(_FLUSH_DEBOUNCE_SEC / 2)
+        for entry in _object_cache.pending(time.monotonic() - _FLUSH_DEBOUNCE_SEC):
+            try:
+                _flush_entry(entry)
+            except Exception as e:
+                print("WARNING: Cannot write cached item", entry.disk_path, e)
+                # Retry after another debounce window instead of spinning on a persistent error
+                entry.changed_at = time.monotonic()
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+def _start_flusher():
+    global _flusher
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name="cache-flusher", daemon=True)
+            _flusher.start()
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush_cache()
+    except Exception as e:
+        print("WARNING: Cannot flush cache at exit:", e)
+
+def _put_shared_item(mem_key, val: File, expire=0) -> str | None:
+    backend = get_backend()
+    if backend is None:
+        return None
+    shared_key, stamp_key = _shared_cache_key(mem_key)
+    try:
+        version = os.urandom(8).hex()
+        backend.set(shared_key, val, expire=expire)
+        backend.set(stamp_key, version, expire=expire)
+        return version
+    except Exception as e:
+        # The shared backend is only an accelerator, the local copy is still valid
+        print("WARNING: Cannot put item into the shared cache:", e)
+        backend.delete(stamp_key)
+        return None
+
+def _save_cached_item(val: File, cached_item_path, fsync=False):
+    # Runs on the flusher thread or while serving another user, so nothing here may depend on g
+    # cached_item_path was validated when the entry was created, the caller holds its exclusive lock
+    cache_dir, name = os.path.split(cached_item_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    if name.endswith(GENII_EXT):
+        # A new version next to the current one, readers keep opening the current one until it is complete
+        commit_genii(val.item, cached_item_path, fsync)
+        return
+    # The temporary name keeps the ending, MNE picks the format from it
+    tmp_path = os.path.join(cache_dir, f"tmp{os.getpid()}-{threading.get_ident()}-{name}")
+    val.item.save(tmp_path, overwrite=True)
+    if fsync:
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, cached_item_path)
+
+def _touch(path):
+    # Last access of a disk copy is its mtime, see cache_gc
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def pinned_cache_paths() -> List[str]:
+    """
+    Disk copies (private and shared) of the objects in the memory cache of this process
+
+    They are in use, cache_gc never removes them
+    """
+    with _object_cache._lock:
+        entries = list(_object_cache._entries.values())
+    paths = []
+    for entry in entries:
+        paths.append(entry.disk_path)
+        if entry.shared_path is not None:
+            paths.append(entry.shared_path)
+    return paths
+
+def _copy_exists(cached_item_path) -> bool:
+    # A GENII directory exists as soon as its first version is being written, it can be opened once one is complete
+    if cached_item_path.endswith(GENII_EXT):
+        return current_genii(cached_item_path) is not None
+    return os.path.isfile(cached_item_path)
+
+def _remove_cached_copy(cached_item_path) -> bool:
+    if os.path.isdir(cached_item_path):
+        remove_genii(cached_item_path)
+        return True
+    if os.path.isfile(cached_item_path):
+        os.remove(cached_item_path)
+        return True
+    return False
+
+def _write_ref(cached_item_path, shared_path, state):
+    os.makedirs(os.path.dirname(cached_item_path), exist_ok=True)
+    tmp_path = f"{cached_item_path}{_REF_EXT}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"shared": os.path.basename(shared_path), "state": state}, f)
+    os.replace(tmp_path, cached_item_path + _REF_EXT)
+
+def _read_ref(cached_item_path):
+    # (shared path, state) of the shared copy a private entry points to, None if there is none (anymore)
+    try:
+        with open(cached_item_path + _REF_EXT, "r", encoding="utf-8") as f:
+            ref = json.load(f)
+    except (OSError, ValueError):
+        return None
+    shared_path = os.path.join(_shared_cache_dir(), ref["shared"])
+    if not _copy_exists(shared_path):
+        return None
+    return shared_path, ref.get("state")
+
+def _write_back(evicted: List[_CacheEntry]):
+    for entry in evicted:
+        try:
+            _flush_entry(entry)
+        except Exception as e:
+            print("WARNING: Cannot write back evicted item", entry.disk_path, e)
+
+def _cached_item_path(key):
     # make a copy to cache dir with generated name
-    cached_item_path = os.path.join(
+    return os.path.join(
         g.user_data["wd"],
         _CACHE_DIR,
-        _generate_cached_item_name(os.path.basename(key))
+        _generate_cached_item_name(key)
     )
-    
-    from file_io import save_mne_object
-    save_mne_object(val.item, cached_item_path)
 
-    # register cache existance?
+def _shared_cache_dir():
+    # Next to the working directories of the users, outside of all of them
+    return os.path.join(os.path.dirname(os.path.realpath(g.user_data["wd"])), _CACHE_DIR)
+
+def has_private_edits(key) -> bool:
+    """
+    Whether the cached object of key may hold edits of the user (journal or private disk copy)
+
+    A journal of DISPLAY_EDITS only does not count, the samples are the same for everyone
+    """
+    cached_item_path = _cached_item_path(key)
+    if _copy_exists(cached_item_path):
+        return True
+    return any(op["op"] not in DISPLAY_EDITS for op in read_cache_journal(key))
+
+def _state_tag(state: dict | None) -> str:
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+def _view_cache_key(key, state: dict | None):
+    # Views of a file are kept next to its object, keyed by their processing state (None: as opened)
+    return *_mem_cache_key(key), _state_tag(state)
+
+def put_view_item(key, file: File, state: dict | None):
+    """
+    Keep file, the object of key processed into state, in memory to switch back to later (see workflow.general._alter_view())
 
-    # client.set(key, val, expire=expire)
+    Views share the memory budget with the other cached objects and are dropped least recently used first,
+    they are never written to disk (the current view of a file is, as its cached object)
+    file must not be changed afterwards, processing starts from a copy of it
+
+    state: dict | None
+        None for the object as it was opened
+    """
+    validate_access(key)
+    _write_back(_object_cache.put(_view_cache_key(key, state), file, _cached_item_path(key))[1])
+    # Views are preloaded more often than not, they count against the preload budget of the user like the rest
+    mem_key = _mem_cache_key(key)
+    _write_back(_object_cache.make_room(mem_key[0], 0, _USER_PRELOAD_BYTES, keep_key=mem_key))
+
+def get_view_item(key, state: dict | None, pop: bool = False) -> File | None:
+    """
+    The view of key in state kept by put_view_item(), None if it was dropped (or never kept)
+
+    pop: bool = False
+        Take it out of the view cache, e.g. to make it the cached object of key
+    """
+    validate_access(key)
+    view_key = _view_cache_key(key, state)
+    entry = _object_cache.pop(view_key) if pop else _object_cache.get(view_key)
+    return None if entry is None else entry.file
+
+def derived_item_path(key, state: dict, ext: str) -> str | None:
+    """
+    Path of the shared, read-only copy of the original file of key processed into state
+
+    The name is made of the content hash of the original file and a hash of state,
+    so identical recordings processed the same way share one copy, across users
+    None if the cached object holds edits of the user, it can not be shared then
+
+    ext: str
+        Ending of the file name, e.g. .genii
+    """
+    if has_private_edits(key):
+        return None
+    return os.path.join(_shared_cache_dir(), f"{content_hash(key)[:32]}-{_state_tag(state)}{ext}")
+
+def private_derived_item_path(key, state: dict, ext: str) -> str:
+    """
+    Same as derived_item_path(), in the private cache dir of the user, for objects holding edits of the user
+    """
+    name = hashlib.sha1(os.path.realpath(key).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(g.user_data["wd"], _CACHE_DIR, f"{name}-{_state_tag(state)}{ext}")
+
+def open_derived_item(key, shared_path: str, state: dict) -> File | None:
+    from file_io import _open_file_without_caching
+    with FileLock(shared_path, shared=True):
+        if not _copy_exists(shared_path):
+            return None
+        _touch(shared_path)
+        file = _open_file_without_caching(shared_path)
+    file.path = key
+    file.dirty = True
+    file.item.info["temp"] = {"state": state}
+    return file
+
+_content_hash_memo = None
+_content_hash_lock = threading.Lock()
+
+def _content_files(real_path):
+    # A Compumedics study is the whole exported folder
+    if real_path[-4:] in (".sdy", ".eeg", ".rda"):
+        root = real_path if os.path.isdir(real_path) else os.path.dirname(real_path)
+        if real_path[-4:] == ".rda":
+            root = os.path.dirname(root)
+        files = []
+        for dir_path, dirs, names in os.walk(root):
+            dirs.sort()
+            files.extend(os.path.join(dir_path, n) for n in sorted(names))
+        return root, files
+    return os.path.dirname(real_path), [real_path]
+
+def _sampled_digest(path, size: int, mtime_ns: int) -> bytes:
+    # A file rewritten in place gets a new mtime, so a change between the sampled blocks is not missed
+    h = hashlib.sha1(f"{size}|{mtime_ns}".encode("utf-8"))
+    with open(path, "rb") as f:
+        if size <= _CONTENT_HASH_BLOCK * _CONTENT_HASH_N_BLOCKS:
+            h.update(f.read())
+        else:
+            for offset in np.linspace(0, size - _CONTENT_HASH_BLOCK, _CONTENT_HASH_N_BLOCKS).astype(np.int64):
+                f.seek(int(offset))
+                h.update(f.read(_CONTENT_HASH_BLOCK))
+    return h.digest()
+
+def _read_content_hash_memo(memo_path) -> dict:
+    try:
+        with open(memo_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def content_hash(key) -> str:
+    """
+    sha1 identifying the content of the file (or Compumedics study) of key
+
+    Made of the size and mtime of every file and, for large files, of blocks sampled over them (see _sampled_digest()),
+    at most _CONTENT_HASH_N_BLOCKS * _CONTENT_HASH_BLOCK bytes are read per file
+    Copies of a recording share the hash if they kept its mtime (copied with their metadata)
+    Memoized by realpath, size and mtime of every file, in the shared cache dir (merged with the other processes)
+    """
+    global _content_hash_memo
+    real_path = os.path.realpath(key)
+    root, files = _content_files(real_path)
+    stats = [(os.path.relpath(f, root), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in files]
+    fingerprint = hashlib.sha1(json.dumps(stats).encode("utf-8")).hexdigest()
+    memo_path = os.path.join(_shared_cache_dir(), _CONTENT_HASH_MEMO)
+
+    with _content_hash_lock:
+        for reload in (False, True):
+            if _content_hash_memo is None or reload:
+                # Hashed by another process meanwhile
+                with FileLock(memo_path, shared=True):
+                    _content_hash_memo = _read_content_hash_memo(memo_path)
+            memo = _content_hash_memo.get(real_path)
+            if memo is not None and memo["fingerprint"] == fingerprint:
+                return memo["hash"]
+
+    h = hashlib.sha1()
+    for f, (rel, size, mtime_ns) in zip(files, stats):
+        # Names only matter inside a study, a single file may be uploaded under any name
+        if len(files) > 1:
+            h.update(rel.encode("utf-8") + b"\0")
+        h.update(_sampled_digest(f, size, mtime_ns))
+    digest = h.hexdigest()
+
+    with _content_hash_lock:
+        # The memo file is the union of what every process hashed, it is read again before it is replaced
+        with FileLock(memo_path):
+            memo = _read_content_hash_memo(memo_path)
+            memo[real_path] = {"fingerprint": fingerprint, "hash": digest}
+            tmp_path = f"{memo_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(memo, f)
+            os.replace(tmp_path, memo_path)
+        _content_hash_memo = memo
+    return digest
 
 def get_cached_files(token) -> Tuple[File, ...]:
     return tuple()
-    # return client.get(token)
 
-def _generate_cached_item_name(basename):
-    #TODO
-    return basename
+def _generate_cached_item_name(path):
+    # Files with the same name in different folders must not collide
+    basename = os.path.basename(path)
+    name = hashlib.sha1(os.path.realpath(path).encode("utf-8")).hexdigest()[:16] + "-" + basename
+    # Copies are GENII directories (see genii_format), source estimates are still saved by MNE
+    if not basename.endswith(".stc"):
+        name += GENII_EXT
+    return name
 
 def remove_cache(key):
     validate_access(key)
-    
-    cached_item_path = os.path.join(
-        g.user_data["wd"],
-        _CACHE_DIR,
-        _generate_cached_item_name(os.path.basename(key))
-    )
-    if os.path.exists(cached_item_path) and os.path.isfile(cached_item_path):
-        os.remove(cached_item_path)
-        return True
-    return False
\ No newline at end of file
+
+    mem_key = _mem_cache_key(key)
+    entry = _object_cache.pop(mem_key)
+    removed = entry is not None
+    # Views are never saved, nothing to wait for
+    removed = len(_object_cache.pop_views(mem_key)) > 0 or removed
+    if entry is not None:
+        # Wait for a flush in progress, and make sure none starts after the disk copy is gone
+        with entry.flush_lock:
+            entry.removed = True
+    backend = get_backend()
+    if backend is not None:
+        shared_key, stamp_key = _shared_cache_key(mem_key)
+        removed = backend.delete(stamp_key) or removed
+        backend.delete(shared_key)
+    cached_item_path = _cached_item_path(key)
+    with FileLock(cached_item_path):
+        for ext in (_JOURNAL_EXT, _REF_EXT):
+            if os.path.isfile(cached_item_path + ext):
+                os.remove(cached_item_path + ext)
+                removed = True
+        return _remove_cached_copy(cached_item_path) or removed
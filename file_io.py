@@ -1,12 +1,19 @@
 import os
-from db.memcached_util import get_cached_item, set_cache_item
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from db.memcached_util import get_cached_item, set_cache_item, get_cache_dir, journal_cache_item, replay_cache_journal, read_cache_journal, peek_cached_item, cached_copy_path, reserve_preload, refresh_cached_size, DISPLAY_EDITS
 from compumedics_util import Compumedics
+from genii_format import GENII_EXT, read_genii, is_file_backed
 import mne
-from flask import g, abort
+import numpy as np
+from flask import g, abort, current_app
 from enum import Enum
 from db.data_structure import File, FileType
+from typing import Dict, Tuple, Any
 
 expire = 3 * 60 * 60 # 3 hours
+# Threads opening files selected in the sidebar before the user presses Open
+_PREFETCH_WORKERS = int(os.environ.get("GENII_PREFETCH_WORKERS", 2))
 
 class _DetailedFileType(Enum):
     COMPUMEDICS = 1
@@ -15,6 +22,7 @@ class _DetailedFileType(Enum):
     MNE_EPOCH = 4
     MNE_EVOKED = 5
     MNE_ESI = 6
+    GENII = 7
     UNSUPPORTED = -1
 
 # 读取文件，并检查其文件类型（raw, epoch, ...）
@@ -26,37 +34,186 @@ def read_check_and_cache_file(path):
     if cache_item is not None:
         return cache_item
 
+    # Being opened by a prefetch, wait for it instead of opening the file twice
+    if _wait_prefetch(path):
+        cache_item = get_cached_item(path)
+        if cache_item is not None:
+            return cache_item
+
+    return _open_and_cache_file(path)
+
+def _open_and_cache_file(path):
     item = _open_file_without_caching(path)
+    replay_cache_journal(path, item)
     
-    set_cache_item(path, item)
+    # Original file + journal is a valid copy of the edited object, nothing is written until the journal is due
+    set_cache_item(path, item, journaled=True)
     return item
 
-def read_summary_and_cache_file(path):
-    file = read_check_and_cache_file(path)
-    file_type = file.item_type
+# 预读：用户选中文件后就在后台把它读进缓存，点击Open时就不用等
+_prefetch_executor = None
+_prefetch_lock = threading.Lock()
+# (user id, real path) -> prefetch not finished yet
+_prefetch_pending: Dict[Tuple[Any, str], Future] = {}
+
+def prefetch_file(path, replace: bool = True) -> Future | None:
+    """
+    Open path into the object cache on a background thread
+
+    replace: bool = True
+        Cancel the other prefetches of the user that have not started yet (the selection changed)
+        An open already in progress can not be interrupted, its object is still cached
+        False prefetches path in addition to them
+
+    Returns None if path can not be opened or is already in memory
+    """
+    validate_access(path)
+    if infer_file_type(path) == FileType.UNSUPPORTED or peek_cached_item(path) is not None:
+        return None
+
+    global _prefetch_executor
+    user_data = g.user_data
+    key = (user_data["id"], os.path.realpath(path))
+    app = current_app._get_current_object()
+    with _prefetch_lock:
+        stale = [
+            pending for (user_id, real_path), pending in _prefetch_pending.items()
+            if replace and user_id == key[0] and real_path != key[1]
+        ]
+        future = _prefetch_pending.get(key)
+        if future is None:
+            if _prefetch_executor is None:
+                _prefetch_executor = ThreadPoolExecutor(max_workers=_PREFETCH_WORKERS, thread_name_prefix="prefetch")
+            future = _prefetch_executor.submit(_prefetch, app, user_data, path)
+            _prefetch_pending[key] = future
+            new = True
+        else:
+            new = False
+    # Outside of the lock, cancel() runs the done callbacks right away
+    for pending in stale:
+        pending.cancel()
+    if not new:
+        return future
+
+    def done(f):
+        with _prefetch_lock:
+            if _prefetch_pending.get(key) is f:
+                del _prefetch_pending[key]
+    future.add_done_callback(done)
+    return future
+
+def _prefetch(app, user_data, path) -> bool:
+    # Background threads have no request, the cache needs the user in g
+    with app.app_context():
+        g.user_data = user_data
+        if get_cached_item(path) is not None:
+            return False
+        _open_and_cache_file(path)
+        return True
+
+def _wait_prefetch(path) -> bool:
+    # True if a prefetch of path was running and is finished now
+    with _prefetch_lock:
+        future = _prefetch_pending.get((g.user_data["id"], os.path.realpath(path)))
+    if future is None or future.cancelled():
+        return False
+    try:
+        future.result()
+    except Exception:
+        # Opened again by the caller, which gets to see the error
+        pass
+    return True
+
+def prefetch_related_files(path):
+    """
+    Prefetch the files the user most likely opens after path, if they exist
+    Names follow extract_epoch() (<name>-epo.fif) and compute_evoked() (<name>-ave.fif)
+    """
+    name = os.path.basename(path).split(".")[0]
+    if name.endswith("-epo"):
+        related = name[:-4] + "-ave.fif"
+    elif name.endswith("-ave"):
+        return
+    else:
+        related = name + "-epo.fif"
+    related = os.path.join(os.path.dirname(path), related)
+    if os.path.isfile(related):
+        prefetch_file(related, replace=False)
+
+# 只读取文件头，不读取数据，也不缓存
+def read_file_summary(path):
+    """
+    Summary of a file (nchan, sfreq, n_times, ...), read from its header only
+
+    No sample is read and nothing is cached, an object already in memory is summarized as-is
+    Once the file was edited or processed, the header of its newest saved copy is read instead,
+    bad channels edited since (still in the journal) are applied to it
+    """
+    validate_access(path)
+
+    file = peek_cached_item(path)
+    if file is not None:
+        return _summarize_item(file.item, file.item_type)
+
+    summary = _read_header_summary(cached_copy_path(path) or path)
+    if "bads" in summary:
+        summary["bads"] = list(summary["bads"])
+        for op in read_cache_journal(path):
+            if op["op"] == "bads":
+                _apply_bads(summary["bads"], op)
+    return summary
+
+def _read_header_summary(read_path):
+    file_type = _infer_file_type(read_path)
+
+    if file_type == _DetailedFileType.COMPUMEDICS:
+        # Headers and the segment index only, the .rda files are memory mapped but not read, the events are not read at all
+        c = Compumedics(read_path, index_dir=get_cache_dir(), load_events=False)
+        sfreq = c.compumedics_header.sampling_freq
+        return {
+            # Same as the Raw exported by Compumedics.export_to_mne_raw()
+            "highpass": 0.,
+            "lowpass": sfreq / 2,
+            "bads": [],
+            "sfreq": sfreq,
+            "nchan": len(c.compumedics_header.ch_names),
+            "type": "Raw",
+            "n_times": c.n_times(),
+        }
+    elif file_type == _DetailedFileType.MISC_RAW:
+        return _summarize_item(mne.io.read_raw(read_path, preload=False, verbose="error"), FileType.RAW)
+    elif file_type == _DetailedFileType.MNE_EPOCH:
+        return _summarize_item(mne.read_epochs(read_path, preload=False, verbose="error"), FileType.EPOCH)
+    elif file_type == _DetailedFileType.MNE_EVOKED:
+        # Evoked arrays are small (one average per channel), there is no header-only reader for them anyway
+        return _summarize_item(mne.read_evokeds(read_path, condition=0, verbose="error"), FileType.EVOKED)
+
+    file = _open_file_without_caching(read_path)
+    return _summarize_item(file.item, file.item_type)
 
+def _summarize_item(item, file_type: FileType):
     info = {}
-    for k in file.item.info.keys():
+    for k in item.info.keys():
         if k in ("nchan", "sfreq", "bads", 
                 #  "description", 
                  "highpass", "lowpass", 
                 #  "meas_date"
                  ):
-            info[k] = file.item.info[k]
+            info[k] = item.info[k]
     
     if file_type == FileType.RAW:
         info["type"] = "Raw"
-        info["n_times"] = file.item.n_times
+        info["n_times"] = item.n_times
     elif file_type == FileType.EPOCH:
         info["type"] = "Epoch"
-        info["tmin"] = file.item.tmin
-        info["tmax"] = file.item.tmax
+        info["tmin"] = item.tmin
+        info["tmax"] = item.tmax
         # TODO Event related info
     elif file_type == FileType.EVOKED:
         info["type"] = "Evoked"
-        info["nave"] = file.item.nave
-        info["tmin"] = file.item.tmin
-        info["tmax"] = file.item.tmax
+        info["nave"] = item.nave
+        info["tmin"] = item.tmin
+        info["tmax"] = item.tmax
         # TODO Event related info
     return info
     # TODO
@@ -80,19 +237,113 @@ def read_summary_and_cache_file(path):
 def read_and_cache_file(path):
     return read_check_and_cache_file(path).item
 
+# 绕过缓存读取原始文件
+def read_original_file(path):
+    """
+    The original file of path as it is on disk, nothing is read from or put into the cache (no copy, no journal)
+    """
+    validate_access(path)
+    return _open_file_without_caching(path)
+
 # 将物件储存进cache里
 # TODO security check & security when cache miss
-def cache_file(obj, type: FileType, dirty: bool, path: str):
+def cache_file(obj, type: FileType, dirty: bool, path: str, shared_path: str | None = None, state: dict | None = None):
     file = File(
         obj, type, dirty, path
     )
     set_cache_item(
         path,
         file,
-        expire
+        expire,
+        shared_path=shared_path,
+        state=state
     )
     return file
 
+# 记录一次小的修改（标注、坏导、删除epoch），不重新储存整个文件
+def journal_file(path: str, op: dict):
+    """
+    Apply an edit to the cached object of path and append it to its edit journal
+
+    op: dict
+        {"op": "annot_add" | "annot_del", "onset": float, "duration": float, "description": str}
+        {"op": "bads", "ch": str, "bad": bool}
+        {"op": "drop", "selection": List[int]}, the selection (original indices) of the epochs to drop
+        {"op": "display", "preview": dict | None, "montage": str | None}, how the object is shown (info["temp"]),
+        shipped to the other worker processes and kept across evictions like the rest, the object stays clean
+    """
+    file = read_check_and_cache_file(path)
+    apply_edit(file.item, op)
+    if op["op"] not in DISPLAY_EDITS:
+        file.dirty = True
+    journal_cache_item(path, op)
+    return file
+
+def apply_edit(item, op: dict):
+    # Every edit is idempotent, a journal can be replayed onto an object that already has some of them
+    if op["op"] == "annot_add":
+        if _find_annotation(item.annotations, op) is None:
+            item.annotations.append(op["onset"], op["duration"], op["description"])
+    elif op["op"] == "annot_del":
+        idx = _find_annotation(item.annotations, op)
+        if idx is not None:
+            item.annotations.delete(idx)
+    elif op["op"] == "bads":
+        _apply_bads(item.info["bads"], op)
+    elif op["op"] == "drop":
+        idx = np.flatnonzero(np.isin(item.selection, op["selection"]))
+        if len(idx) > 0:
+            item.drop(idx)
+    elif op["op"] == "display":
+        temp = dict(item.info.get("temp", None) or {})
+        for k in ("preview", "montage"):
+            temp.pop(k, None)
+            if op[k] is not None:
+                temp[k] = op[k]
+        item.info["temp"] = temp or None
+    else:
+        raise ValueError(f"Unknown edit {op['op']}")
+
+def _apply_bads(bads: list, op: dict):
+    if op["bad"] and op["ch"] not in bads:
+        bads.append(op["ch"])
+    elif not op["bad"] and op["ch"] in bads:
+        bads.remove(op["ch"])
+
+def _find_annotation(annotations, op: dict):
+    match = np.flatnonzero(
+        np.isclose(annotations.onset, op["onset"], rtol=0, atol=1e-6)
+        & np.isclose(annotations.duration, op["duration"], rtol=0, atol=1e-6)
+        & (annotations.description == op["description"])
+    )
+    return int(match[0]) if len(match) > 0 else None
+
+# 在需要全部数据的操作前（滤波、双极导联）把数据读进内存
+def ensure_preloaded(file: File) -> File:
+    """
+    Load every sample of a disk-backed object into memory, within the preload budget of the user
+
+    Only for operations that need the whole recording at once (filtering, re-referencing)
+    Viewing and epoching read windows straight from the file and do not need this
+
+    Raises MemoryError if the object does not fit into the budget
+    """
+    item = file.item
+    if file.item_type == FileType.RAW:
+        if item.preload:
+            return file
+        # load_data() reads into float64
+        reserve_preload(file.path, item.info["nchan"] * item.n_times * 8)
+        item.load_data()
+    elif file.item_type in (FileType.EPOCH, FileType.EVOKED) and is_file_backed(getattr(item, "_data", None)):
+        # Mapped from a GENII copy, changing it in place would copy it page by page behind the budget's back
+        reserve_preload(file.path, item._data.nbytes)
+        item._data = np.array(item._data)
+    else:
+        return file
+    refresh_cached_size(file.path)
+    return file
+
 def get_appropriate_ext(item_type: FileType):
     if item_type == FileType.RAW:
         return ".fif"
@@ -108,7 +359,9 @@ def save_mne_object(obj, path: str):
     obj.save(path, overwrite=True) # MNE objects
 
 def _infer_file_type(path):
-    if path[-4:] in (".eeg", ".sdy", ".rda"): # Compumedic
+    if path.endswith(GENII_EXT): # Cached copy, see genii_format
+        return _DetailedFileType.GENII
+    elif path[-4:] in (".eeg", ".sdy", ".rda"): # Compumedic
         return _DetailedFileType.COMPUMEDICS
     elif path[-2:] == ".e": # TODO Nicolet support
         return _DetailedFileType.NICOLET
@@ -167,6 +420,7 @@ def infer_file_type(path):
         _DetailedFileType.MISC_RAW:FileType.RAW,
         _DetailedFileType.UNSUPPORTED: FileType.UNSUPPORTED,
         _DetailedFileType.MNE_ESI: FileType.UNSUPPORTED,
+        _DetailedFileType.GENII: FileType.UNSUPPORTED, # only opened through the cache
     }[_infer_file_type(path)]
 
 def validate_access(path):
@@ -183,11 +437,19 @@ def _open_file_without_caching(path):
 
     if file_type == _DetailedFileType.COMPUMEDICS:
         item = File(
-            Compumedics(path).export_to_mne_raw(),
+            Compumedics(path, index_dir=get_cache_dir()).export_to_mne_raw(preload=False),
             FileType.RAW,
             False,
             path
         )
+    elif file_type == _DetailedFileType.GENII:
+        obj = read_genii(path)
+        item = File(
+            obj,
+            FileType.RAW if isinstance(obj, mne.io.BaseRaw) else FileType.EPOCH if isinstance(obj, mne.BaseEpochs) else FileType.EVOKED,
+            False,
+            path
+        )
     elif file_type == _DetailedFileType.NICOLET:
         raise NotImplementedError("Support for Nicolet file is not implemented yet")
     elif file_type == _DetailedFileType.MNE_EVOKED:
@@ -206,7 +468,8 @@ def _open_file_without_caching(path):
         )
     elif file_type == _DetailedFileType.MISC_RAW:
         item = File(
-            mne.io.read_raw(path, preload=True), # FIXME potentially use a lot of RAM
+            # Disk-backed, samples are read per window, see ensure_preloaded()
+            mne.io.read_raw(path, preload=False),
             FileType.RAW,
             False,
             path
@@ -0,0 +1,300 @@
+"""
+GENII cache format, a directory holding one MNE Raw, Epochs or Evoked object
+
+    <name>.genii/
+        CURRENT         name of the version in use, replaced atomically by commit_genii()
+        v<ns>-<pid>/    one complete copy of the object per version
+    <name>.genii/v<ns>-<pid>/
+        data.npy    samples, a plain .npy file that is opened with np.memmap
+                    Raw: (n_times, n_channels) float32 in file units (divided by cal * range, same as FIF),
+                    so that a window of every channel is one contiguous block
+                    Epochs: (n_epochs, n_channels, n_times) float64, Evoked: (n_channels, n_times) float64
+        info.fif    measurement info (mne.io.write_info)
+        annot.fif   annotations of a Raw, if it has any
+        events.npy  events of an Epochs
+        metadata.json   metadata of an Epochs, if it has any, as saved in FIF (one JSON record per epoch)
+        meta.json   everything else (kind, first sample, tmin, event_id, ..., info["temp"])
+
+Re-opening only parses the small sidecar files, samples are paged in from data.npy when they are used
+A Raw stays disk-backed, Epochs and Evoked are backed by a copy-on-write mapping of data.npy
+A new version is written next to the current one and only then made current, so readers never see half a copy
+and objects mapping an older version keep working (on Windows, mapped files can not be removed nor replaced)
+"""
+
+import os
+import json
+import mmap
+import time
+import shutil
+import numpy as np
+import mne
+from mne.io import BaseRaw
+from typing import Any, Dict
+
+try:
+    from mne._fiff.utils import _mult_cal_one
+except ImportError:
+    from mne.io.utils import _mult_cal_one
+from mne.utils import _prepare_write_metadata, _prepare_read_metadata
+
+GENII_EXT = ".genii"
+# Bump when the layout of the directory changes, older directories are then not opened
+_GENII_VERSION = 1
+_DATA_NAME = "data.npy"
+_INFO_NAME = "info.fif"
+_ANNOT_NAME = "annot.fif"
+_EVENTS_NAME = "events.npy"
+_METADATA_NAME = "metadata.json"
+_META_NAME = "meta.json"
+_CURRENT_NAME = "CURRENT"
+# Superseded versions kept besides the current one, an object still reading one of them
+# (e.g. unpickled in another worker process, it maps data.npy again) survives one more commit
+_KEEP_OLD_VERSIONS = 1
+# Samples of a Raw are copied in blocks of about this size, a Raw that is not preloaded is never read whole
+_WRITE_BLOCK_BYTES = 64 << 20
+
+def is_file_backed(arr) -> bool:
+    """
+    Whether the memory of arr belongs to a memory mapped file
+    """
+    while arr is not None:
+        if isinstance(arr, (np.memmap, mmap.mmap)):
+            return True
+        arr = getattr(arr, "base", None)
+    return False
+
+class _GeniiReader():
+    """
+    data.npy of a RawGenii, mapped on first use
+    """
+
+    def __init__(self, data_path: str, samples: np.ndarray | None = None):
+        self.data_path = data_path
+        self._samples = samples
+
+    @property
+    def samples(self) -> np.ndarray:
+        if self._samples is None:
+            self._samples = np.load(self.data_path, mmap_mode="r")
+        return self._samples
+
+    def __deepcopy__(self, memo):
+        # Read-only, copies of a RawGenii share it instead of copying the mapping
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The file is mapped again after unpickling, the samples are not shipped
+        state["_samples"] = None
+        return state
+
+class RawGenii(BaseRaw):
+    """
+    MNE Raw object reading its samples from data.npy of a GENII directory
+    Use read_genii() to create one
+    """
+
+    def __init__(self, path: str, info: mne.Info, first_samp: int = 0, verbose=None):
+        data_path = os.path.join(path, _DATA_NAME)
+        samples = np.load(data_path, mmap_mode="r")
+        super().__init__(
+            info,
+            preload=False,
+            first_samps=(first_samp,),
+            last_samps=(first_samp + samples.shape[0] - 1,),
+            filenames=(path,),
+            raw_extras=[{"reader": _GeniiReader(data_path, samples), "first_samp": first_samp}],
+            orig_format="single",
+            verbose=verbose
+        )
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        reader: _GeniiReader = self._raw_extras[fi]["reader"]
+        # start and stop count from the first sample of the recording as written, data.npy from its first row
+        first_samp = self._raw_extras[fi]["first_samp"]
+        _mult_cal_one(data, reader.samples[start - first_samp:stop - first_samp].T, idx, cals, mult)
+
+def write_genii(item, path: str, fsync: bool = False):
+    """
+    Write an MNE Raw, Epochs or Evoked object into a new version directory
+
+    path: str
+        Must not exist yet, see commit_genii() to add a version to a GENII directory
+
+    fsync: bool = False
+        Flush every file to the storage device before returning
+    """
+    os.makedirs(path)
+    meta: Dict[str, Any] = {"version": _GENII_VERSION, "temp": item.info.get("temp")}
+    data_path = os.path.join(path, _DATA_NAME)
+
+    if isinstance(item, BaseRaw):
+        meta.update(kind="raw", first_samp=int(item.first_samp))
+        _write_raw_samples(item, data_path)
+        if len(item.annotations) > 0:
+            item.annotations.save(os.path.join(path, _ANNOT_NAME), overwrite=True, verbose="error")
+    elif isinstance(item, mne.BaseEpochs):
+        meta.update(
+            kind="epochs",
+            tmin=float(item.tmin),
+            event_id={k: int(v) for k, v in item.event_id.items()},
+            selection=item.selection.tolist(),
+            drop_log=[list(log) for log in item.drop_log],
+            baseline=None if item.baseline is None else [float(t) for t in item.baseline],
+            proj=bool(item.proj),
+            # Read back from FIF as a 1-element array
+            raw_sfreq=float(np.ravel(item._raw_sfreq)[0]),
+        )
+        np.save(data_path, np.ascontiguousarray(item.get_data(picks=np.arange(item.info["nchan"])), dtype="<f8"))
+        np.save(os.path.join(path, _EVENTS_NAME), item.events)
+        if item.metadata is not None:
+            # Same encoding as FIF, a DataFrame (or a list of dicts without pandas) comes back the same way
+            with open(os.path.join(path, _METADATA_NAME), "w", encoding="utf-8") as f:
+                f.write(_prepare_write_metadata(item.metadata))
+    elif isinstance(item, mne.Evoked):
+        meta.update(
+            kind="evoked",
+            tmin=float(item.tmin),
+            comment=item.comment,
+            nave=int(item.nave),
+            evoked_kind=item.kind,
+            baseline=None if item.baseline is None else [float(t) for t in item.baseline],
+        )
+        np.save(data_path, np.ascontiguousarray(item.data, dtype="<f8"))
+    else:
+        raise TypeError(f"Cannot write {type(item).__name__} in GENII format")
+
+    mne.io.write_info(os.path.join(path, _INFO_NAME), item.info)
+    with open(os.path.join(path, _META_NAME), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+    if fsync:
+        for name in os.listdir(path):
+            with open(os.path.join(path, name), "rb") as f:
+                os.fsync(f.fileno())
+
+def _write_raw_samples(raw: BaseRaw, data_path: str):
+    cals = np.array([ch["cal"] * ch["range"] for ch in raw.info["chs"]])
+    out = np.lib.format.open_memmap(data_path, mode="w+", dtype="<f4", shape=(int(raw.n_times), len(cals)))
+    step = max(_WRITE_BLOCK_BYTES // (8 * max(len(cals), 1)), 1)
+    for start in range(0, raw.n_times, step):
+        stop = min(start + step, raw.n_times)
+        block, _ = raw[:, start:stop]
+        out[start:stop] = (block / cals[:, np.newaxis]).T
+    out.flush()
+    del out
+
+def read_genii(path: str):
+    """
+    Open the current version of a GENII directory, returns the MNE Raw, Epochs or Evoked object in it
+
+    No sample is read, a Raw is a RawGenii reading windows from data.npy,
+    Epochs and Evoked hold a copy-on-write mapping of data.npy (in-place changes stay in memory)
+    """
+    version_path = current_genii(path)
+    if version_path is None:
+        raise FileNotFoundError(f"No GENII copy in {path}")
+    path = version_path
+    with open(os.path.join(path, _META_NAME), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("version") != _GENII_VERSION:
+        raise ValueError(f"Unsupported GENII version {meta.get('version')} in {path}")
+    info = mne.io.read_info(os.path.join(path, _INFO_NAME), verbose="error")
+    data_path = os.path.join(path, _DATA_NAME)
+
+    if meta["kind"] == "raw":
+        item = RawGenii(path, info, first_samp=meta["first_samp"], verbose="error")
+        annot_path = os.path.join(path, _ANNOT_NAME)
+        if os.path.isfile(annot_path):
+            annotations = mne.read_annotations(annot_path)
+            if annotations.orig_time is None:
+                # Saved as Raw.annotations has them, from the start of the recording,
+                # set_annotations() counts them from the first sample and would shift them by first_time again
+                annotations.onset -= item.first_time
+            item.set_annotations(annotations)
+    elif meta["kind"] == "epochs":
+        metadata = None
+        metadata_path = os.path.join(path, _METADATA_NAME)
+        if os.path.isfile(metadata_path):
+            with open(metadata_path, "r", encoding="utf-8") as f:
+                metadata = _prepare_read_metadata(f.read())
+        item = mne.EpochsArray(
+            np.load(data_path, mmap_mode="c"),
+            info,
+            events=np.load(os.path.join(path, _EVENTS_NAME)),
+            tmin=meta["tmin"],
+            event_id=meta["event_id"] or None,
+            metadata=metadata,
+            proj=meta["proj"],
+            on_missing="ignore",
+            selection=meta["selection"],
+            drop_log=tuple(tuple(log) for log in meta["drop_log"]),
+            raw_sfreq=meta["raw_sfreq"],
+            verbose="error"
+        )
+        # Same as mne.read_epochs(), the samples are already baseline corrected
+        item.baseline = None if meta["baseline"] is None else tuple(meta["baseline"])
+        item._do_baseline = False
+    elif meta["kind"] == "evoked":
+        item = mne.EvokedArray(
+            np.load(data_path, mmap_mode="c"),
+            info,
+            tmin=meta["tmin"],
+            comment=meta["comment"],
+            nave=meta["nave"],
+            kind=meta["evoked_kind"],
+            verbose="error"
+        )
+        item.baseline = None if meta["baseline"] is None else tuple(meta["baseline"])
+    else:
+        raise ValueError(f"Unknown GENII object kind {meta['kind']} in {path}")
+
+    if meta.get("temp") is not None:
+        item.info["temp"] = meta["temp"]
+    return item
+
+def current_genii(path: str) -> str | None:
+    """
+    Directory of the current version of the GENII directory path, None if it has no complete version (yet)
+    """
+    try:
+        with open(os.path.join(path, _CURRENT_NAME), "r", encoding="utf-8") as f:
+            name = f.read().strip()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return os.path.join(path, name) if name else None
+
+def commit_genii(item, path: str, fsync: bool = False) -> str:
+    """
+    Write item as a new version of the GENII directory path (created if needed) and make it current
+
+    Writers of the same path must exclude each other (see db.file_lock), readers need not
+    Returns the directory of the new version
+
+    fsync: bool = False
+        Flush the new version and CURRENT to the storage device before returning
+    """
+    os.makedirs(path, exist_ok=True)
+    name = f"v{time.time_ns():020d}-{os.getpid()}"
+    write_genii(item, os.path.join(path, name), fsync)
+
+    current_path = os.path.join(path, _CURRENT_NAME)
+    tmp_path = f"{current_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(name)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, current_path)
+    _prune_versions(path, name)
+    return os.path.join(path, name)
+
+def _prune_versions(path: str, current: str):
+    # Versions newer than the current one are still being written by someone else
+    old = sorted(n for n in os.listdir(path) if n.startswith("v") and n < current)
+    for name in old[:max(len(old) - _KEEP_OLD_VERSIONS, 0)]:
+        # Still mapped on Windows, removed by a later commit
+        shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+def remove_genii(path: str):
+    shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,323 @@
+"""
+Background jobs for operations that take too long to run inside a callback (epochs, evoked, source estimation)
+
+The callback submits a job and returns right away, the job panel (layout_impl/job_panel.py) polls its progress
+and opens its result in a new tab when it is done
+    queued -> running -> done | failed | cancelled
+Jobs are rows of a sqlite database (GENII_JOB_DB) shared by the worker processes of the app, so any of them can list
+and cancel the jobs of a user, and run on a pool of GENII_JOB_WORKERS processes owned by the process that submitted them
+A job runs as the user who submitted it and opens its inputs through the object cache, like another worker process
+(edits reach it through the journal, the view it was submitted with is derived again, see workflow.general.open_view()),
+its result is a file that the process serving the panel opens into its own object cache
+Each job process gets its share of the cores (GENII_WORKERS / GENII_JOB_WORKERS, see worker_pool)
+Cancelling is cooperative: a queued job never starts, a running job stops at its next progress report
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing
+from typing import Callable, Dict, List, Tuple, Any
+
+from flask import Flask, g
+from db.data_structure import UserData
+from db.memcached_util import flush_cache
+import worker_pool
+
+_DB_PATH = os.environ.get("GENII_JOB_DB", os.path.join("uploaded_files", "jobs.sqlite3"))
+_WORKERS = max(int(os.environ.get("GENII_JOB_WORKERS", 2)), 1)
+# Finished jobs stay listed in the panel this long
+_KEEP_SEC = float(os.environ.get("GENII_JOB_KEEP_SEC", 24 * 60 * 60))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+class JobCancelled(Exception):
+    pass
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def _connect() -> sqlite3.Connection:
+    global _schema_ready
+    con = sqlite3.connect(_DB_PATH, timeout=30)
+    con.row_factory = sqlite3.Row
+    with _schema_lock:
+        if not _schema_ready:
+            os.makedirs(os.path.dirname(os.path.abspath(_DB_PATH)), exist_ok=True)
+            # Progress is written by the job processes while the panels of every worker process read
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("" \
+                "CREATE TABLE IF NOT EXISTS job (" \
+                    "id INTEGER PRIMARY KEY AUTOINCREMENT," \
+                    "user_id TEXT NOT NULL," \
+                    "kind TEXT NOT NULL," \
+                    "label TEXT NOT NULL," \
+                    "status TEXT NOT NULL," \
+                    "progress REAL NOT NULL DEFAULT 0," \
+                    "message TEXT NULL," \
+                    "result TEXT NULL," \
+                    "cancel INTEGER NOT NULL DEFAULT 0," \
+                    "delivered INTEGER NOT NULL DEFAULT 0," \
+                    "owner_pid INTEGER NOT NULL," \
+                    "created REAL NOT NULL," \
+                    "finished REAL NULL" \
+                ");"
+            )
+            con.commit()
+            _prune(con)
+            _schema_ready = True
+    return con
+
+def _prune(con: sqlite3.Connection):
+    # Housekeeping when a process starts and when a job of it ends, never while polling (see user_jobs())
+    with con:
+        con.execute("DELETE FROM job WHERE finished IS NOT NULL AND finished < ?", (time.time() - _KEEP_SEC,))
+        # The process owning the pool of an active job is gone (restarted), the job went with it
+        for row in con.execute("SELECT DISTINCT owner_pid FROM job WHERE status IN (?, ?)", (QUEUED, RUNNING)).fetchall():
+            if not _pid_alive(row["owner_pid"]):
+                con.execute(
+                    "UPDATE job SET status = ?, message = ?, finished = ? WHERE owner_pid = ? AND status IN (?, ?)",
+                    (FAILED, "Interrupted, the server was restarted", time.time(), row["owner_pid"], QUEUED, RUNNING)
+                )
+
+def _pid_alive(pid: int) -> bool:
+    if os.name == "nt":
+        # FIXME os.kill() terminates the process on Windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _query(sql: str, params=()) -> List[sqlite3.Row]:
+    with closing(_connect()) as con, con:
+        return con.execute(sql, params).fetchall()
+
+def _update(sql: str, params=()) -> int:
+    with closing(_connect()) as con, con:
+        return con.execute(sql, params).rowcount
+
+def _finish(job_id: int, status: str, message: str | None = None, result: Any = None):
+    # Only an active job can finish, a job is finished once
+    _update(
+        "UPDATE job SET status = ?, progress = COALESCE(?, progress), message = COALESCE(?, message), result = ?, finished = ?" \
+        " WHERE id = ? AND status IN (?, ?)",
+        (status, 1. if status == DONE else None, message, None if result is None else json.dumps(result), time.time(), job_id, QUEUED, RUNNING)
+    )
+
+class Job():
+    """
+    Handle of a job, passed to the job function as its first argument
+    """
+
+    def __init__(self, job_id: int):
+        self.id = job_id
+
+    def progress(self, fraction: float, message: str | None = None):
+        """
+        Report progress (0 to 1) to the job panel, raises JobCancelled if the job was cancelled meanwhile
+        """
+        with closing(_connect()) as con, con:
+            con.execute(
+                "UPDATE job SET progress = ?, message = COALESCE(?, message) WHERE id = ?",
+                (max(0., min(float(fraction), 1.)), message, self.id)
+            )
+            cancelled = con.execute("SELECT cancel FROM job WHERE id = ?", (self.id,)).fetchone()["cancel"]
+        if cancelled:
+            raise JobCancelled()
+
+# Job processes
+
+_job_app = None
+
+def _init_job_process(n_cores: int):
+    worker_pool.limit_workers(n_cores)
+
+def _run_job(job_id: int, user_data: UserData, fn: Callable, args: tuple):
+    global _job_app
+    if _update("UPDATE job SET status = ? WHERE id = ? AND status = ? AND cancel = 0", (RUNNING, job_id, QUEUED)) == 0:
+        # Cancelled before it started
+        _finish(job_id, CANCELLED, message="Cancelled")
+        return
+    if _job_app is None:
+        _job_app = Flask(__name__)
+    try:
+        # No request in a job process, the object cache needs the user in g (same as file_io._prefetch())
+        with _job_app.app_context():
+            g.user_data = user_data
+            try:
+                result = fn(Job(job_id), *args)
+            finally:
+                # Job processes end with os._exit(), the flush at exit of memcached_util never runs there
+                flush_cache(fsync=True)
+        _finish(job_id, DONE, result=result)
+    except JobCancelled:
+        _finish(job_id, CANCELLED, message="Cancelled")
+    except Exception as e:
+        print(traceback.format_exc())
+        _finish(job_id, FAILED, message=f"{type(e).__name__}: {e}")
+
+# Submitting process
+
+_executor = None
+_executor_lock = threading.Lock()
+# ProcessPoolExecutor(max_tasks_per_child=) is Python >= 3.11, before that every job gets a pool of its own
+_ONE_POOL = sys.version_info >= (3, 11)
+_job_slots = threading.BoundedSemaphore(_WORKERS)
+_futures: Dict[int, Future] = {}
+_futures_lock = threading.Lock()
+
+def _mp_context():
+    # Forked job processes would inherit the locks held by the threads of the server (object cache, flusher, pool)
+    # The fork server is a fresh process with only mne loaded, job processes are forked from it
+    # They import the main module again (like spawned processes do), app.py builds nothing at import (see create_app())
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["mne", "jobs"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+def _new_executor(max_workers: int, **kwargs) -> ProcessPoolExecutor:
+    # The cores of the app are split between the job processes instead of each using them all
+    return ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=_mp_context(),
+        initializer=_init_job_process, initargs=(max(worker_pool.n_workers() // _WORKERS, 1),), **kwargs
+    )
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # One process per job, the memory of a job (and its view of the object cache) goes away with it
+            _executor = _new_executor(_WORKERS, max_tasks_per_child=1)
+        return _executor
+
+def _submit_to_own_pool(*args) -> Future:
+    # Same as _get_executor().submit(_run_job, *args) without max_tasks_per_child:
+    # the job waits for one of GENII_JOB_WORKERS slots, then runs in a pool of one process that is shut down after it
+    future = Future()
+    def run():
+        with _job_slots:
+            # Cancelled while waiting for a slot
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                with _new_executor(1) as executor:
+                    future.set_result(executor.submit(_run_job, *args).result())
+            except BaseException as e:
+                future.set_exception(e)
+    threading.Thread(target=run, name="job", daemon=True).start()
+    return future
+
+def _job_ended(job_id: int, future: Future):
+    global _executor
+    with _futures_lock:
+        _futures.pop(job_id, None)
+    if future.cancelled():
+        _finish(job_id, CANCELLED, message="Cancelled")
+    else:
+        e = future.exception()
+        if e is not None:
+            # The job process died (e.g. out of memory) or the job could not be sent to it
+            _finish(job_id, FAILED, message=f"{type(e).__name__}: {e}")
+            if isinstance(e, BrokenProcessPool):
+                with _executor_lock:
+                    _executor = None
+    with closing(_connect()) as con:
+        _prune(con)
+
+def submit(kind: str, label: str, fn: Callable, *args) -> int:
+    """
+    Run fn(job, *args) in a job process as the current user, returns the id of the job
+
+    fn must be a module-level function and args plain values (paths, numbers, dicts), they are pickled
+    fn reports progress with job.progress() and returns its result as a JSON-able dict, see register_opener()
+
+    kind: str
+        What the job does, decides how its result is opened
+
+    label: str
+        Shown in the job panel
+    """
+    user_data = g.user_data
+    with closing(_connect()) as con, con:
+        job_id = con.execute(
+            "INSERT INTO job(user_id, kind, label, status, owner_pid, created) VALUES (?, ?, ?, ?, ?, ?)",
+            (str(user_data["id"]), kind, label, QUEUED, os.getpid(), time.time())
+        ).lastrowid
+    # Without the password and token
+    job_user = UserData(user_data["id"], user_data["name"], user_data["email"], None, None)
+    job_user.wd = user_data["wd"]
+    try:
+        if _ONE_POOL:
+            future = _get_executor().submit(_run_job, job_id, job_user, fn, args)
+        else:
+            future = _submit_to_own_pool(job_id, job_user, fn, args)
+    except Exception as e:
+        _finish(job_id, FAILED, message=f"{type(e).__name__}: {e}")
+        raise
+    with _futures_lock:
+        _futures[job_id] = future
+    future.add_done_callback(lambda f: _job_ended(job_id, f))
+    return job_id
+
+def cancel(job_id: int) -> bool:
+    """
+    Cancel a job of the current user, False if it is not queued or running (anymore)
+    """
+    if _update(
+        "UPDATE job SET cancel = 1 WHERE id = ? AND user_id = ? AND status IN (?, ?)",
+        (job_id, str(g.user_data["id"]), QUEUED, RUNNING)
+    ) == 0:
+        return False
+    with _futures_lock:
+        future = _futures.get(job_id)
+    # Queued in this process, it is dropped right away, otherwise the flag stops it
+    if future is not None:
+        future.cancel()
+    return True
+
+def user_jobs() -> List[Dict[str, Any]]:
+    """
+    Jobs of the current user, newest first, finished jobs are dropped after GENII_JOB_KEEP_SEC
+
+    Only reads, the job panel calls it on every poll
+    """
+    return [dict(row) for row in _query("SELECT * FROM job WHERE user_id = ? ORDER BY id DESC", (str(g.user_data["id"]),))]
+
+def take_result(job_id: int) -> Dict[str, Any] | None:
+    """
+    Result of a finished job of the current user, only once: None if it is not done or was taken already
+    (by another tab or worker process)
+    """
+    if _update(
+        "UPDATE job SET delivered = 1 WHERE id = ? AND user_id = ? AND status = ? AND delivered = 0",
+        (job_id, str(g.user_data["id"]), DONE)
+    ) == 0:
+        return None
+    return json.loads(_query("SELECT result FROM job WHERE id = ?", (job_id,))[0]["result"])
+
+_openers: Dict[str, Callable[[Dict[str, Any]], Tuple[Any, Any]]] = {}
+
+def register_opener(kind: str, opener: Callable[[Dict[str, Any]], Tuple[Any, Any]]):
+    """
+    opener(result) -> (tab title, tab content) opens the result of a job of kind, in the process serving the panel
+    """
+    _openers[kind] = opener
+
+def open_result(kind: str, result: Dict[str, Any]) -> Tuple[Any, Any]:
+    return _openers[kind](result)
@@ -5,6 +5,7 @@ from flask import g, abort
 from layout_impl.header import header, header_init_targets
 from layout_impl.left_sidebar import left_sidebar, left_sidebar_init_targets
 from layout_impl.main_body import main_body, main_body_init_targets
+from layout_impl.job_panel import job_panel
 from layout_impl.reusable import OnceInterval
 
 from workflow.raw import clientside_collector as raw_clientside_collector
@@ -64,6 +65,9 @@ def get_layout():
                         )
                     ),
 
+                    # Polled every second, kept out of whole-loading
+                    job_panel(),
+
                     # HACK This is even more cursed
                     *[
                         dcc.Store(
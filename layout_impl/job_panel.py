@@ -0,0 +1,138 @@
+from flask import g
+from dash_iconify import DashIconify
+import dash_bootstrap_components as dbc
+from dash import callback, Input, Output, State, ALL, ctx, no_update, html, dcc
+import traceback
+import jobs
+from .main_body import append_to_tabs
+
+# Outside of whole-loading, polling must not bring up the big spinner
+def job_panel():
+    return html.Div(
+        id="job-panel",
+        className="bg-light rounded shadow-sm",
+        style={
+            "position": "fixed",
+            "right": "15px",
+            "bottom": "15px",
+            "width": "320px",
+            "maxHeight": "40%",
+            "overflowY": "auto",
+            "zIndex": "1000"
+        },
+        children=(
+            # Polls while jobs are active, submitting a job enables it again
+            dcc.Interval(
+                id="job-poll-interval",
+                interval=1000,
+                disabled=False
+            ),
+            # What the list shows, it is only rendered again when this changes
+            dcc.Store(
+                id="job-panel-snapshot",
+                storage_type="memory"
+            ),
+            # Id of a finished job whose result is to be opened in a new tab
+            dcc.Store(
+                id="job-finished",
+                storage_type="memory"
+            ),
+            html.Div(
+                id="job-panel-list"
+            )
+        )
+    )
+
+def render_job(job: dict):
+    active = job["status"] in (jobs.QUEUED, jobs.RUNNING)
+    return dbc.Card(
+        className="m-1",
+        body=True,
+        children=(
+            html.Div(
+                className="d-flex align-items-center",
+                children=(
+                    html.Small(
+                        className="flex-grow-1 text-truncate",
+                        title=job["label"],
+                        children=job["label"]
+                    ),
+                    dbc.Button(
+                        id={"type": "job-cancel-btn", "index": job["id"]},
+                        className="btn btn-sm btn-outline-danger" + ("" if active else " d-none"),
+                        title="Cancel",
+                        children=DashIconify(icon="material-symbols:close")
+                    )
+                )
+            ),
+            dbc.Progress(
+                className="my-1",
+                value=round(job["progress"] * 100),
+                striped=job["status"] == jobs.QUEUED,
+                animated=job["status"] == jobs.RUNNING,
+                color={jobs.DONE: "success", jobs.FAILED: "danger", jobs.CANCELLED: "secondary"}.get(job["status"])
+            ),
+            html.Small(
+                className="text-muted",
+                children=job["status"] if job["message"] is None else f"{job['status']}: {job['message']}"
+            )
+        )
+    )
+
+@callback(
+    Output("job-panel-list", "children"),
+    Output("job-panel-snapshot", "data"),
+    Output("job-finished", "data"),
+    Output("job-poll-interval", "disabled"),
+    Input("job-poll-interval", "n_intervals"),
+    State("job-panel-snapshot", "data"),
+    State("job-finished", "data"),
+)
+def poll_jobs(_, snapshot, finished):
+    if g.get("user_data") is None:
+        return no_update, no_update, no_update, no_update
+    user_jobs = jobs.user_jobs()
+    shown = [[j["id"], j["status"], j["progress"], j["message"]] for j in user_jobs]
+    # Oldest result first, one per poll
+    ready = [j["id"] for j in user_jobs if j["status"] == jobs.DONE and not j["delivered"]]
+    # Nothing can change anymore until a job is submitted
+    idle = len(ready) == 0 and not any(j["status"] in (jobs.QUEUED, jobs.RUNNING) for j in user_jobs)
+    ready = ready[-1] if len(ready) > 0 and ready[-1] != finished else no_update
+    if shown == snapshot:
+        return no_update, no_update, ready, idle
+    return [render_job(j) for j in user_jobs], shown, ready, idle
+
+@callback(
+    Output("content-tabs", "children", allow_duplicate=True),
+    Output("content-tabs", "value", allow_duplicate=True),
+    Input("job-finished", "data"),
+    State({"type": "content-tab-list", "index": ALL}, "value"),
+    prevent_initial_call=True
+)
+def open_job_result(job_id, tab_values):
+    if job_id is None:
+        return no_update
+    job = next((j for j in jobs.user_jobs() if j["id"] == job_id), None)
+    # Taken by another tab of the user already
+    result = None if job is None else jobs.take_result(job_id)
+    if result is None:
+        return no_update
+    try:
+        return append_to_tabs(tab_values, *jobs.open_result(job["kind"], result))
+    except Exception:
+        # FIXME the result is lost for the panel, the file is still in the workspace
+        print(traceback.format_exc())
+        return no_update
+
+@callback(
+    Output("job-panel-snapshot", "data", allow_duplicate=True),
+    Input({"type": "job-cancel-btn", "index": ALL}, "n_clicks"),
+    prevent_initial_call=True
+)
+def cancel_job(_):
+    # The list is rendered again, a new button triggers this too
+    if ctx.triggered_id is None or not ctx.triggered[0]["value"]:
+        return no_update
+    jobs.cancel(ctx.triggered_id["index"])
+    # Shown again at the next poll
+    return None
@@ -4,7 +4,7 @@ import dash_bootstrap_components as dbc
 import dash_mantine_components as dmc
 from dash import callback, Input, Output, ALL, MATCH, State, ctx, no_update, html, dcc, Patch
 import os
-from file_io import read_check_and_cache_file, read_summary_and_cache_file, infer_file_type, validate_access
+from file_io import read_check_and_cache_file, read_file_summary, infer_file_type, validate_access, prefetch_file, prefetch_related_files
 from db.data_structure import FileType
 from workflow.raw import render_raw_content
 from workflow.epoch import render_epoch_content
@@ -221,7 +221,13 @@ def get_file_summary(_):
     if not any(_): return no_update
 
     try:
-        summary = read_summary_and_cache_file(decode_path(ctx.triggered_id))
+        # Most likely opened next, load it while the user looks at the summary
+        prefetch_file(decode_path(ctx.triggered_id))
+    except:
+        print(traceback.format_exc())
+
+    try:
+        summary = read_file_summary(decode_path(ctx.triggered_id))
         can_open = True
     except:
         print(traceback.format_exc())
@@ -249,6 +255,7 @@ def open_file(_, table_id, tab_values):
         return no_update
     
     file = read_check_and_cache_file(path)
+    prefetch_related_files(path)
     if file.item_type == FileType.RAW:
         new_tab = render_raw_content(file)
         # tab = render_raw_content(file.item, path=path)
@@ -0,0 +1,22 @@
+import os
+import sys
+
+# The modules of the app are imported from the repository root, as app.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mne
+
+mne.set_log_level("ERROR")
+
+import pytest
+
+@pytest.fixture
+def user(tmp_path, monkeypatch):
+    """
+    Runs the test as a user whose working directory is tmp_path, like a request would
+    """
+    flask = pytest.importorskip("flask")
+    monkeypatch.chdir(tmp_path)
+    with flask.Flask(__name__).app_context():
+        flask.g.user_data = {"id": 1, "wd": str(tmp_path)}
+        yield flask.g.user_data
@@ -0,0 +1,108 @@
+import time
+
+import numpy as np
+import pytest
+
+from db import cache_backend
+from db.cache_backend import (
+    serialize, deserialize, InProcessBackend, DiskBackend, InProcessMemcachedClient, MemcachedBackend, _hash_key
+)
+
+def _value():
+    return {"name": "a_raw.fif", "data": np.arange(100_000, dtype=np.float64).reshape(100, 1000), "events": np.arange(30)}
+
+def _assert_same(got, expected):
+    assert got["name"] == expected["name"]
+    np.testing.assert_array_equal(got["data"], expected["data"])
+    np.testing.assert_array_equal(got["events"], expected["events"])
+
+def test_serialize_round_trip():
+    value = _value()
+
+    _assert_same(deserialize(bytes(serialize(value))), value)
+
+def test_deserialize_maps_arrays_in_place_aligned():
+    data = serialize(_value())
+    start = np.frombuffer(data, dtype=np.uint8).ctypes.data
+
+    got = deserialize(data)
+
+    assert not got["data"].flags.owndata
+    assert (got["data"].ctypes.data - start) % cache_backend._SER_ALIGN == 0
+
+def test_deserialize_rejects_other_data():
+    with pytest.raises(ValueError):
+        deserialize(b"\0" * 64)
+
+def test_memcached_small_value_is_one_item():
+    client = InProcessMemcachedClient(item_size_limit=1 << 20)
+    backend = MemcachedBackend(client, item_size_limit=1 << 20)
+
+    backend.set("small", {"x": 1})
+
+    assert backend.get("small") == {"x": 1}
+    assert list(client._items) == [_hash_key("small")]
+
+def test_memcached_large_value_is_chunked():
+    limit = 64 << 10
+    client = InProcessMemcachedClient(item_size_limit=limit)
+    backend = MemcachedBackend(client, item_size_limit=limit)
+    value = _value()
+
+    backend.set("large", value)
+
+    _assert_same(backend.get("large"), value)
+    assert len(client._items) > 2
+    assert all(len(key) + len(item[1]) <= limit for key, item in client._items.items())
+
+def test_memcached_missing_chunk_is_a_miss():
+    limit = 64 << 10
+    client = InProcessMemcachedClient(item_size_limit=limit)
+    backend = MemcachedBackend(client, item_size_limit=limit)
+    backend.set("large", _value())
+
+    client.delete(next(key for key in client._items if key != _hash_key("large")))
+
+    assert backend.get("large", "missing") == "missing"
+
+def test_memcached_new_version_does_not_mix_chunks():
+    limit = 64 << 10
+    client = InProcessMemcachedClient(item_size_limit=limit)
+    backend = MemcachedBackend(client, item_size_limit=limit)
+    backend.set("large", _value())
+    value = _value()
+    value["data"] = -value["data"]
+
+    backend.set("large", value)
+
+    _assert_same(backend.get("large"), value)
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+@pytest.mark.parametrize("make_backend", (
+    lambda tmp_path: InProcessBackend(),
+    lambda tmp_path: DiskBackend(str(tmp_path)),
+    lambda tmp_path: MemcachedBackend(InProcessMemcachedClient()),
+))
+def test_ttl(make_backend, tmp_path, clock):
+    backend = make_backend(tmp_path)
+    backend.set("short", 1, expire=10)
+    backend.set("forever", 2)
+
+    clock[0] += 5
+    assert backend.get("short") == 1
+    clock[0] += 10
+    assert backend.get("short") is None
+    assert backend.get("forever") == 2
+
+def test_disk_backend_delete(tmp_path):
+    backend = DiskBackend(str(tmp_path))
+    backend.set("a", _value())
+
+    assert backend.delete("a")
+    assert not backend.delete("a")
+    assert backend.get("a") is None
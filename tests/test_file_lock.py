@@ -0,0 +1,76 @@
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+from db.file_lock import FileLock, LOCK_EXT
+
+def _in_thread(fn):
+    out = []
+    t = threading.Thread(target=lambda: out.append(fn()))
+    t.start()
+    t.join()
+    return out[0]
+
+def _try_lock(path: str, shared: bool) -> bool:
+    try:
+        with FileLock(path, shared=shared, blocking=False):
+            return True
+    except BlockingIOError:
+        return False
+
+@pytest.mark.skipif(os.name == "nt", reason="shared locks are exclusive on Windows")
+def test_shared_locks_coexist(tmp_path):
+    path = str(tmp_path / "a_raw.fif")
+    with FileLock(path, shared=True):
+        assert _in_thread(lambda: _try_lock(path, shared=True))
+
+@pytest.mark.skipif(os.name == "nt", reason="shared locks are exclusive on Windows")
+def test_exclusive_excludes_other_threads(tmp_path):
+    path = str(tmp_path / "a_raw.fif")
+    with FileLock(path):
+        assert not _in_thread(lambda: _try_lock(path, shared=True))
+        assert not _in_thread(lambda: _try_lock(path, shared=False))
+    with FileLock(path, shared=True):
+        assert not _in_thread(lambda: _try_lock(path, shared=False))
+    assert _in_thread(lambda: _try_lock(path, shared=False))
+
+def test_reentrant_in_the_same_thread(tmp_path):
+    path = str(tmp_path / "a_raw.fif")
+    with FileLock(path):
+        with FileLock(path, blocking=False):
+            with FileLock(path, shared=True, blocking=False):
+                pass
+        # Still held after the inner ones were released
+        assert not _in_thread(lambda: _try_lock(path, shared=False))
+    assert _in_thread(lambda: _try_lock(path, shared=False))
+
+def test_no_upgrade_from_shared(tmp_path):
+    path = str(tmp_path / "a_raw.fif")
+    with FileLock(path, shared=True):
+        with pytest.raises(RuntimeError):
+            with FileLock(path):
+                pass
+
+def test_removed_lock_file_is_created_again(tmp_path):
+    path = str(tmp_path / "a_raw.fif")
+    with FileLock(path):
+        # Removed together with its item, see cache_gc
+        os.remove(path + LOCK_EXT)
+        # A new lock file is created, the holder of the unlinked one does not exclude anyone
+        assert _in_thread(lambda: _try_lock(path, shared=False))
+
+def _child_try_lock(path: str, queue):
+    queue.put(_try_lock(path, shared=False))
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="no fork")
+def test_forked_child_does_not_hold_the_locks_of_its_parent(tmp_path):
+    path = str(tmp_path / "a_raw.fif")
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    with FileLock(path):
+        child = context.Process(target=_child_try_lock, args=(path, queue))
+        child.start()
+        child.join()
+    assert queue.get(timeout=10) is False
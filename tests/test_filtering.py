@@ -0,0 +1,135 @@
+from collections import OrderedDict
+
+import mne
+import numpy as np
+import pytest
+
+from workflow import filtering
+from workflow.filtering import filter_raw_out_of_core, needs_out_of_core, filter_window
+
+_SFREQ = 250.
+
+def _saved_raw(tmp_path, n_times: int = 20_000, annotations=None, first_samp: int = 0) -> mne.io.BaseRaw:
+    info = mne.create_info([f"E{i}" for i in range(3)] + ["STI"], _SFREQ, ["eeg"] * 3 + ["stim"])
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((4, n_times)) * 1e-5
+    data[3] = 0
+    raw = mne.io.RawArray(data, info, first_samp=first_samp)
+    if annotations is not None:
+        raw.set_annotations(annotations)
+    path = str(tmp_path / "a_raw.fif")
+    raw.save(path)
+    return mne.io.read_raw_fif(path, preload=False)
+
+def _assert_same_as_filter(tmp_path, raw, l_freq, h_freq):
+    expected = raw.copy().load_data().filter(l_freq, h_freq).get_data()
+
+    got = filter_raw_out_of_core(raw, l_freq, h_freq, str(tmp_path / "filtered.genii"))
+
+    assert not raw.preload
+    # GENII copies hold float32 samples
+    np.testing.assert_allclose(got.get_data(), expected, rtol=0, atol=1e-6 * np.abs(expected).max())
+    assert got.info["highpass"] == pytest.approx(l_freq or 0.)
+    assert got.info["lowpass"] == pytest.approx(h_freq or _SFREQ / 2)
+
+@pytest.mark.parametrize("l_freq, h_freq", ((1., 40.), (0.5, None), (None, 30.)))
+def test_same_as_raw_filter(tmp_path, l_freq, h_freq):
+    _assert_same_as_filter(tmp_path, _saved_raw(tmp_path), l_freq, h_freq)
+
+def test_segments_split_at_annotations(tmp_path):
+    annotations = mne.Annotations([20., 50.], [4., 0.1], ["bad_acq_skip", "edge"])
+    _assert_same_as_filter(tmp_path, _saved_raw(tmp_path, annotations=annotations), 1., 40.)
+
+def test_first_sample_offset(tmp_path):
+    _assert_same_as_filter(tmp_path, _saved_raw(tmp_path, first_samp=1234), 1., 40.)
+
+def test_existing_copy_is_reused(tmp_path):
+    raw = _saved_raw(tmp_path)
+    path = str(tmp_path / "filtered.genii")
+    first = filter_raw_out_of_core(raw, 1., 40., path)
+
+    second = filter_raw_out_of_core(raw, 1., 40., path)
+
+    assert second.filenames == first.filenames
+
+def test_needs_out_of_core(tmp_path, monkeypatch):
+    raw = _saved_raw(tmp_path)
+    monkeypatch.setattr(filtering, "_OUT_OF_CORE_BYTES", 4 * 20_000 * 8 - 1)
+
+    assert needs_out_of_core(raw)
+    assert not needs_out_of_core(raw.copy().load_data())
+    monkeypatch.setattr(filtering, "_OUT_OF_CORE_BYTES", 4 * 20_000 * 8)
+    assert not needs_out_of_core(raw)
+
+@pytest.fixture
+def preview_cache(monkeypatch):
+    monkeypatch.setattr(filtering, "_preview_blocks", OrderedDict())
+    monkeypatch.setattr(filtering, "_preview_bytes", 0)
+    # Pages ahead are filtered right away instead of in the background
+    monkeypatch.setattr(filtering.worker_pool, "submit", lambda fn, *args, **kwargs: fn(*args, **kwargs))
+    return filtering._preview_blocks
+
+@pytest.fixture
+def count_filtered(monkeypatch):
+    windows = []
+    filtered = filtering._WindowFilter.filtered
+    def counting(self, start, stop):
+        windows.append((start, stop))
+        return filtered(self, start, stop)
+    monkeypatch.setattr(filtering._WindowFilter, "filtered", counting)
+    return windows
+
+@pytest.mark.parametrize("start, stop", ((0, 1000), (1234, 3456), (18_500, 20_000), (19_000, 25_000)))
+def test_window_same_as_raw_filter(tmp_path, preview_cache, start, stop):
+    raw = _saved_raw(tmp_path)
+    expected = raw.copy().load_data().filter(1., 40.).get_data(start=start, stop=stop)
+
+    got = filter_window(raw, 1., 40., start, stop, "a")
+
+    np.testing.assert_allclose(got, expected, rtol=0, atol=1e-9 * np.abs(expected).max())
+
+def test_window_across_annotation(tmp_path, preview_cache):
+    raw = _saved_raw(tmp_path, annotations=mne.Annotations([20.], [4.], ["bad_acq_skip"]))
+    expected = raw.copy().load_data().filter(1., 40.).get_data(start=4500, stop=6500)
+
+    got = filter_window(raw, 1., 40., 4500, 6500, "a")
+
+    np.testing.assert_allclose(got, expected, rtol=0, atol=1e-9 * np.abs(expected).max())
+
+def test_blocks_are_cached_and_filtered_ahead(tmp_path, preview_cache, count_filtered):
+    raw = _saved_raw(tmp_path)
+    block_len = filtering._block_len(raw)
+    filter_window(raw, 1., 40., 2 * block_len, 3 * block_len, "a")
+    # The page and the pages before and after it
+    assert sorted(key[-1] for key in preview_cache) == [1, 2, 3]
+    n_filtered = len(count_filtered)
+
+    filter_window(raw, 1., 40., 2 * block_len + 10, 3 * block_len + 10, "a")
+    assert len(count_filtered) == n_filtered + 1
+    assert count_filtered[-1] == (4 * block_len, 5 * block_len)
+
+    # Another filter or another state of the samples is filtered again
+    filter_window(raw, 1., 30., 2 * block_len, 3 * block_len, "a")
+    filter_window(raw, 1., 40., 2 * block_len, 3 * block_len, "b")
+    assert len(preview_cache) == 10
+
+def test_cache_stays_within_budget(tmp_path, preview_cache, monkeypatch):
+    raw = _saved_raw(tmp_path)
+    block_len = filtering._block_len(raw)
+    block_bytes = raw.info["nchan"] * block_len * 8
+    monkeypatch.setattr(filtering, "_PREVIEW_CACHE_BYTES", 4 * block_bytes)
+
+    for start in range(0, raw.n_times, block_len):
+        filter_window(raw, 1., 40., start, start + block_len, "a")
+
+    assert filtering._preview_bytes <= 4 * block_bytes
+    assert filtering._preview_bytes == sum(data.nbytes for data in preview_cache.values())
+    # The blocks used last are kept
+    last = (raw.n_times - 1) // block_len
+    assert last in [key[-1] for key in preview_cache]
+
+def test_no_filter_reads_samples(tmp_path, preview_cache):
+    raw = _saved_raw(tmp_path)
+
+    np.testing.assert_array_equal(filter_window(raw, None, None, 100, 200, "a"), raw.get_data(start=100, stop=200))
+    assert len(preview_cache) == 0
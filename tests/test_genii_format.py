@@ -0,0 +1,101 @@
+import os
+
+import mne
+import numpy as np
+import pytest
+
+from genii_format import commit_genii, current_genii, read_genii, remove_genii, is_file_backed, RawGenii
+
+def _info(n_channels: int = 4) -> mne.Info:
+    return mne.create_info([f"E{i}" for i in range(n_channels)], 100., "eeg")
+
+def _raw() -> mne.io.BaseRaw:
+    data = np.random.default_rng(0).standard_normal((4, 1000)) * 1e-5
+    raw = mne.io.RawArray(data, _info(), first_samp=50)
+    raw.set_annotations(mne.Annotations([1., 3.], [0.5, 0.], ["spike", "blink"], orig_time=None))
+    raw.info["bads"] = ["E2"]
+    raw.info["temp"] = {"state": {"highpass": 0.5, "lowpass": 40.}}
+    return raw
+
+def _epochs(metadata=None) -> mne.BaseEpochs:
+    data = np.random.default_rng(1).standard_normal((6, 4, 20)) * 1e-5
+    events = np.column_stack([np.arange(6) * 100, np.zeros(6, int), [1, 2, 1, 2, 1, 2]])
+    ep = mne.EpochsArray(data, _info(), events=events, tmin=-0.05, event_id={"a": 1, "b": 2}, metadata=metadata)
+    ep.drop([1, 4], reason="USER")
+    return ep
+
+def test_raw_round_trip(tmp_path):
+    raw = _raw()
+
+    commit_genii(raw, str(tmp_path / "a.genii"))
+    got = read_genii(str(tmp_path / "a.genii"))
+
+    assert isinstance(got, RawGenii) and not got.preload
+    assert got.first_samp == raw.first_samp
+    # Samples are stored as float32
+    np.testing.assert_allclose(got.get_data(), raw.get_data(), rtol=1e-6)
+    np.testing.assert_allclose(got.annotations.onset, raw.annotations.onset)
+    assert list(got.annotations.description) == list(raw.annotations.description)
+    assert got.info["bads"] == ["E2"]
+    assert got.info["temp"] == raw.info["temp"]
+
+def test_epochs_round_trip(tmp_path):
+    ep = _epochs()
+
+    commit_genii(ep, str(tmp_path / "a-epo.genii"))
+    got = read_genii(str(tmp_path / "a-epo.genii"))
+
+    np.testing.assert_array_equal(got.get_data(), ep.get_data())
+    assert is_file_backed(got._data)
+    np.testing.assert_array_equal(got.events, ep.events)
+    np.testing.assert_array_equal(got.selection, ep.selection)
+    assert got.drop_log == ep.drop_log
+    assert got.event_id == ep.event_id
+    assert got.tmin == pytest.approx(ep.tmin)
+
+def test_epochs_metadata_round_trip(tmp_path):
+    pd = pytest.importorskip("pandas")
+    ep = _epochs(pd.DataFrame({"rt": np.arange(6) * 0.1, "side": list("lrlrlr")}))
+
+    commit_genii(ep, str(tmp_path / "a-epo.genii"))
+    got = read_genii(str(tmp_path / "a-epo.genii"))
+
+    pd.testing.assert_frame_equal(got.metadata, ep.metadata)
+
+def test_evoked_round_trip(tmp_path):
+    ev = _epochs().average()
+
+    commit_genii(ev, str(tmp_path / "a-ave.genii"))
+    got = read_genii(str(tmp_path / "a-ave.genii"))
+
+    np.testing.assert_array_equal(got.data, ev.data)
+    assert got.nave == ev.nave
+    assert got.comment == ev.comment
+    assert got.tmin == pytest.approx(ev.tmin)
+
+def test_commit_replaces_current_version(tmp_path):
+    path = str(tmp_path / "a.genii")
+    raw = _raw()
+    first = commit_genii(raw, path)
+    opened = read_genii(path)
+    raw.info["bads"] = []
+
+    second = commit_genii(raw, path)
+    third = commit_genii(raw, path)
+
+    assert current_genii(path) == third
+    assert read_genii(path).info["bads"] == []
+    # One superseded version is kept for readers that still use it
+    assert not os.path.exists(first)
+    assert os.path.isdir(second)
+    assert opened.get_data().shape == (4, 1000)
+
+def test_missing_copy(tmp_path):
+    path = str(tmp_path / "a.genii")
+    assert current_genii(path) is None
+    with pytest.raises(FileNotFoundError):
+        read_genii(path)
+
+    commit_genii(_raw(), path)
+    remove_genii(path)
+    assert current_genii(path) is None
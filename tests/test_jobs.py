@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+
+import pytest
+
+flask = pytest.importorskip("flask")
+
+from db.data_structure import UserData
+
+def ok(job, x):
+    job.progress(0.5, "half")
+    return {"x": x, "user": flask.g.user_data["name"]}
+
+def slow(job):
+    for i in range(200):
+        time.sleep(0.05)
+        job.progress(i / 200, f"step {i}")
+    return {}
+
+def boom(job):
+    raise ValueError("bad")
+
+@pytest.fixture(scope="module")
+def jobs(tmp_path_factory):
+    # Job processes import jobs on their own, they find the database through the environment
+    db_path = str(tmp_path_factory.mktemp("jobs") / "jobs.sqlite3")
+    env = {"GENII_JOB_DB": db_path, "GENII_JOB_WORKERS": "1"}
+    old = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    import jobs
+    jobs._DB_PATH, jobs._WORKERS, jobs._schema_ready = db_path, 1, False
+    yield jobs
+    if jobs._executor is not None:
+        jobs._executor.shutdown(cancel_futures=True)
+        jobs._executor = None
+    for k, v in old.items():
+        if v is None:
+            os.environ.pop(k, None)
+        else:
+            os.environ[k] = v
+
+def _login(user_id: int, name: str):
+    user = UserData(user_id, name, f"{name}@example.com", "secret", "token")
+    user.wd = os.getcwd()
+    flask.g.user_data = user
+
+@pytest.fixture(params=("one pool", "pool per job"))
+def pools(request, jobs, monkeypatch):
+    # A pool per job is how jobs run before Python 3.11, see jobs._ONE_POOL
+    monkeypatch.setattr(jobs, "_ONE_POOL", request.param == "one pool")
+    monkeypatch.setattr(jobs, "_job_slots", threading.BoundedSemaphore(1))
+
+@pytest.fixture
+def alice(jobs):
+    with flask.Flask(__name__).app_context():
+        _login(1, "alice")
+        yield
+
+def _wait(jobs, job_ids, timeout=120.):
+    end = time.time() + timeout
+    while time.time() < end:
+        found = {j["id"]: j for j in jobs.user_jobs()}
+        if all(found[i]["status"] not in (jobs.QUEUED, jobs.RUNNING) for i in job_ids):
+            return found
+        time.sleep(0.1)
+    raise TimeoutError(job_ids)
+
+def test_result_is_taken_once(jobs, pools, alice):
+    job_id = jobs.submit("test", "ok", ok, 3)
+
+    assert _wait(jobs, [job_id])[job_id]["status"] == jobs.DONE
+    assert jobs.take_result(job_id) == {"x": 3, "user": "alice"}
+    assert jobs.take_result(job_id) is None
+    assert not jobs.cancel(job_id)
+
+def test_failure_is_reported(jobs, alice):
+    job_id = jobs.submit("test", "boom", boom)
+
+    job = _wait(jobs, [job_id])[job_id]
+    assert job["status"] == jobs.FAILED and job["message"] == "ValueError: bad"
+    assert jobs.take_result(job_id) is None
+
+def test_cancel_running_and_queued(jobs, pools, alice):
+    running = jobs.submit("test", "slow", slow)
+    # One job process, this one waits for the first
+    queued = jobs.submit("test", "queued", ok, 4)
+    end = time.time() + 60
+    while next(j for j in jobs.user_jobs() if j["id"] == running)["progress"] == 0:
+        assert time.time() < end
+        time.sleep(0.05)
+
+    assert jobs.cancel(queued)
+    assert jobs.cancel(running)
+
+    found = _wait(jobs, [running, queued])
+    assert found[running]["status"] == found[queued]["status"] == jobs.CANCELLED
+    # Stopped at a progress report
+    assert 0 < found[running]["progress"] < 1
+    assert found[queued]["progress"] == 0
+
+def test_jobs_of_other_users(jobs, alice):
+    job_id = jobs.submit("test", "slow", slow)
+
+    _login(2, "bob")
+    assert job_id not in [j["id"] for j in jobs.user_jobs()]
+    assert not jobs.cancel(job_id)
+
+    _login(1, "alice")
+    assert jobs.cancel(job_id)
+    assert _wait(jobs, [job_id])[job_id]["status"] == jobs.CANCELLED
+
+def test_jobs_of_a_dead_process_fail(jobs, alice, monkeypatch):
+    from contextlib import closing
+    jobs._update(
+        "INSERT INTO job(user_id, kind, label, status, owner_pid, created) VALUES (?, ?, ?, ?, ?, ?)",
+        ("1", "test", "orphan", jobs.RUNNING, 1 << 30, time.time())
+    )
+    monkeypatch.setattr(jobs, "_pid_alive", lambda pid: pid != 1 << 30)
+    # Polling only reads
+    assert jobs.user_jobs()[0]["status"] == jobs.RUNNING
+
+    with closing(jobs._connect()) as con:
+        jobs._prune(con)
+
+    assert jobs.user_jobs()[0]["status"] == jobs.FAILED
@@ -0,0 +1,107 @@
+import json
+
+import mne
+import numpy as np
+import pytest
+
+pytest.importorskip("flask")
+
+from db.data_structure import File, FileType
+from db.memcached_util import _JOURNAL_EXT, _read_journal, _replay_journal, _truncate_journal
+from file_io import apply_edit
+
+_EDITS = [
+    {"op": "annot_add", "onset": 1., "duration": 0.5, "description": "spike"},
+    {"op": "annot_add", "onset": 2., "duration": 0., "description": "blink"},
+    {"op": "annot_del", "onset": 2., "duration": 0., "description": "blink"},
+    {"op": "bads", "ch": "E1", "bad": True},
+    {"op": "bads", "ch": "E2", "bad": True},
+    {"op": "bads", "ch": "E2", "bad": False},
+    {"op": "display", "preview": {"highpass": 1., "lowpass": 30.}, "montage": "average"},
+]
+
+def _raw() -> mne.io.BaseRaw:
+    info = mne.create_info([f"E{i}" for i in range(4)], 100., "eeg")
+    return mne.io.RawArray(np.zeros((4, 1000)), info)
+
+def _epochs() -> mne.BaseEpochs:
+    info = mne.create_info([f"E{i}" for i in range(4)], 100., "eeg")
+    return mne.EpochsArray(np.zeros((5, 4, 10)), info)
+
+def _state(raw) -> tuple:
+    annotations = raw.annotations
+    return (
+        list(zip(annotations.onset, annotations.duration, annotations.description)),
+        list(raw.info["bads"]),
+        raw.info.get("temp"),
+    )
+
+def _write_journal(cached_item_path, ops):
+    with open(str(cached_item_path) + _JOURNAL_EXT, "w", encoding="utf-8") as f:
+        for ts, op in enumerate(ops, 1):
+            f.write(json.dumps({"ts": ts, **op}) + "\n")
+
+def test_edits_are_idempotent():
+    once = _raw()
+    for op in _EDITS:
+        apply_edit(once, op)
+    twice = _raw()
+    for op in _EDITS + _EDITS:
+        apply_edit(twice, op)
+
+    assert _state(once) == _state(twice) == (
+        [(1., 0.5, "spike")], ["E1"], {"preview": {"highpass": 1., "lowpass": 30.}, "montage": "average"}
+    )
+
+def test_drop_is_idempotent():
+    ep = _epochs()
+    op = {"op": "drop", "selection": [1, 3]}
+
+    apply_edit(ep, op)
+    apply_edit(ep, op)
+
+    assert list(ep.selection) == [0, 2, 4]
+
+def test_replay_onto_object_that_has_some_edits(tmp_path):
+    cached_item_path = tmp_path / "a_raw.fif"
+    _write_journal(cached_item_path, _EDITS)
+    expected = _raw()
+    for op in _EDITS:
+        apply_edit(expected, op)
+    partial = _raw()
+    for op in _EDITS[:4]:
+        apply_edit(partial, op)
+    file = File(partial, FileType.RAW, False, str(cached_item_path))
+
+    n_edits = _replay_journal(str(cached_item_path), file)
+
+    assert n_edits == len(_EDITS) - 1
+    assert file.dirty
+    assert _state(file.item) == _state(expected)
+
+def test_display_edits_leave_the_object_clean(tmp_path):
+    cached_item_path = tmp_path / "a_raw.fif"
+    _write_journal(cached_item_path, _EDITS[-1:])
+    file = File(_raw(), FileType.RAW, False, str(cached_item_path))
+
+    assert _replay_journal(str(cached_item_path), file) == 0
+    assert not file.dirty
+    assert file.item.info["temp"]["montage"] == "average"
+
+def test_torn_last_line_is_skipped(tmp_path):
+    cached_item_path = tmp_path / "a_raw.fif"
+    _write_journal(cached_item_path, _EDITS[:2])
+    with open(str(cached_item_path) + _JOURNAL_EXT, "a", encoding="utf-8") as f:
+        f.write('{"ts": 3, "op": "ba')
+
+    assert [op["ts"] for op in _read_journal(str(cached_item_path))] == [1, 2]
+
+def test_truncate_keeps_newer_edits(tmp_path):
+    cached_item_path = tmp_path / "a_raw.fif"
+    _write_journal(cached_item_path, _EDITS)
+
+    _truncate_journal(str(cached_item_path), 4)
+    assert [op["ts"] for op in _read_journal(str(cached_item_path))] == [5, 6, 7]
+
+    _truncate_journal(str(cached_item_path), 7)
+    assert _read_journal(str(cached_item_path)) == []
@@ -0,0 +1,123 @@
+import json
+
+import mne
+import numpy as np
+import pytest
+
+from workflow import montage
+from workflow.montage import _build, montage_window, recorded_channel, apply_montage, load_montages
+
+_NAMES = ["Fp1", "Fp2", "F7", "F3", "Cz", "T7", "C4", "O1", "EOG", "STI"]
+_TYPES = ["eeg"] * 8 + ["eog", "stim"]
+
+def _raw(bads=()) -> mne.io.BaseRaw:
+    data = np.random.default_rng(0).standard_normal((len(_NAMES), 500)) * 1e-5
+    raw = mne.io.RawArray(data, mne.create_info(_NAMES, 100., _TYPES))
+    raw.info["bads"] = list(bads)
+    return raw
+
+def _shown(raw, definition):
+    op = _build(definition, tuple(raw.ch_names), tuple(raw.get_channel_types()), tuple(raw.info["bads"]))
+    return op, op.matrix @ raw.get_data()
+
+@pytest.mark.parametrize("bads", ((), ("F3",)))
+def test_average_same_as_set_eeg_reference(bads):
+    raw = _raw(bads)
+    expected = raw.copy().set_eeg_reference("average", projection=False)
+
+    op, shown = _shown(raw, {"type": "average"})
+
+    assert op.ch_names[:8] == _NAMES[:8]
+    np.testing.assert_allclose(shown[:8], expected.get_data(picks=_NAMES[:8]), rtol=1e-12, atol=1e-18)
+    assert op.bads == list(bads)
+
+def test_reference_same_as_set_eeg_reference():
+    raw = _raw()
+    expected = raw.copy().set_eeg_reference(["Cz"], projection=False)
+
+    _, shown = _shown(raw, {"type": "reference", "ref": ["cz"]})
+
+    np.testing.assert_allclose(shown[:8], expected.get_data(picks=_NAMES[:8]), rtol=1e-12, atol=1e-18)
+
+def test_bipolar_same_as_set_bipolar_reference():
+    raw = _raw(("F3",))
+    # T3 is the old name of T7, Pz is not recorded
+    pairs = [["Fp1", "F7"], ["F7", "T3"], ["Fp1", "F3"], ["Cz", "Pz"]]
+    expected = mne.set_bipolar_reference(raw.copy(), ["Fp1", "F7", "Fp1"], ["F7", "T7", "F3"], drop_refs=False)
+
+    op, shown = _shown(raw, {"type": "bipolar", "pairs": pairs})
+
+    assert op.ch_names[:3] == ["Fp1-F7", "F7-T7", "Fp1-F3"]
+    np.testing.assert_allclose(shown[:3], expected.get_data(picks=op.ch_names[:3]), rtol=1e-12, atol=1e-18)
+    assert op.bads == ["Fp1-F3"]
+    # Channels no pair reads are shown as recorded
+    assert op.ch_names[3:] == ["Fp2", "Cz", "C4", "O1", "EOG", "STI"]
+    np.testing.assert_array_equal(shown[3:], raw.get_data(picks=op.ch_names[3:]))
+
+def test_laplacian_skips_bad_neighbours():
+    raw = _raw(("F3",))
+    data = raw.get_data()
+
+    op, shown = _shown(raw, {"type": "laplacian", "neighbors": {"Fp1": ["Fp2", "F3", "F7"], "Fp2": ["F3"]}})
+
+    assert op.ch_names[0] == "Fp1"
+    np.testing.assert_allclose(shown[0], data[0] - (data[1] + data[2]) / 2)
+    # No good neighbour, shown as recorded
+    assert op.ch_names[1] == "Fp2"
+    np.testing.assert_array_equal(shown[1], data[1])
+    assert op.anchors[1] == 1 and op.is_anchor[1]
+
+def test_custom():
+    raw = _raw()
+    data = raw.get_data()
+
+    op, shown = _shown(raw, {"type": "custom", "channels": {"front": {"Fp1": 0.5, "Fp2": 0.5}, "gone": {"Pz": 1}}})
+
+    assert op.ch_names[0] == "front" and "gone" not in op.ch_names
+    np.testing.assert_allclose(shown[0], (data[0] + data[1]) / 2)
+
+def test_unknown_type():
+    with pytest.raises(ValueError):
+        _build({"type": "nope"}, tuple(_NAMES), tuple(_TYPES), ())
+
+@pytest.fixture
+def montage_dir(tmp_path, monkeypatch):
+    with open(tmp_path / "pairs.json", "w", encoding="utf-8") as f:
+        json.dump({"label": "Pairs", "type": "bipolar", "pairs": [["Fp1", "F7"], ["F3", "Cz"]]}, f)
+    monkeypatch.setattr(montage, "_MONTAGE_DIR", str(tmp_path))
+    return tmp_path
+
+def test_window_of_epochs(montage_dir):
+    raw = _raw()
+    ep = mne.make_fixed_length_epochs(raw, duration=1., preload=True)
+    ep.info["temp"] = {"montage": "pairs"}
+
+    names, bads, shown = montage_window(ep, ep.get_data())
+
+    assert names[:2] == ["Fp1-F7", "F3-Cz"] and bads == []
+    np.testing.assert_allclose(shown[:, 1], ep.get_data(picks="F3")[:, 0] - ep.get_data(picks="Cz")[:, 0])
+    assert recorded_channel(ep, 0) is None
+    assert recorded_channel(ep, 2) == names[2]
+
+def test_apply_montage_to_raw(montage_dir):
+    raw = _raw(("F3",))
+    raw.info["temp"] = {"montage": "pairs", "state": {"highpass": 0., "lowpass": 50.}}
+
+    shown = apply_montage(raw)
+
+    assert shown.ch_names[:2] == ["Fp1-F7", "F3-Cz"]
+    assert shown.info["bads"] == ["F3-Cz"]
+    assert shown.info["temp"] == {"state": {"highpass": 0., "lowpass": 50.}}
+    np.testing.assert_allclose(shown.get_data(picks="Fp1-F7")[0], raw.get_data(picks="Fp1")[0] - raw.get_data(picks="F7")[0])
+
+def test_missing_montage_shows_recorded_channels(montage_dir):
+    raw = _raw()
+    raw.info["temp"] = {"montage": "gone"}
+
+    names, _, shown = montage_window(raw, raw.get_data())
+
+    assert names == _NAMES
+    np.testing.assert_array_equal(shown, raw.get_data())
+
+def test_shipped_montages_load():
+    assert {"average", "cz", "double_banana", "laplacian"} <= set(load_montages())
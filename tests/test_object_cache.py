@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("flask")
+
+from db.data_structure import File, FileType
+from db.memcached_util import _ObjectCache, _MEM_CACHE_OVERHEAD
+
+_N = 1000
+
+def _file(name: str, n: int = _N, data=None) -> File:
+    item = SimpleNamespace(_data=np.zeros(n) if data is None else data)
+    return File(item, FileType.RAW, False, name)
+
+def _size(n: int = _N) -> int:
+    return _MEM_CACHE_OVERHEAD + n * 8
+
+def test_evicts_least_recently_used_over_budget():
+    cache = _ObjectCache(3 * _size())
+    for name in ("a", "b", "c"):
+        cache.put((1, name), _file(name), name)
+    # Used last, "b" is now the oldest
+    assert cache.get((1, "a")) is not None
+
+    _, evicted = cache.put((1, "d"), _file("d"), "d")
+
+    assert [e.mem_key for e in evicted] == [(1, "b")]
+    assert cache.get((1, "b")) is None
+    assert cache.n_bytes == 3 * _size()
+
+def test_newest_entry_is_kept_over_budget():
+    cache = _ObjectCache(_size())
+    cache.put((1, "a"), _file("a"), "a")
+
+    entry, evicted = cache.put((1, "big"), _file("big", 10 * _N), "big")
+
+    assert [e.mem_key for e in evicted] == [(1, "a")]
+    assert cache.get((1, "big")) is entry
+    assert cache.n_bytes == _size(10 * _N)
+
+def test_put_again_updates_entry_in_place():
+    cache = _ObjectCache(10 * _size())
+    first, _ = cache.put((1, "a"), _file("a"), "a")
+
+    second, _ = cache.put((1, "a"), _file("a", 2 * _N), "a", dirty=True)
+
+    assert second is first
+    assert cache.n_bytes == _size(2 * _N)
+    assert not second.saved and second.due
+
+def test_pop_releases_bytes():
+    cache = _ObjectCache(10 * _size())
+    cache.put((1, "a"), _file("a"), "a")
+    cache.put((1, "a", "view"), _file("a", 2 * _N), "a")
+
+    assert [e.mem_key for e in cache.pop_views((1, "a"))] == [(1, "a", "view")]
+    assert cache.pop((1, "a")) is not None
+    assert cache.n_bytes == 0
+
+def test_file_backed_samples_do_not_count(tmp_path):
+    data = np.memmap(tmp_path / "data.bin", dtype=np.float64, mode="w+", shape=(10 * _N,))
+    cache = _ObjectCache(_size())
+
+    cache.put((1, "mapped"), _file("mapped", data=data), "mapped")
+
+    assert cache.n_bytes == _MEM_CACHE_OVERHEAD
+
+def test_make_room_only_drops_preloaded_entries_of_the_user():
+    cache = _ObjectCache(100 * _size())
+    cache.put((1, "a"), _file("a"), "a")
+    cache.put((1, "small"), _file("small", 0), "small")
+    cache.put((2, "b"), _file("b"), "b")
+    cache.put((1, "c"), _file("c"), "c")
+
+    evicted = cache.make_room(1, _size(), _size(), keep_key=(1, "c"))
+
+    assert [e.mem_key for e in evicted] == [(1, "a")]
+    assert cache.get((2, "b")) is not None
+    assert cache.get((1, "small")) is not None
+
+def test_recaching_the_same_object_keeps_it_saved():
+    cache = _ObjectCache(10 * _size())
+    file = _file("a")
+    entry, _ = cache.put((1, "a"), file, "a", has_disk_copy=True)
+    entry.saved = True
+
+    # A render caches the object it shows again, wrapped in a new File
+    cache.put((1, "a"), File(file.item, FileType.RAW, False, "a"), "a", has_disk_copy=True)
+    assert entry.saved
+
+    # Another object than the one on disk, its disk copy is outdated
+    cache.put((1, "a"), _file("a"), "a", has_disk_copy=True)
+    assert not entry.saved
@@ -0,0 +1,44 @@
+import mne
+import numpy as np
+import pytest
+
+pytest.importorskip("flask")
+
+from db import memcached_util
+from file_io import read_check_and_cache_file, ensure_preloaded
+
+def _save_raw(path, n_times: int = 10_000):
+    info = mne.create_info([f"E{i}" for i in range(4)], 100., "eeg")
+    mne.io.RawArray(np.random.default_rng(0).standard_normal((4, n_times)) * 1e-5, info).save(path)
+
+def test_raw_is_opened_disk_backed(user, tmp_path):
+    path = str(tmp_path / "a_raw.fif")
+    _save_raw(path)
+
+    file = read_check_and_cache_file(path)
+
+    assert not file.item.preload
+    # Windows are read from the file
+    assert file.item.get_data(start=100, stop=200).shape == (4, 100)
+
+def test_ensure_preloaded_loads_and_counts_samples(user, tmp_path, monkeypatch):
+    monkeypatch.setattr(memcached_util, "_object_cache", memcached_util._ObjectCache(1 << 30))
+    path = str(tmp_path / "a_raw.fif")
+    _save_raw(path)
+    file = read_check_and_cache_file(path)
+    before = memcached_util._object_cache.n_bytes
+
+    ensure_preloaded(file)
+
+    assert file.item.preload
+    assert memcached_util._object_cache.n_bytes - before == 4 * 10_000 * 8
+
+def test_ensure_preloaded_over_budget(user, tmp_path, monkeypatch):
+    monkeypatch.setattr(memcached_util, "_USER_PRELOAD_BYTES", 1000)
+    path = str(tmp_path / "a_raw.fif")
+    _save_raw(path)
+    file = read_check_and_cache_file(path)
+
+    with pytest.raises(MemoryError):
+        ensure_preloaded(file)
+    assert not file.item.preload
@@ -0,0 +1,119 @@
+"""
+App-wide pool for heavy operations (filtering, re-referencing, source estimation)
+
+Operations run on GENII_WORKERS threads (default: number of cores) and reserve cores before they start,
+so at most GENII_WORKERS cores are busy at once however many users there are
+An operation asks for up to max_cores and gets what is free (at least one), passed on as n_jobs,
+MNE then splits the channels over that many joblib threads (the arrays are shared, not copied to processes)
+Without joblib every operation gets one core
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import nullcontext
+from typing import Callable
+
+try:
+    import joblib
+except ImportError:
+    joblib = None
+
+_WORKERS = max(int(os.environ.get("GENII_WORKERS", os.cpu_count() or 1)), 1)
+
+class _Cores():
+    """
+    Counting semaphore that hands out as many units as are free, up to the number asked for
+    """
+
+    def __init__(self, n: int):
+        self.n_free = n
+        self._cond = threading.Condition()
+
+    def acquire(self, n: int) -> int:
+        with self._cond:
+            self._cond.wait_for(lambda: self.n_free > 0)
+            n = min(n, self.n_free)
+            self.n_free -= n
+            return n
+
+    def release(self, n: int):
+        with self._cond:
+            self.n_free += n
+            self._cond.notify_all()
+
+_cores = _Cores(_WORKERS)
+_executor = None
+_executor_lock = threading.Lock()
+# Set on the threads of the pool, an operation running there runs the operations it starts itself
+_local = threading.local()
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_WORKERS, thread_name_prefix="worker", initializer=_init_worker)
+        return _executor
+
+def _init_worker():
+    _local.in_pool = True
+
+def _threading_backend():
+    # parallel_config() is joblib >= 1.3, parallel_backend() is deprecated there
+    if hasattr(joblib, "parallel_config"):
+        return joblib.parallel_config(backend="threading")
+    return joblib.parallel_backend("threading")
+
+def _run(fn: Callable, args, kwargs, max_cores: int):
+    n_cores = _cores.acquire(max_cores)
+    try:
+        if max_cores == 1:
+            return fn(*args, **kwargs)
+        # joblib keeps its backend per thread, other operations are not affected
+        with _threading_backend() if n_cores > 1 else nullcontext():
+            return fn(*args, n_jobs=n_cores, **kwargs)
+    finally:
+        _cores.release(n_cores)
+
+def submit(fn: Callable, *args, max_cores: int = 1, **kwargs) -> Future:
+    """
+    Run fn(*args, **kwargs) on the pool once a core is free
+
+    Nothing in fn may depend on flask.g, it runs on another thread
+
+    max_cores: int = 1
+        If > 1, fn takes n_jobs and is called with the number of cores it was granted (1 to max_cores)
+    """
+    max_cores = max(min(max_cores, _WORKERS), 1)
+    if joblib is None and max_cores > 1:
+        max_cores = 1
+        kwargs = dict(kwargs, n_jobs=1)
+    if getattr(_local, "in_pool", False):
+        # Waiting for the pool from the pool could wait forever, the cores of the caller are used instead
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs) if max_cores == 1 else fn(*args, n_jobs=1, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+    return _get_executor().submit(_run, fn, args, kwargs, max_cores)
+
+def run(fn: Callable, *args, max_cores: int = 1, **kwargs):
+    """
+    submit() and wait for the result, e.g. from a callback
+    """
+    return submit(fn, *args, max_cores=max_cores, **kwargs).result()
+
+def n_workers() -> int:
+    return _WORKERS
+
+def limit_workers(n: int):
+    """
+    Use at most n cores from now on, before the first operation of the process (job processes, see jobs.py)
+    """
+    global _WORKERS, _cores
+    with _executor_lock:
+        if _executor is not None:
+            raise RuntimeError("The pool is already running")
+        _WORKERS = max(n, 1)
+        _cores = _Cores(_WORKERS)
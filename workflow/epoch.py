@@ -2,10 +2,10 @@ import mne
 import dash_bootstrap_components as dbc
 from .util import plot_to_base64
 from dash import html, callback, Input, Output, State, ctx, no_update, dcc, MATCH, ALL
-from file_io import read_and_cache_file, cache_file
+from file_io import read_and_cache_file, read_original_file, cache_file, journal_file
 from db.data_structure import FileType, File
 import os
-from layout_impl.main_body import append_to_tabs
+import jobs
 from workflow.evoked import render_evoked_content
 from path_based_id_util import make_id, make_generic_id, decode_path
 from layout_impl.reusable import OnceInterval
@@ -15,7 +15,8 @@ from plotly.graph_objs import Layout, Scatter, Figure
 from plotly.graph_objs.layout import YAxis, Annotation, Font, shape
 
 from .plotting_util import decide_ch_color
-from .general import render_general_function
+from .general import render_general_function, view_of, open_view
+from .montage import montage_window
 
 from datetime import datetime
 
@@ -228,11 +229,12 @@ def render_epoch_graph(_, start_idx, page_len, id):
     else:
         # print(filt)
         data = view.get_data(copy=True)[start_idx:end_idx]
+    ch_names, bads, data = montage_window(epoch, data)
     concatenated_data = np.concatenate([d for d in data], axis=1)
     # print(concatenated_data.shape)
 
     #TODO mostly copied from raw render plot, can be pulled out to be a util function 
-    step = 1. / epoch.info["nchan"]
+    step = 1. / len(ch_names)
     kwargs = dict(domain=[1 - step, 1], showticklabels=False, zeroline=False, showgrid=False, visible=False)
 
     # FIXME ???
@@ -248,13 +250,13 @@ def render_epoch_graph(_, start_idx, page_len, id):
         x=times,
         y=concatenated_data.T[:, 0],
         line={
-            "color": decide_ch_color(epoch.info["ch_names"][0], epoch.info["bads"]),
+            "color": decide_ch_color(ch_names[0], bads),
             "width": 1
         }
     )]
 
     # loop over the channels
-    for ii in range(1, epoch.info["nchan"]):
+    for ii in range(1, len(ch_names)):
             kwargs.update(domain=[1 - (ii + 1) * step, 1 - ii * step])
             layout.update({'yaxis%d' % (ii + 1): YAxis(kwargs), 'showlegend': False})
             traces.append(Scatter(
@@ -262,7 +264,7 @@ def render_epoch_graph(_, start_idx, page_len, id):
                 y=concatenated_data.T[:, ii],
                 yaxis='y%d' % (ii + 1),
                 line={
-                    "color": decide_ch_color(epoch.info["ch_names"][ii], epoch.info["bads"]),
+                    "color": decide_ch_color(ch_names[ii], bads),
                     "width": 1
                 }
             ))
@@ -273,7 +275,7 @@ def render_epoch_graph(_, start_idx, page_len, id):
             x=-0.06, y=0, xref='paper', yref='y%d' % (ii + 1),
             text=ch_name,
             showarrow=False
-        ) for ii, ch_name in enumerate(epoch.info["ch_names"])
+        ) for ii, ch_name in enumerate(ch_names)
     ]
 
     layout.update(annotations=annotations, margin=dict(l=60, r=20, t=20, b=20),)
@@ -326,32 +328,51 @@ def render_epoch_graph(_, start_idx, page_len, id):
     return fig, "hide"
 
 @callback(
-    Output("content-tabs", "children", allow_duplicate=True),
-    Output("content-tabs", "value", allow_duplicate=True),
+    Output("job-poll-interval", "disabled", allow_duplicate=True),
     Input("compute-evoked-info-collector", "data"),
-    State({"type": "content-tab-list", "index": ALL}, "value"),
     prevent_initial_call=True
 )
-def compute_evoked(info, tab_values):
+def compute_evoked(info):
     # print(info)
     if info is None:
         return no_update
     path = decode_path(info)
-    ep = read_and_cache_file(path)
+    # Runs in the background, the job panel opens the evoked when it is ready
+    # The job opens the epochs as they are shown here, nothing is flushed before (see open_view())
+    jobs.submit("compute_evoked", "Evoked of " + os.path.basename(path), _compute_evoked_job, path, view_of(path))
+    # Wakes the job panel up
+    return False
+
+def _compute_evoked_job(job, path, view):
+    job.progress(0., "Opening the epochs")
+    ep = open_view(path, view).item
+    job.progress(0.3, "Averaging")
     ev = ep.average()
+    job.progress(0.8, "Saving")
     # if "temp" in ev.info:
     #     del ev.info["temp"]
     save_path = os.path.join(os.path.dirname(path), os.path.basename(path).split(".")[0])[:-4]
     # path = save_path + "-" + datetime.now().strftime("%d_%m_%y__%H_%M_%S") + "-ave.fif"
     path = save_path + "-ave.fif"
     ev.save(path, overwrite=True)
-    ev = cache_file(ev, FileType.EVOKED, True, path)
 
     # path = save_path + ??? + "-ave.fif"
     # path = save_path + "-ave-epo.fif"
     # ep.save(path, overwrite=True)
     # cache_file(ep, FileType.EPOCH, True, save_path + "-" + datetime.now().strftime("%d_%m_%y__%H_%M_%S") + "-ave-epo.fif")
-    return append_to_tabs(tab_values, *render_evoked_content(ev))
+    # info["temp"] is not saved, the filter state and the montage go with the result
+    temp = dict(ev.info.get("temp", None) or {})
+    temp.pop("montage", None)
+    if view is not None and view["montage"] is not None:
+        temp["montage"] = view["montage"]
+    return {"path": path, "temp": temp or None}
+
+def _open_evoked_result(result):
+    file = read_original_file(result["path"])
+    file.item.info["temp"] = result["temp"]
+    return render_evoked_content(cache_file(file.item, FileType.EVOKED, True, result["path"]))
+
+jobs.register_opener("compute_evoked", _open_evoked_result)
 
 # Indirectly trigger rerender of epoch using render_epoch_graph() by changing the Inputs of it
 @callback(
@@ -369,8 +390,8 @@ def drop_epochs_with_index(_, epoch_idxs):
     
     path = decode_path(ctx.triggered_id)
     ep: mne.Epochs = read_and_cache_file(path)
-    ep.drop(epoch_idxs)
-    cache_file(ep, FileType.EPOCH, True, path)
+    # Journaled by selection (original index), indices shift after every drop
+    journal_file(path, {"op": "drop", "selection": ep.selection[np.asarray(epoch_idxs or [], dtype=int)].tolist()})
     return 0, [], make_epoch_dropdown_options(ep), make_epoch_ev_count(ep)
 
 
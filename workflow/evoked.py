@@ -2,13 +2,15 @@ import mne
 import dash_bootstrap_components as dbc
 from dash import html, callback, Output, Input, State, no_update, ctx, ALL, MATCH, dcc
 from .util import plot_to_base64
-from file_io import read_and_cache_file, cache_file
+from file_io import read_and_cache_file, read_original_file, cache_file
+import worker_pool
+import jobs
 from db.data_structure import FileType
 import os
-from layout_impl.main_body import append_to_tabs 
 from workflow.esi import render_esi_content
 import numpy as np
-from .general import render_general_function
+from .general import render_general_function, view_of, open_view
+from .montage import montage_window
 
 # TODO do not include dot
 from path_based_id_util import make_id, make_generic_id, decode_path
@@ -200,8 +202,9 @@ def render_evoked_graph(_, t, id):
     #     data = evoked.get_data()
     # else:
     #     data = view.get_data()
+    ch_names, bads, data = montage_window(evoked, data)
 
-    step = 1. / evoked.info["nchan"]
+    step = 1. / len(ch_names)
     kwargs = dict(domain=[1 - step, 1], showticklabels=False, zeroline=False, showgrid=False, visible=False)
 
     # create objects for layout and traces
@@ -229,13 +232,13 @@ def render_evoked_graph(_, t, id):
         x=evoked.times,
         y=data.T[:, 0],
         line={
-            "color": decide_ch_color(evoked.info["ch_names"][0], evoked.info["bads"]),
+            "color": decide_ch_color(ch_names[0], bads),
             "width": 1
         }
     )]
 
     # loop over the channels
-    for ii in range(1, evoked.info["nchan"]):
+    for ii in range(1, len(ch_names)):
             kwargs.update(domain=[1 - (ii + 1) * step, 1 - ii * step])
             layout.update({'yaxis%d' % (ii + 1): YAxis(kwargs), 'showlegend': False})
             traces.append(Scatter(
@@ -243,7 +246,7 @@ def render_evoked_graph(_, t, id):
                 y=data.T[:, ii],
                 yaxis='y%d' % (ii + 1),
                 line={
-                    "color": decide_ch_color(evoked.info["ch_names"][ii], evoked.info["bads"]),
+                    "color": decide_ch_color(ch_names[ii], bads),
                     "width": 1
                 }
             ))
@@ -254,7 +257,7 @@ def render_evoked_graph(_, t, id):
             x=-0.16, y=0, xref='paper', yref='y%d' % (ii + 1),
             text=ch_name,
             showarrow=False
-        ) for ii, ch_name in enumerate(evoked.info["ch_names"])
+        ) for ii, ch_name in enumerate(ch_names)
     ]
 
 
@@ -323,13 +326,11 @@ def change_chosen_alg(_):
     return ctx.triggered_id["index"]
 
 @callback(
-    Output("content-tabs", "children", allow_duplicate=True),
-    Output("content-tabs", "value", allow_duplicate=True),
+    Output("job-poll-interval", "disabled", allow_duplicate=True),
     Input("perform-esi-info-collector", "data"),
-    State({"type": "content-tab-list", "index": ALL}, "value"),
     prevent_initial_call=True
 )
-def perform_esi(info, tab_values):
+def perform_esi(info):
     # print(info)
     if info is None:
         return no_update
@@ -338,29 +339,62 @@ def perform_esi(info, tab_values):
         return no_update # TODO error message choose an algorithm
     
     path = decode_path(info)
+    ep_path = path[:-7]+"epo.fif"
+    # Runs in the background (minutes), the job panel opens the estimate when it is ready
+    # The job opens the epochs and the evoked as they are shown here, nothing is flushed before (see open_view())
+    jobs.submit(
+        "perform_esi", info["alg_name"] + " of " + os.path.basename(path),
+        _perform_esi_job, path, info["alg_name"], view_of(ep_path), view_of(path)
+    )
+    # Wakes the job panel up
+    return False
 
+def _perform_esi_job(job, path, alg_name, ep_view, ev_view):
+    job.progress(0., "Opening the epochs")
     # ep = read_and_cache_file("-epo.".join(path.split(".")))
-    ep = read_and_cache_file(path[:-7]+"epo.fif")
-    ev = read_and_cache_file(path)
+    ep = open_view(path[:-7]+"epo.fif", ep_view).item
+    ev = open_view(path, ev_view).item
 
+    job.progress(0.05, "Fetching fsaverage")
     fs_dir = mne.datasets.fetch_fsaverage()
     subjects_dir = os.path.dirname(fs_dir)
     trans = "fsaverage"
     src = os.path.join(fs_dir, "bem", "fsaverage-vol-5-src.fif")
     bem = os.path.join(fs_dir, "bem", "fsaverage-5120-5120-5120-bem-sol.fif")
-    fwd = mne.make_forward_solution(ep.info, trans=trans, src=src, bem=bem, eeg=True, mindist=5.0, n_jobs=None)
-    cov = mne.compute_covariance(ep, tmax=0.0)
-    inv = mne.minimum_norm.make_inverse_operator(ev.info, fwd, cov, verbose=True)
-    stc = mne.minimum_norm.apply_inverse(ev, inv, method=info["alg_name"])
+    # Forward solution and covariance are split over the cores free in the shared pool
+    job.progress(0.1, "Forward solution")
+    fwd = worker_pool.run(mne.make_forward_solution, ep.info, trans=trans, src=src, bem=bem, eeg=True, mindist=5.0, max_cores=worker_pool.n_workers())
+    job.progress(0.5, "Noise covariance")
+    cov = worker_pool.run(mne.compute_covariance, ep, tmax=0.0, max_cores=worker_pool.n_workers())
+    job.progress(0.7, "Inverse operator")
+    inv = worker_pool.run(mne.minimum_norm.make_inverse_operator, ev.info, fwd, cov, verbose=True)
+    job.progress(0.85, "Applying the inverse operator")
+    stc = worker_pool.run(mne.minimum_norm.apply_inverse, ev, inv, method=alg_name)
 
     # src2 = os.path.join(fs_dir, "bem", "fsaverage-ico-5-src.fif")
     # fwd2 = mne.make_forward_solution(ep.info, trans=trans, src=src2, bem=bem, eeg=True, mindist=5.0, n_jobs=None)
     # inv2 = mne.minimum_norm.make_inverse_operator(ev.info, fwd2, cov, verbose=True)
     # stc2 = mne.minimum_norm.apply_inverse(ev, inv2, method=info["alg_name"])
     
+    job.progress(0.95, "Saving")
     stc_path = os.path.splitext(path)[0] + "-vl.stc" # FIXME when supporting more than volumetric ESI
     # stc2_path = path + "-surf.stc"
-    cache_file(stc, FileType.ESI, True, stc_path)
     stc.save(stc_path, overwrite=True)
     # cache_file(stc2, FileType.ESI, True, stc2_path)
-    return append_to_tabs(tab_values, *render_esi_content(stc, path=stc_path, subjects_dir=subjects_dir, src=src, initial_time=ev.get_peak(ch_type="eeg")[1], tmin=ev.tmin, tmax=ev.tmax, ev_path=path))
+    return {
+        "path": stc_path,
+        "subjects_dir": subjects_dir,
+        "src": src,
+        "initial_time": float(ev.get_peak(ch_type="eeg")[1]),
+        "tmin": float(ev.tmin),
+        "tmax": float(ev.tmax),
+        "ev_path": path
+    }
+
+def _open_esi_result(result):
+    # stc.save() adds its own ending to the path
+    stc = read_original_file(result["path"]).item
+    cache_file(stc, FileType.ESI, True, result["path"])
+    return render_esi_content(stc, **result)
+
+jobs.register_opener("perform_esi", _open_esi_result)
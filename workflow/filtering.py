@@ -0,0 +1,240 @@
+"""
+Out-of-core FIR filtering of a Raw, for recordings that do not fit into memory
+
+Same filter as Raw.filter() with its defaults: zero-phase FIR (firwin, hamming, automatic length and transitions),
+reflect_limited padding, segments split at "edge" / "bad_acq_skip" annotations, filtered independently
+The result is computed window by window: an output window needs the input window plus half the kernel on each side,
+at the edges of a segment the input is padded exactly like MNE pads the whole segment,
+then the window is convolved with overlap-add FFTs
+Memory is a few windows whatever the length of the recording, the result is streamed into a GENII directory
+
+The same windows back the preview of a filter in the raw viewer (filter_window()), only the pages looked at are filtered
+"""
+
+import os
+import functools
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Tuple
+import mne
+from mne.io import BaseRaw
+from scipy.signal import oaconvolve
+
+from genii_format import current_genii, commit_genii, read_genii
+from db.file_lock import FileLock
+import worker_pool
+
+try:
+    from mne._fiff.utils import _mult_cal_one
+except ImportError:
+    from mne.io.utils import _mult_cal_one
+from mne.annotations import _annotations_starts_stops
+from mne.filter import _filt_check_picks, _filt_update_info
+
+# Raws that are not preloaded and larger than this (as float64) are filtered out of core
+_OUT_OF_CORE_BYTES = int(os.environ.get("GENII_OUT_OF_CORE_BYTES", 512 << 20))
+# Same as the default of Raw.filter()
+_SKIP_BY_ANNOTATION = ("edge", "bad_acq_skip")
+# Previewed samples are filtered and cached in blocks of this length, pages can start anywhere
+_PREVIEW_BLOCK_SEC = 2.
+_PREVIEW_CACHE_BYTES = int(os.environ.get("GENII_PREVIEW_CACHE_BYTES", 256 << 20))
+
+@functools.lru_cache(maxsize=32)
+def design_kernel(sfreq: float, l_freq: float | None, h_freq: float | None, l_trans="auto", h_trans="auto") -> np.ndarray:
+    """
+    Zero-phase FIR kernel of Raw.filter() with its defaults, designed once per (sfreq, l_freq, h_freq, transitions)
+
+    The returned array is shared, it is read-only
+    """
+    h = mne.filter.create_filter(
+        None, sfreq, l_freq, h_freq,
+        l_trans_bandwidth=l_trans,
+        h_trans_bandwidth=h_trans,
+        method="fir",
+        phase="zero",
+        fir_window="hamming",
+        fir_design="firwin",
+        verbose="error"
+    )
+    h.flags.writeable = False
+    return h
+
+def needs_out_of_core(raw) -> bool:
+    return isinstance(raw, BaseRaw) and not raw.preload and raw.info["nchan"] * raw.n_times * 8 > _OUT_OF_CORE_BYTES
+
+class _WindowFilter():
+    """
+    Filters windows of a (not preloaded) Raw, the reader of a _FilteredRaw
+    """
+
+    def __init__(self, raw: BaseRaw, picks: np.ndarray, l_freq: float | None, h_freq: float | None):
+        self.raw = raw
+        self.picks = picks
+        self.h = design_kernel(float(raw.info["sfreq"]), l_freq, h_freq)
+        self.half = (len(self.h) - 1) // 2
+        onsets, ends = _annotations_starts_stops(raw, _SKIP_BY_ANNOTATION, invert=True)
+        self.segments = list(zip(onsets.tolist(), ends.tolist()))
+
+    def _read(self, start, stop) -> np.ndarray:
+        return self.raw.get_data(start=start, stop=stop)
+
+    def filtered(self, start, stop) -> np.ndarray:
+        out = self._read(start, stop)
+        for seg_start, seg_stop in self.segments:
+            a, b = max(start, seg_start), min(stop, seg_stop)
+            if a >= b:
+                continue
+            ext = self._extended(seg_start, seg_stop, a - self.half, b + self.half)
+            out[self.picks, a - start:b - start] = oaconvolve(ext, self.h[np.newaxis], mode="valid", axes=1)
+        return out
+
+    def _extended(self, seg_start, seg_stop, lo, hi) -> np.ndarray:
+        # Samples lo to hi of the segment padded the way mne.filter._smart_pad() pads it (reflect_limited):
+        # n_edge samples on each side, point-reflected around the first / last sample, zero past the reflected part
+        n = seg_stop - seg_start
+        n_edge = max(min(len(self.h), n) - 1, 0)
+        n_reflect = min(n_edge, n - 1)
+        ext = np.zeros((len(self.picks), hi - lo))
+        a, b = max(lo, seg_start), min(hi, seg_stop)
+        if a < b:
+            ext[:, a - lo:b - lo] = self._read(a, b)[self.picks]
+        n_left = min(seg_start - lo, n_reflect)
+        if n_left > 0:
+            x = self._read(seg_start, seg_start + n_left + 1)[self.picks]
+            ext[:, seg_start - lo - n_left:seg_start - lo] = (2 * x[:, :1] - x[:, 1:])[:, ::-1]
+        n_right = min(hi - seg_stop, n_reflect)
+        if n_right > 0:
+            x = self._read(seg_stop - 1 - n_right, seg_stop)[self.picks]
+            ext[:, seg_stop - lo:seg_stop - lo + n_right] = 2 * x[:, -1:] - x[:, -2::-1]
+        return ext
+
+class _FilteredRaw(BaseRaw):
+    """
+    Raw whose samples are the samples of another (not preloaded) Raw, filtered when a window of them is read
+    """
+
+    def __init__(self, raw: BaseRaw, l_freq: float | None, h_freq: float | None):
+        info = raw.info.copy()
+        update_info, picks = _filt_check_picks(info, None, l_freq, h_freq)
+        _filt_update_info(info, update_info, l_freq, h_freq)
+        super().__init__(
+            info,
+            preload=False,
+            first_samps=(raw.first_samp,),
+            last_samps=(raw.last_samp,),
+            filenames=(None,),
+            raw_extras=[{
+                "filter": _WindowFilter(raw, picks, l_freq, h_freq),
+                "cals": np.array([ch["cal"] * ch["range"] for ch in info["chs"]]),
+                "first_samp": raw.first_samp,
+            }],
+            orig_format="double",
+            verbose="error"
+        )
+        self.set_annotations(raw.annotations)
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        extras = self._raw_extras[fi]
+        # start and stop count from the first sample of the recording, the filter from the first sample of raw
+        block = extras["filter"].filtered(start - extras["first_samp"], stop - extras["first_samp"])
+        # BaseRaw expects file units, the calibration is applied again by _mult_cal_one
+        _mult_cal_one(data, block / extras["cals"][:, np.newaxis], idx, cals, mult)
+
+def filter_raw_out_of_core(raw: BaseRaw, l_freq: float | None, h_freq: float | None, path: str) -> BaseRaw:
+    """
+    Filter raw like raw.filter(l_freq, h_freq) without loading it, the result is written to the GENII directory path
+
+    Returns the filtered Raw, disk-backed (see genii_format.RawGenii)
+    raw is not changed
+
+    path: str
+        Reused as-is if it already holds a copy, so it must be named after the recording and the filter
+        (see memcached_util.derived_item_path())
+    """
+    if l_freq is None and h_freq is None:
+        return raw.copy()
+    with FileLock(path):
+        if current_genii(path) is None:
+            commit_genii(_FilteredRaw(raw, l_freq, h_freq), path)
+    with FileLock(path, shared=True):
+        return read_genii(path)
+
+# 预览：只过滤正在看的那一页
+_preview_blocks: OrderedDict[Tuple, np.ndarray] = OrderedDict()
+_preview_bytes = 0
+_preview_lock = threading.Lock()
+
+def _block_len(raw: BaseRaw) -> int:
+    return max(int(round(_PREVIEW_BLOCK_SEC * raw.info["sfreq"])), 1)
+
+def _blocks_of(raw: BaseRaw, start: int, stop: int) -> list:
+    start, stop = max(start, 0), min(stop, raw.n_times)
+    if stop <= start:
+        return []
+    return list(range(start // _block_len(raw), (stop - 1) // _block_len(raw) + 1))
+
+def _filter_blocks(raw: BaseRaw, l_freq, h_freq, key, blocks: list) -> dict:
+    # Filtered blocks (n_channels, block length) by block number, each run of missing blocks is filtered as one window
+    global _preview_bytes
+    block_len = _block_len(raw)
+    # Annotations split the recording into the segments filtered independently
+    segments = tuple(_annotations_starts_stops(raw, _SKIP_BY_ANNOTATION, invert=True)[0].tolist())
+    keys = {b: (key, l_freq, h_freq, segments, b) for b in blocks}
+    found = {}
+    with _preview_lock:
+        for block, block_key in keys.items():
+            data = _preview_blocks.get(block_key)
+            if data is not None:
+                _preview_blocks.move_to_end(block_key)
+                found[block] = data
+
+    missing = [b for b in blocks if b not in found]
+    runs = []
+    for block in missing:
+        if len(runs) > 0 and runs[-1][-1] == block - 1:
+            runs[-1].append(block)
+        else:
+            runs.append([block])
+    _, picks = _filt_check_picks(raw.info, None, l_freq, h_freq)
+    for run in runs:
+        start = run[0] * block_len
+        data = _WindowFilter(raw, picks, l_freq, h_freq).filtered(start, min((run[-1] + 1) * block_len, raw.n_times))
+        with _preview_lock:
+            for block in run:
+                found[block] = data[:, (block - run[0]) * block_len:(block - run[0] + 1) * block_len].copy()
+                old = _preview_blocks.pop(keys[block], None)
+                _preview_bytes += found[block].nbytes - (0 if old is None else old.nbytes)
+                _preview_blocks[keys[block]] = found[block]
+            while _preview_bytes > _PREVIEW_CACHE_BYTES and len(_preview_blocks) > 0:
+                _, old = _preview_blocks.popitem(last=False)
+                _preview_bytes -= old.nbytes
+    return found
+
+def filter_window(raw: BaseRaw, l_freq: float | None, h_freq: float | None, start: int, stop: int, key: Any) -> np.ndarray:
+    """
+    Samples start to stop of every channel of raw.filter(l_freq, h_freq), without filtering the rest of raw
+
+    Only the window and the padding the filter needs are read, the result is the same as filtering everything
+    Filtered blocks are cached (GENII_PREVIEW_CACHE_BYTES), the pages before and after the window are filtered ahead
+
+    key: Any
+        Hashable, identifies the samples of raw (file and processing state)
+    """
+    start, stop = max(start, 0), min(stop, raw.n_times)
+    if stop <= start:
+        return np.zeros((raw.info["nchan"], 0))
+    if l_freq is None and h_freq is None:
+        return raw.get_data(start=start, stop=stop)
+    blocks = _blocks_of(raw, start, stop)
+    found = _filter_blocks(raw, l_freq, h_freq, key, blocks)
+    data = np.concatenate([found[b] for b in blocks], axis=1)
+    offset = start - blocks[0] * _block_len(raw)
+
+    # Paging moves by half a page or a page, both ways
+    n = stop - start
+    for ahead in (_blocks_of(raw, stop, stop + n), _blocks_of(raw, start - n, start)):
+        ahead = [b for b in ahead if b not in blocks]
+        if len(ahead) > 0:
+            worker_pool.submit(_filter_blocks, raw, l_freq, h_freq, key, ahead)
+    return data[:, offset:offset + n]
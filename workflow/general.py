@@ -5,10 +5,15 @@ import dash_bootstrap_components as dbc
 from dash_iconify import DashIconify
 from path_based_id_util import make_id, make_generic_id, decode_path
 from db.data_structure import File, FileType
-from file_io import cache_file, read_check_and_cache_file, validate_access, save_mne_object, get_appropriate_ext
-from db.memcached_util import remove_cache
+from file_io import cache_file, read_check_and_cache_file, read_original_file, validate_access, save_mne_object, get_appropriate_ext, ensure_preloaded, journal_file
+from db.memcached_util import flush_cache, derived_item_path, private_derived_item_path, open_derived_item, put_view_item, get_view_item, peek_cached_item
+from genii_format import GENII_EXT
+from .filtering import needs_out_of_core, filter_raw_out_of_core, filter_window
+from .montage import montage_options, current_montage, apply_montage
+import worker_pool
 import os
 import mne
+import numpy as np
 from flask import g
 import traceback
 
@@ -102,11 +107,13 @@ def render_general_function(file: File):
                         # id=make_id(file.path, type="general-function-tab-panel", index="reference"),
                         value="reference",
                         children=(
-                            dmc.Switch(
-                                id=make_id(file.path, type="general-use-bipolar"),
-                                checked=False,
-                                label="Use bipolar reference",
-                                size="lg"
+                            html.P(children="Montage:"),
+                            dcc.Dropdown(
+                                id=make_id(file.path, type="general-montage"),
+                                options=montage_options(),
+                                value=current_montage(file.item),
+                                placeholder="Recorded reference",
+                                clearable=True
                             ),
                         )
                     ),
@@ -131,7 +138,8 @@ def raw_perform_filter(_, highpass, lowpass, id):
     if ctx.triggered_id is None:
         return no_update
     file = read_check_and_cache_file(decode_path(id))
-    return _alter_view(file, highpass=highpass, lowpass=lowpass)
+    # Only the page on screen is filtered, the whole recording once it is used for more than viewing
+    return _preview_filter(file, highpass=highpass, lowpass=lowpass)
 
 @callback(
     Output(make_generic_id(MATCH, type="epoch-once-interval"), "n_intervals", allow_duplicate=True),
@@ -170,110 +178,257 @@ def evoked_perform_filter(_, highpass, lowpass, id):
 
 @callback(
     Output(make_generic_id(MATCH, type="raw-once-interval"), "n_intervals", allow_duplicate=True),
-    Input(make_generic_id(MATCH, type="general-use-bipolar"), "checked"),
-    State(make_generic_id(MATCH, type="general-use-bipolar"), "id"),
+    Input(make_generic_id(MATCH, type="general-montage"), "value"),
+    State(make_generic_id(MATCH, type="general-montage"), "id"),
     prevent_initial_call=True,
     running=(
         (Output(make_generic_id(MATCH, type="raw-graph-loading"), "display"), "show", "hide"),
     )
 )
-def raw_switch_reference(checked, id):
+def raw_switch_montage(montage, id):
     if ctx.triggered_id is None:
         return no_update
     file = read_check_and_cache_file(decode_path(id))
-    return _alter_view(file, use_bipolar=checked)
+    return _switch_montage(file, montage)
 
 @callback(
     Output(make_generic_id(MATCH, type="epoch-once-interval"), "n_intervals", allow_duplicate=True),
-    Input(make_generic_id(MATCH, type="general-use-bipolar"), "checked"),
-    State(make_generic_id(MATCH, type="general-use-bipolar"), "id"),
+    Input(make_generic_id(MATCH, type="general-montage"), "value"),
+    State(make_generic_id(MATCH, type="general-montage"), "id"),
     prevent_initial_call=True,
     running=(
         (Output(make_generic_id(MATCH, type="epoch-graph-loading"), "display"), "show", "hide"),
     )
 )
-def epoch_switch_reference(checked, id):
+def epoch_switch_montage(montage, id):
     if ctx.triggered_id is None:
         return no_update
     file = read_check_and_cache_file(decode_path(id))
-    return _alter_view(file, use_bipolar=checked)
+    return _switch_montage(file, montage)
 
 @callback(
     Output(make_generic_id(MATCH, type="evoked-once-interval"), "n_intervals", allow_duplicate=True),
-    Input(make_generic_id(MATCH, type="general-use-bipolar"), "checked"),
-    State(make_generic_id(MATCH, type="general-use-bipolar"), "id"),
+    Input(make_generic_id(MATCH, type="general-montage"), "value"),
+    State(make_generic_id(MATCH, type="general-montage"), "id"),
     prevent_initial_call=True,
     running=(
         (Output(make_generic_id(MATCH, type="evoked-ch-graph-loading"), "display"), "show", "hide"),
     )
 )
-def evoked_switch_reference(checked, id):
+def evoked_switch_montage(montage, id):
     if ctx.triggered_id is None:
         return no_update
     file = read_check_and_cache_file(decode_path(id))
-    return _alter_view(file, use_bipolar=checked)
+    return _switch_montage(file, montage)
 
 
 
 
 def _alter_view(file: File, **kwargs):
-    reachable, todo = _state_reachable(file.item, **kwargs)
-    
-    if not reachable:
-        remove_cache(file.path)
-        file = read_check_and_cache_file(file.path)
-    
-    item = file.item
-    if "use_bipolar" in todo and todo["use_bipolar"]:
-        item = _use_bipolar(item)
-    if "highpass" in todo or "lowpass" in todo:
-        item = _filter(item, todo["highpass"], todo["lowpass"])
-    state = {
-        "use_bipolar": False,
-        "highpass": file.item.info["highpass"],
-        "lowpass": file.item.info["lowpass"]
-    } if not reachable else file.item.info["temp"]["state"]
-    state.update(todo)
-    file.item.info["temp"] = {
-        "state": state
+    # Views of a file form a small graph, e.g. as opened -> bandpass(0.5, 40) -> bandpass(1, 30)
+    # Every view left is kept in memory (see put_view_item), switching back to it is a lookup instead of a recompute
+    current = _view_state(file.item)
+    state = dict(current or _opened_state(file.item))
+    state.update(kwargs)
+    if state == current:
+        return 0
+
+    # The same recording was processed into the same state before (by any user), reuse it
+    shared_path = derived_item_path(file.path, state, GENII_EXT)
+    put_view_item(file.path, file, current)
+    view = _find_view(file, state, shared_path)
+    if view is None:
+        start, start_state = _find_start(file, state)
+        view = _derive_view(start, start_state, state)
+    # Edits (annotations, bads, dropped epochs) were made on whichever view was current
+    _carry_edits(file.item, view.item)
+    # The montage shown stays, a previewed filter too unless the filter changed, views kept from before drop theirs
+    preview = preview_state(file.item)
+    if "highpass" in kwargs or "lowpass" in kwargs:
+        preview = None
+    print(view.item.info["temp"]["state"])
+    cache_file(view.item, view.item_type, True, file.path, shared_path=shared_path, state=state)
+    # Also replaces what the journal says about the previous view
+    _set_display(file.path, preview, current_montage(file.item))
+    return 0
+
+def _view_state(item) -> dict | None:
+    # None for the object as it was opened
+    temp = item.info.get("temp", None)
+    return None if temp is None else temp.get("state")
+
+def _opened_state(item) -> dict:
+    return {
+        "highpass": item.info["highpass"],
+        "lowpass": item.info["lowpass"]
     }
-    print(file.item.info["temp"]["state"])
-    cache_file(file.item, file.item_type, True, file.path)
+
+def preview_state(item) -> dict | None:
+    """
+    Filter previewed on a raw ({"highpass": float, "lowpass": float}), None if there is none
+
+    The samples of the raw are not filtered, see read_preview_window()
+    """
+    temp = item.info.get("temp", None)
+    return None if temp is None else temp.get("preview")
+
+def _preview_filter(file: File, highpass, lowpass):
+    current = _view_state(file.item)
+    state = dict(current or _opened_state(file.item), highpass=highpass, lowpass=lowpass)
+    if not _state_reachable(current, state):
+        # Filtered narrower before, the wider band has to be recomputed
+        return _alter_view(file, highpass=highpass, lowpass=lowpass)
+    preview = {"highpass": highpass, "lowpass": lowpass} if state != current else None
+    _set_display(file.path, preview, current_montage(file.item))
+    return 0
+
+def _switch_montage(file: File, montage: str | None):
+    # Nothing is recomputed, the montage is applied to the samples read for a graph (see montage.montage_window())
+    _set_display(file.path, preview_state(file.item), montage or None)
     return 0
 
-def _state_reachable(item, **kwargs):
-    if item.info.get("temp", None) is None:
-        return False, kwargs
+def _set_display(path: str, preview: dict | None, montage: str | None):
+    # The cached object is changed in place and the change journaled, nothing is saved,
+    # other worker processes and re-opens after an eviction see it too
+    journal_file(path, {"op": "display", "preview": preview, "montage": montage})
+
+def read_preview_window(file: File, start: int, stop: int):
+    """
+    Samples start to stop of the raw of file with the previewed filter applied, None if no filter is previewed
+    """
+    preview = preview_state(file.item)
+    if preview is None:
+        return None
+    highpass, lowpass = _filter_freqs(file.item, preview["highpass"], preview["lowpass"])
+    key = (g.user_data["id"], os.path.realpath(file.path), repr(_view_state(file.item)))
+    return filter_window(file.item, highpass, lowpass, start, stop, key)
+
+def commit_preview(path: str) -> File:
+    """
+    Filter the whole raw of path with the previewed filter, before it is used for more than viewing (saving, epoching)
+    """
+    file = read_check_and_cache_file(path)
+    preview = preview_state(file.item)
+    if preview is not None:
+        _alter_view(file, **preview)
+        file = read_check_and_cache_file(path)
+    return file
+
+def view_of(path: str) -> dict | None:
+    """
+    How the cached object of path is processed and shown, to open it the same way in a job (see open_view())
+
+    None if it is not in memory, the copy on disk is current then
+    Nothing is opened or written
+    """
+    file = peek_cached_item(path)
+    if file is None:
+        return None
+    return {"state": _view_state(file.item), "preview": preview_state(file.item), "montage": current_montage(file.item)}
+
+def open_view(path: str, view: dict | None) -> File:
+    """
+    The object of path as view (see view_of()) describes it, with the previewed filter applied to the whole raw
+
+    For jobs: the view of the process that submitted the job may not be flushed yet,
+    it is derived again from what is on disk then (edits are journaled, they are there already)
+    Only the object as it is on disk is cached, the derived one is not
+    """
+    file = read_check_and_cache_file(path)
+    if view is None:
+        return file
+    state = view["state"]
+    if _view_state(file.item) != state:
+        if state is None:
+            derived = read_original_file(path)
+        else:
+            start, start_state = _find_start(file, state)
+            derived = _derive_view(start, start_state, state)
+        _carry_edits(file.item, derived.item)
+        file = derived
+    if view["preview"] is not None:
+        state = dict(_view_state(file.item) or _opened_state(file.item), **view["preview"])
+        start, start_state = _find_start(file, state)
+        derived = _derive_view(start, start_state, state)
+        _carry_edits(file.item, derived.item)
+        file = derived
+    return file
+
+def _find_view(file: File, state: dict, shared_path: str | None) -> File | None:
+    view = get_view_item(file.path, state, pop=True)
+    if view is None and shared_path is not None:
+        view = open_derived_item(file.path, shared_path, state)
+    return view
+
+def _find_start(file: File, state: dict):
+    # Nearest view state can be derived from: the current view if it still has everything state needs,
+    # otherwise the file as opened
+    current = _view_state(file.item)
+    if _state_reachable(current, state):
+        return file, current
+    view = get_view_item(file.path, None)
+    if view is None:
+        view = read_original_file(file.path)
+        put_view_item(file.path, view, None)
+    return view, None
+
+def _derive_view(start: File, start_state: dict | None, state: dict) -> File:
+    # start is kept as a view, processing never changes it in place
+    item = start.item
+    if _filter_freqs(item, state["highpass"], state["lowpass"]) == (None, None):
+        # Back to the band it was opened with
+        item = item.copy()
+    elif needs_out_of_core(item):
+        # Too long to load, filtered window by window into the cache format
+        out_path = derived_item_path(start.path, state, GENII_EXT) or private_derived_item_path(start.path, state, GENII_EXT)
+        item = worker_pool.run(filter_raw_out_of_core, item, *_filter_freqs(item, state["highpass"], state["lowpass"]), out_path)
     else:
-        state = item.info["temp"]["state"]
-        # bipolar -> average
-        if "use_bipolar" in kwargs and state["use_bipolar"] and not kwargs["use_bipolar"]:
-            state.update(kwargs)
-            return False, state
-        # lost info about freq < highpass
-        elif "highpass" in kwargs and state["highpass"] < kwargs["highpass"]:
-            state.update(kwargs)
-            return False, state
-        # lost info about freq > lowpass
-        elif "lowpass" in kwargs and state["lowpass"] > kwargs["lowpass"]:
-            state.update(kwargs)
-            return False, state
-    return True, kwargs
+        item = _filter(ensure_preloaded(File(item.copy(), start.item_type, True, start.path)).item, state["highpass"], state["lowpass"])
+    item.info["temp"] = {
+        "state": state
+    }
+    return File(item, start.item_type, True, start.path)
 
-def _filter(item, highpass, lowpass):
+def _state_reachable(src: dict | None, dst: dict) -> bool:
+    # Whether dst can be derived from src, the object as opened (None) reaches every state
+    if src is None:
+        return True
+    # lost info about freq < highpass
+    if src["highpass"] > dst["highpass"]:
+        return False
+    # lost info about freq > lowpass
+    if src["lowpass"] < dst["lowpass"]:
+        return False
+    return True
+
+def _carry_edits(src, dst):
+    if src is dst:
+        return
+    src_names = set(src.ch_names)
+    # Channels missing from src (e.g. re-referenced away) keep their own status
+    dst.info["bads"] = [
+        ch for ch in dst.ch_names
+        if (ch in src.info["bads"] if ch in src_names else ch in dst.info["bads"])
+    ]
+    if isinstance(src, mne.io.BaseRaw):
+        dst.set_annotations(src.annotations.copy())
+    elif isinstance(src, mne.BaseEpochs):
+        dropped = np.flatnonzero(~np.isin(dst.selection, src.selection))
+        if len(dropped) > 0:
+            dst.drop(dropped, reason="USER", verbose="error")
+
+def _filter_freqs(item, highpass, lowpass):
+    # Nothing to do for the edges the data is already filtered at
     if highpass <= item.info["highpass"]:
         highpass = None
     if lowpass >= item.info["lowpass"]:
         lowpass = None
-    
-    return item.filter(highpass, lowpass)
-
-def _use_bipolar(item):
-    return mne.set_bipolar_reference(
-        item,
-        anode=[ "Fp2", "F8", "T4", "T6", "Fp2", "F4", "C4", "P4", "Fz", "Cz", "Fp2", "F3", "C3", "P3", "Fp1", "F7", "T3", "T5" ],
-        cathode=[ "F8",  "T4", "T6", "O2", "F4",  "C4", "P4", "O2", "Cz", "Pz", "F3",  "C3", "P3", "O1", "F7",  "T3", "T5", "O1" ]
-    )
+    return highpass, lowpass
+
+def _filter(item, highpass, lowpass):
+    highpass, lowpass = _filter_freqs(item, highpass, lowpass)
+    # Channels are filtered in parallel, on the cores free in the shared pool
+    return worker_pool.run(item.filter, highpass, lowpass, max_cores=item.info["nchan"])
 
 @callback(
     Output("notifications-container", "children", allow_duplicate=True),
@@ -295,8 +450,11 @@ def save_file_as(_, name, id):
         # validate_access(path)
         # print("delete")
         # print(path)
-        file = read_check_and_cache_file(path)
-        save_mne_object(file.item.copy(), save_as_path + get_appropriate_ext(file.item_type))
+        file = commit_preview(path)
+        # Saved as shown, in the montage it is shown in
+        save_mne_object(apply_montage(file.item), save_as_path + get_appropriate_ext(file.item_type))
+        # An explicit save also persists pending edits of the working copy
+        flush_cache(path, fsync=True)
         
         notif = dmc.Notification(
             title="File Saved!",
@@ -0,0 +1,223 @@
+"""
+Montages (re-referencing schemes) applied to the samples being looked at, instead of to a copy of the recording
+
+A montage is a sparse matrix (shown channels x recorded channels), built once per montage and channel set,
+and applied to whatever window is read for a graph (montage_window())
+The object keeps its recorded channels, switching montages only changes info["temp"]["montage"]
+Channels no derived channel reads are shown unchanged after the derived ones
+
+Montages are the JSON files in GENII_MONTAGE_DIR (default: montages/ of the app), named after the file
+    {"label": str, "type": "bipolar", "pairs": [[anode, cathode], ...]}
+    {"label": str, "type": "average"}                                   EEG channel minus the mean of the good EEG channels
+    {"label": str, "type": "reference", "ref": [ch, ...]}              EEG channel minus the mean of ref
+    {"label": str, "type": "laplacian", "neighbors": {ch: [ch, ...]}}  ch minus the mean of its good neighbours
+    {"label": str, "type": "custom", "channels": {name: {ch: weight, ...}}}
+Channel names match case-insensitively and across the old and new 10-20 names (T3 / T7, ...),
+derived channels whose channels are missing are left out
+"""
+
+import os
+import json
+import functools
+import numpy as np
+import mne
+from dataclasses import dataclass
+from scipy import sparse
+from typing import Dict, List, Tuple
+
+_MONTAGE_DIR = os.environ.get(
+    "GENII_MONTAGE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "montages")
+)
+_MONTAGE_EXT = ".json"
+# Old and new 10-20 names of the same positions
+_ALIASES = {"t3": "t7", "t4": "t8", "t5": "p7", "t6": "p8"}
+_ALIASES.update({v: k for k, v in list(_ALIASES.items())})
+
+@dataclass(frozen=True)
+class _Operator():
+    ch_names: List[str]
+    bads: List[str]
+    matrix: sparse.csr_matrix
+    # Recorded channel each shown channel takes its type and position from (anode, re-referenced channel, ...)
+    anchors: List[int]
+    # Whether a shown channel is its anchor re-referenced (marking it bad marks the anchor) or a combination
+    is_anchor: List[bool]
+
+def _definition_files() -> Tuple[Tuple[str, float], ...]:
+    try:
+        names = sorted(n for n in os.listdir(_MONTAGE_DIR) if n.endswith(_MONTAGE_EXT))
+    except FileNotFoundError:
+        return ()
+    return tuple((n, os.stat(os.path.join(_MONTAGE_DIR, n)).st_mtime) for n in names)
+
+@functools.lru_cache(maxsize=4)
+def _load(files: Tuple[Tuple[str, float], ...]) -> Dict[str, dict]:
+    montages = {}
+    for name, _ in files:
+        try:
+            with open(os.path.join(_MONTAGE_DIR, name), encoding="utf-8") as f:
+                montages[name[:-len(_MONTAGE_EXT)]] = json.load(f)
+        except (OSError, ValueError) as e:
+            print("WARNING: Cannot load montage", name, e)
+    return montages
+
+def load_montages() -> Dict[str, dict]:
+    """
+    Montage definitions by name, read again whenever a file in GENII_MONTAGE_DIR changes
+    """
+    return _load(_definition_files())
+
+def montage_options() -> List[dict]:
+    return [{"label": m.get("label", name), "value": name} for name, m in load_montages().items()]
+
+def current_montage(item) -> str | None:
+    """
+    Name of the montage item is shown in, None for the recorded channels
+    """
+    temp = item.info.get("temp", None)
+    return None if temp is None else temp.get("montage")
+
+def _build(definition: dict, ch_names: Tuple[str, ...], ch_types: Tuple[str, ...], bads: Tuple[str, ...]) -> _Operator:
+    index = {}
+    for i, ch in enumerate(ch_names):
+        index.setdefault(ch.lower(), i)
+    def find(ch: str) -> int | None:
+        i = index.get(ch.lower())
+        return index.get(_ALIASES.get(ch.lower())) if i is None else i
+    bad = [ch in bads for ch in ch_names]
+    eeg = [i for i, t in enumerate(ch_types) if t == "eeg"]
+
+    # name, {recorded channel: weight}, anchor, is the anchor re-referenced
+    rows: List[Tuple[str, Dict[int, float], int, bool]] = []
+    kind = definition.get("type")
+    if kind == "bipolar":
+        for anode, cathode in definition["pairs"]:
+            a, c = find(anode), find(cathode)
+            if a is not None and c is not None:
+                rows.append((f"{ch_names[a]}-{ch_names[c]}", {a: 1., c: -1.}, a, False))
+    elif kind in ("average", "reference"):
+        if kind == "average":
+            ref = [i for i in eeg if not bad[i]]
+        else:
+            ref = [i for i in map(find, definition["ref"]) if i is not None]
+        if len(ref) == 0:
+            raise ValueError(f"No reference channel of the montage ({kind}) in the recording")
+        for i in eeg:
+            # Bad channels are left as recorded, like set_eeg_reference() does
+            if bad[i]:
+                weights = {i: 1.}
+            else:
+                weights = {j: -1. / len(ref) for j in ref}
+                weights[i] = weights.get(i, 0.) + 1.
+            rows.append((ch_names[i], weights, i, True))
+    elif kind == "laplacian":
+        for ch, neighbors in definition["neighbors"].items():
+            i = find(ch)
+            if i is None:
+                continue
+            around = [j for j in map(find, neighbors) if j is not None and not bad[j]]
+            # Shown as recorded without a good neighbour, the rows of its neighbours read it so it is not added below
+            weights = {j: -1. / len(around) for j in around}
+            weights[i] = 1.
+            rows.append((ch_names[i], weights, i, True))
+    elif kind == "custom":
+        for name, terms in definition["channels"].items():
+            weights = {find(ch): float(w) for ch, w in terms.items()}
+            if None in weights or len(weights) == 0:
+                continue
+            rows.append((name, weights, max(weights, key=weights.get), False))
+    else:
+        raise ValueError(f"Unknown montage type {kind}")
+
+    used = set(j for _, weights, _, _ in rows for j in weights)
+    rows.extend((ch, {i: 1.}, i, True) for i, ch in enumerate(ch_names) if i not in used)
+
+    data, indices, indptr = [], [], [0]
+    for _, weights, _, _ in rows:
+        indices.extend(weights.keys())
+        data.extend(weights.values())
+        indptr.append(len(indices))
+    matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(rows), len(ch_names)))
+    return _Operator(
+        ch_names=[name for name, _, _, _ in rows],
+        # A derived channel is as bad as the worst channel it reads, the means of average / laplacian skip bads
+        bads=[name for name, weights, anchor, is_anchor in rows if (bad[anchor] if is_anchor else any(bad[j] for j in weights))],
+        matrix=matrix,
+        anchors=[anchor for _, _, anchor, _ in rows],
+        is_anchor=[is_anchor for _, _, _, is_anchor in rows]
+    )
+
+@functools.lru_cache(maxsize=64)
+def _cached_operator(files, name: str, ch_names: Tuple[str, ...], ch_types: Tuple[str, ...], bads: Tuple[str, ...]) -> _Operator:
+    return _build(_load(files)[name], ch_names, ch_types, bads)
+
+def _item_operator(item, name: str) -> _Operator | None:
+    files = _definition_files()
+    if name not in _load(files):
+        print("WARNING: Montage", name, "not found, showing the recorded channels")
+        return None
+    return _cached_operator(files, name, tuple(item.info["ch_names"]), tuple(item.get_channel_types()), tuple(item.info["bads"]))
+
+def montage_window(item, data: np.ndarray) -> Tuple[List[str], List[str], np.ndarray]:
+    """
+    Channel names, bad channels and samples of data as shown in the montage of item
+
+    data: np.ndarray
+        Read from item, channels on the second to last axis (Raw / Evoked window or Epochs)
+    """
+    name = current_montage(item)
+    op = None if name is None else _item_operator(item, name)
+    if op is None:
+        return item.info["ch_names"], item.info["bads"], data
+    moved = np.moveaxis(data, -2, 0)
+    shown = op.matrix @ moved.reshape(moved.shape[0], -1)
+    return op.ch_names, op.bads, np.moveaxis(shown.reshape((-1,) + moved.shape[1:]), 0, -2)
+
+def recorded_channel(item, index: int) -> str | None:
+    """
+    Recorded channel behind shown channel index, None if the shown channel combines several (e.g. bipolar)
+    """
+    name = current_montage(item)
+    op = None if name is None else _item_operator(item, name)
+    if op is None:
+        return item.info["ch_names"][index]
+    return item.info["ch_names"][op.anchors[index]] if op.is_anchor[index] else None
+
+def apply_montage(item):
+    """
+    Copy of item with the channels of its montage instead of the recorded ones, e.g. to save what is shown
+
+    Every sample is read, a Raw is loaded into memory
+    """
+    name = current_montage(item)
+    op = None if name is None else _item_operator(item, name)
+    if op is None:
+        return item.copy()
+    _, _, data = montage_window(item, item.get_data())
+    types = item.get_channel_types()
+    info = mne.create_info(op.ch_names, item.info["sfreq"], [types[i] for i in op.anchors])
+    with info._unlock():
+        for ch, anchor in zip(info["chs"], op.anchors):
+            ch["loc"] = item.info["chs"][anchor]["loc"].copy()
+        info["highpass"] = item.info["highpass"]
+        info["lowpass"] = item.info["lowpass"]
+        info["bads"] = list(op.bads)
+    info.set_meas_date(item.info["meas_date"])
+    temp = dict(item.info["temp"])
+    temp.pop("montage")
+    info["temp"] = temp
+
+    if isinstance(item, mne.io.BaseRaw):
+        shown = mne.io.RawArray(data, info, first_samp=item.first_samp, verbose="error")
+        shown.set_annotations(item.annotations.copy())
+    elif isinstance(item, mne.BaseEpochs):
+        shown = mne.EpochsArray(
+            data, info, events=item.events, tmin=item.tmin, event_id=item.event_id,
+            metadata=item.metadata, selection=item.selection, drop_log=item.drop_log, verbose="error"
+        )
+    elif isinstance(item, mne.Evoked):
+        shown = mne.EvokedArray(data, info, tmin=item.tmin, comment=item.comment, nave=item.nave, kind=item.kind, verbose="error")
+    else:
+        raise TypeError(f"Montages do not apply to {type(item).__name__}")
+    return shown
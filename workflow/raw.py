@@ -4,11 +4,11 @@ import dash_bootstrap_components as dbc
 import dash_mantine_components as dmc
 from dash_iconify import DashIconify
 from .util import plot_to_base64
-from layout_impl.main_body import append_to_tabs
 from .epoch import render_epoch_content
-from file_io import read_and_cache_file, cache_file
+from file_io import read_and_cache_file, read_check_and_cache_file, read_original_file, cache_file, journal_file, prefetch_related_files
 from db.data_structure import File, FileType
 import os
+import jobs
 
 # import chart_studio.plotly as py
 from plotly import tools
@@ -16,7 +16,8 @@ from plotly.graph_objs import Layout, Scatter, Figure
 from plotly.graph_objs.layout import YAxis, Annotation, Font, shape
 from layout_impl.reusable import OnceInterval
 
-from .general import render_general_function
+from .general import render_general_function, read_preview_window, view_of, open_view
+from .montage import montage_window, recorded_channel, current_montage
 
 from path_based_id_util import make_id, make_generic_id, decode_path
 
@@ -103,7 +104,8 @@ def render_raw_content(file: File):
     montage = mne.channels.make_standard_montage("standard_1020")
     # file.item.drop_channels(list(set(file.item.ch_names) - montage.ch_names))
     file.item.set_montage(montage, match_case=False, match_alias=True, on_missing="ignore")
-    file.item.load_data().set_eeg_reference(projection=True)
+    # Only adds a projector, the raw can stay disk-backed
+    file.item.set_eeg_reference(projection=True)
     cache_file(file.item, FileType.RAW, False, file.path)
     content = dbc.Row(
         className="max-h-100",
@@ -223,7 +225,8 @@ def render_raw_graph(_, tmin, page_len, id):
         tmin = 0
     tmax = tmin + page_len
     path = decode_path(id)
-    raw = read_and_cache_file(path)
+    file = read_check_and_cache_file(path)
+    raw = file.item
 
     # view = raw.info.get("temp", {}).get("view", None)
     # if view is not None:
@@ -231,8 +234,14 @@ def render_raw_graph(_, tmin, page_len, id):
 
     start, stop = raw.time_as_index([tmin, tmax])
     data, times = raw[:, start:stop]
+    # A previewed filter is only applied to the page
+    preview = read_preview_window(file, start, stop)
+    if preview is not None:
+        data = preview
+    # So is the montage
+    ch_names, bads, data = montage_window(raw, data)
     
-    step = 1. / raw.info["nchan"]
+    step = 1. / len(ch_names)
     kwargs = dict(domain=[1 - step, 1], showticklabels=False, zeroline=False, showgrid=False, visible=False)
 
     # create objects for layout and traces
@@ -245,13 +254,13 @@ def render_raw_graph(_, tmin, page_len, id):
         x=times,
         y=data.T[:, 0],
         line={
-            "color": decide_ch_color(raw.info["ch_names"][0], raw.info["bads"]),
+            "color": decide_ch_color(ch_names[0], bads),
             "width": 1
         }
     )]
 
     # loop over the channels
-    for ii in range(1, raw.info["nchan"]):
+    for ii in range(1, len(ch_names)):
             kwargs.update(domain=[1 - (ii + 1) * step, 1 - ii * step])
             layout.update({'yaxis%d' % (ii + 1): YAxis(kwargs), 'showlegend': False})
             traces.append(Scatter(
@@ -259,7 +268,7 @@ def render_raw_graph(_, tmin, page_len, id):
                 y=data.T[:, ii],
                 yaxis='y%d' % (ii + 1),
                 line={
-                    "color": decide_ch_color(raw.info["ch_names"][ii], raw.info["bads"]),
+                    "color": decide_ch_color(ch_names[ii], bads),
                     "width": 1
                 }
             ))
@@ -270,7 +279,7 @@ def render_raw_graph(_, tmin, page_len, id):
             x=-0.06, y=0, xref='paper', yref='y%d' % (ii + 1),
             text=ch_name,
             showarrow=False
-        ) for ii, ch_name in enumerate(raw.info["ch_names"])
+        ) for ii, ch_name in enumerate(ch_names)
     ]
 
     layout.update(annotations=annotations, margin=dict(l=60, r=20, t=20, b=20))
@@ -395,7 +404,8 @@ def handle_annotate(clickData, ev_select, new_ev, curr_ev, tmin, page_len):
                 closest_line = i
                 closest_dist = dist
         if closest_line is not None:
-            raw.annotations.delete(closest_line)
+            ann = raw.annotations[closest_line]
+            journal_file(path, {"op": "annot_del", "onset": float(ann["onset"]), "duration": float(ann["duration"]), "description": str(ann["description"])})
             fig_shape = []
             for ann in raw.annotations.copy().crop(tmin, tmin + page_len, use_orig_time=False):
                 # FIXME copy pasted
@@ -443,38 +453,33 @@ def handle_annotate(clickData, ev_select, new_ev, curr_ev, tmin, page_len):
                     textposition="top center"
                 )
             ))
-            raw.annotations.append(click_x, 0, ev_select) # TODO support of duration
+            journal_file(path, {"op": "annot_add", "onset": click_x, "duration": 0, "description": ev_select}) # TODO support of duration
             # if have_new_ev:
             #     curr_ev = [curr_ev[0], *[{"label": e, "value": e} for e in raw.annotations.count().keys()]]
 
-    cache_file(raw, FileType.RAW, True, path)
-
     return fig, no_update if not have_new_ev else curr_ev, no_update if not have_new_ev else ev_select
 
 def handle_toggle_bad_ch(clickData):
     path = decode_path(ctx.triggered_id)
     raw = read_and_cache_file(path)
     ch_idx = clickData["points"][0]["curveNumber"]
-    ch_n = raw.ch_names[ch_idx]
-    if ch_n in raw.info["bads"]:
-        color = _DEFAULT_CH_LINE_COLOR
-        raw.info["bads"].remove(ch_n)
-    else:
-        color = _BAD_CH_LINE_COLOR
-        raw.info["bads"].append(ch_n)
+    ch_n = recorded_channel(raw, ch_idx)
+    if ch_n is None:
+        # FIXME bads are recorded channels, a derived channel (e.g. bipolar) cannot be marked on its own
+        return no_update
+    bad = ch_n not in raw.info["bads"]
+    color = _BAD_CH_LINE_COLOR if bad else _DEFAULT_CH_LINE_COLOR
+    journal_file(path, {"op": "bads", "ch": ch_n, "bad": bad})
     fig_data = Patch()
     fig_data["data"][ch_idx]["line"]["color"]=color
-    cache_file(raw, FileType.RAW, True, path)
     return fig_data
 
 @callback(
-    Output("content-tabs", "children", allow_duplicate=True),
-    Output("content-tabs", "value", allow_duplicate=True),
+    Output("job-poll-interval", "disabled", allow_duplicate=True),
     Input("extract-epoch-info-collector", "data"),
-    State({"type": "content-tab-list", "index": ALL}, "value"),
     prevent_initial_call=True
 )
-def extract_epoch(info, tab_values):
+def extract_epoch(info):
     # print("AAAAAAAAAAAAAAAAAAAAAA")
     # print(info)
     # print(path)
@@ -494,16 +499,44 @@ def extract_epoch(info, tab_values):
         info["tmax"] = _EPOCHING_TMAX
 
     path = decode_path(info)
-    raw = read_and_cache_file(path)
-    ep = mne.Epochs(raw, event_repeated="merge", tmin=info["tmin"], tmax=info["tmax"])[info["ev_name"]]
+    # Runs in the background, the job panel opens the epochs when they are ready
+    # The job opens the recording as it is shown here, nothing is flushed before (see open_view())
+    jobs.submit(
+        "extract_epoch",
+        "Epochs of " + os.path.basename(path) + ": " + info["ev_name"],
+        _extract_epoch_job, path, info["ev_name"], info["tmin"], info["tmax"], view_of(path)
+    )
+    # Wakes the job panel up
+    return False
+
+def _extract_epoch_job(job, path, ev_name, tmin, tmax, view):
+    job.progress(0., "Opening the recording")
+    raw = open_view(path, view).item
+    job.progress(0.5, "Extracting epochs")
+    ep = mne.Epochs(raw, event_repeated="merge", tmin=tmin, tmax=tmax)[ev_name]
     ep.load_data().drop_bad()
+    job.progress(0.9, "Saving")
     # if "temp" in ep.info:
     #     del ep.info["temp"]
     # ep_path = os.path.join(os.path.dirname(path), os.path.basename(path).split(".")[0]) + "-" + datetime.now().strftime("%d_%m_%y__%H_%M_%S") + "-epo.fif"
     ep_path = os.path.join(os.path.dirname(path), os.path.basename(path).split(".")[0]) + "-epo.fif"
     ep.save(ep_path, overwrite=True)
-    ep = cache_file(ep, FileType.EPOCH, True, ep_path)
-    return append_to_tabs(tab_values, *render_epoch_content(ep))
+    # info["temp"] is not saved, the filter state and the montage go with the result
+    temp = dict(ep.info.get("temp", None) or {})
+    temp.pop("montage", None)
+    temp.pop("preview", None)
+    if view is not None and view["montage"] is not None:
+        temp["montage"] = view["montage"]
+    return {"path": ep_path, "temp": temp or None}
+
+def _open_epoch_result(result):
+    file = read_original_file(result["path"])
+    file.item.info["temp"] = result["temp"]
+    ep = cache_file(file.item, FileType.EPOCH, True, result["path"])
+    prefetch_related_files(result["path"])
+    return render_epoch_content(ep)
+
+jobs.register_opener("extract_epoch", _open_epoch_result)
 
 # TODO stuff like this should be clientside callback but I am lazy
 # This implementation cause 2 round trips for 1 graph update